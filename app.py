@@ -1,100 +1,87 @@
 import os
-from flask import Flask, render_template, request, jsonify
+import re
+import json
+import time
+import queue
+import base64
+import functools
+import threading
+from datetime import datetime, timezone
+from flask import Blueprint, Flask, Response, g, render_template, request, jsonify, stream_with_context
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
 from werkzeug.security import generate_password_hash, check_password_hash
-
-app = Flask(__name__)
-
-# Configuración de Firestore
-PROJECT_ID = "surfn-peru"
-DATABASE_ID = "expenses"
+from ref_cache import TTLCache
+from gcp_clients import firestore_db
+import search_index
+import rollups
+import dedup
+import expense_fields
+import query_planner
+import sessions
+import expense_export
+import instrumentation
+from expense_stream import ExpenseStream, format_event
+
+# Rutas de la API; create_app() las registra en la app
+api = Blueprint('api', __name__)
+
+# Cliente de Firestore compartido: se crea con la primera consulta, no al importar (gcp_clients.py)
 # Joey
-
-# Inicializar cliente de Firestore
-db = firestore.Client(project=PROJECT_ID, database=DATABASE_ID)
+db = firestore_db
 collection_name = "expenses"
+deleted_collection = "expenses_deleted"  # tombstones para la sincronización incremental a BigQuery
 users_collection = "users"
 categories_collection = "categories"
 clients_collection = "clients"
 
-def initialize_categories():
-    """Inicializa la colección de categorías si está vacía."""
-    try:
-        docs = db.collection(categories_collection).limit(1).stream()
-        if not any(docs):
-            print("Inicializando categorías en Firestore...")
-            initial_categories = [
-                "Auto-Gasolina", "Auto-Estacionamiento", "Auto-Otros",
-                "Gasto-Rep-Comida", "Gasto-Rep-Otros", "Servicios-Misc", "Viajes-Misc"
-            ]
-            batch = db.batch()
-            for cat in initial_categories:
-                doc_ref = db.collection(categories_collection).document(cat)
-                batch.set(doc_ref, {"name": cat})
-            batch.commit()
-            print("Categorías inicializadas.")
-    except Exception as e:
-        print(f"Error inicializando categorías: {e}")
-
-def initialize_clients():
-    """Inicializa la colección de clientes si está vacía."""
-    try:
-        docs = db.collection(clients_collection).limit(1).stream()
-        if not any(docs):
-            print("Inicializando clientes en Firestore...")
-            initial_clients = [
-                "Delosi", "Cliente-1", "Cliente-2", "Cliente-3", "Cliente-4",
-                "Cliente-5", "Cliente-6", "Cliente-7", "Cliente-8", "Cliente-9",
-                "Cliente-10", "Cliente-11", "Cliente-12", "Cliente-13", "Cliente-14", "Cliente-15"
-            ]
-            batch = db.batch()
-            for client in initial_clients:
-                doc_ref = db.collection(clients_collection).document(client)
-                batch.set(doc_ref, {"company_name": client})
-            batch.commit()
-            print("Clientes inicializados.")
-    except Exception as e:
-        print(f"Error inicializando clientes: {e}")
-
-# Initialize categories on startup
-# Initialize categories on startup
-initialize_categories()
-initialize_clients()
-
-def initialize_admin_user():
-    """Crea un usuario administrador por defecto si no existe."""
-    try:
-        admin_ref = db.collection(users_collection).document("admin")
-        if not admin_ref.get().exists:
-            print("Creando usuario admin por defecto...")
-            hashed_password = generate_password_hash("admin123")
-            admin_data = {
-                "username": "admin",
-                "password": hashed_password,
-                "role": "admin",
-                "created_at": firestore.SERVER_TIMESTAMP
-            }
-            admin_ref.set(admin_data)
-            print("Usuario admin creado.")
-    except Exception as e:
-        print(f"Error inicializando admin: {e}")
-
-initialize_admin_user()
-
-def is_admin(user_id):
-    """Determina si un usuario es administrador."""
-    # TODO: In the future, check role in DB
-    return user_id and (user_id.startswith("Gerente-") or user_id == "admin")
-
-@app.route('/admin')
+# Caché de listas de referencia (categorías, clientes, usuarios)
+REF_CACHE_TTL = int(os.environ.get('REF_CACHE_TTL', 300))
+ref_cache = TTLCache(ttl=REF_CACHE_TTL)
+
+def cached_list_response(key, loader):
+    """Responde una lista de referencia desde la caché, con ETag para peticiones condicionales."""
+    value, etag = ref_cache.get(key, loader)
+    response = jsonify(value)
+    response.set_etag(etag)
+    # no-cache: el navegador guarda la respuesta pero revalida siempre (304 si no cambió)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+# Sesiones: token firmado emitido por /api/login (sessions.py)
+UNAUTHORIZED = "Sesión inválida o expirada"
+
+def current_session(allow_query_token=False):
+    """Sesión del token 'Authorization: Bearer', o de ?token= si se permite; None si no es válida."""
+    query_token = request.args.get('token') if allow_query_token else None
+    return sessions.verify(sessions.token_from(request.headers.get('Authorization'), query_token))
+
+def require_session(view):
+    """Rechaza con 401 las peticiones sin sesión válida; la sesión queda en g.session."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        session = current_session()
+        if session is None:
+            return jsonify({"status": "error", "message": UNAUTHORIZED}), 401
+        g.session = session
+        return view(*args, **kwargs)
+    return wrapper
+
+def admin_only():
+    """Respuesta 403 si la sesión no es de administrador, o None."""
+    if not g.session.is_admin:
+        return jsonify({"status": "error", "message": "No autorizado"}), 403
+    return None
+
+@api.route('/admin')
 def admin_dashboard():
     return render_template('admin.html')
 
-@app.route('/')
+@api.route('/')
 def index():
     return render_template('recibos.html')
 
-@app.route('/api/register', methods=['POST'])
+@api.route('/api/register', methods=['POST'])
 def register():
     try:
         data = request.json
@@ -104,6 +91,12 @@ def register():
         if not username or not password:
             return jsonify({"status": "error", "message": "Faltan datos"}), 400
 
+        # Los nombres con rol (admin, Gerente-*) solo los crea un administrador
+        if sessions.role_of(username) != 'user':
+            session = current_session()
+            if session is None or not session.is_admin:
+                return jsonify({"status": "error", "message": "No autorizado"}), 403
+
         # Check if user exists
         user_ref = db.collection(users_collection).document(username)
         if user_ref.get().exists:
@@ -118,12 +111,13 @@ def register():
             "created_at": firestore.SERVER_TIMESTAMP
         }
         user_ref.set(user_data)
+        ref_cache.invalidate("users")
         
         return jsonify({"status": "success", "username": username}), 201
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def login():
     try:
         data = request.json
@@ -133,40 +127,71 @@ def login():
         if not username or not password:
             return jsonify({"status": "error", "message": "Faltan datos"}), 400
 
+        # Límite de intentos fallidos por usuario, antes de leer Firestore o calcular el hash
+        retry_after = sessions.login_limiter.retry_after(username)
+        if retry_after:
+            response = jsonify({"status": "error", "message": "Demasiados intentos, intente más tarde"})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+
         user_ref = db.collection(users_collection).document(username)
         doc = user_ref.get()
 
         if not doc.exists:
+             sessions.login_limiter.failed(username)
              return jsonify({"status": "error", "message": "Usuario no encontrado"}), 404
         
         user_data = doc.to_dict()
         if check_password_hash(user_data.get('password'), password):
-            return jsonify({"status": "success", "username": username, "role": user_data.get('role', 'user')}), 200
+            sessions.login_limiter.succeeded(username)
+            # Único punto donde se lee el usuario y se verifica el hash; luego basta el token
+            role = sessions.role_of(username, user_data.get('role'))
+            return jsonify({"status": "success", "username": username, "role": role,
+                            "token": sessions.issue(username, role), "expires_in": sessions.SESSION_TTL}), 200
         else:
+            sessions.login_limiter.failed(username)
             return jsonify({"status": "error", "message": "Contraseña incorrecta"}), 401
 
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/users', methods=['GET'])
+def load_users():
+    users = db.collection(users_collection).stream()
+    return [doc.id for doc in users]
+
+@api.route('/api/users', methods=['GET'])
+@require_session
 def get_users():
+    denied = admin_only()
+    if denied:
+        return denied
     try:
-        users = db.collection(users_collection).stream()
-        user_list = [doc.id for doc in users]
-        return jsonify(user_list), 200
+        return cached_list_response("users", load_users)
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/users/<user_id>', methods=['DELETE'])
+@api.route('/api/users/<user_id>', methods=['DELETE'])
+@require_session
 def delete_user(user_id):
+    denied = admin_only()
+    if denied:
+        return denied
     try:
         db.collection(users_collection).document(user_id).delete()
+        sessions.revocations.revoke(user_id)
+        ref_cache.invalidate("users")
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/users/<user_id>', methods=['PUT'])
+@api.route('/api/users/<user_id>', methods=['PUT'])
+@require_session
 def update_user(user_id):
+    # Cada usuario cambia su propia contraseña; las de otros, solo un administrador
+    if user_id != g.session.username:
+        denied = admin_only()
+        if denied:
+            return denied
     try:
         data = request.json
         password = data.get('password')
@@ -175,23 +200,32 @@ def update_user(user_id):
             
         hashed_password = generate_password_hash(password)
         db.collection(users_collection).document(user_id).update({"password": hashed_password})
+        # Las sesiones abiertas con la contraseña anterior dejan de valer
+        sessions.revocations.revoke(user_id)
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/categories', methods=['GET'])
+def load_categories():
+    categories = db.collection(categories_collection).stream()
+    category_list = [doc.to_dict().get('name') for doc in categories]
+    # Filter out None values just in case
+    category_list = [c for c in category_list if c]
+    return sorted(category_list)
+
+@api.route('/api/categories', methods=['GET'])
 def get_categories():
     try:
-        categories = db.collection(categories_collection).stream()
-        category_list = [doc.to_dict().get('name') for doc in categories]
-        # Filter out None values just in case
-        category_list = [c for c in category_list if c]
-        return jsonify(sorted(category_list)), 200
+        return cached_list_response("categories", load_categories)
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/categories', methods=['POST'])
+@api.route('/api/categories', methods=['POST'])
+@require_session
 def add_category():
+    denied = admin_only()
+    if denied:
+        return denied
     try:
         data = request.json
         name = data.get('name')
@@ -199,20 +233,30 @@ def add_category():
             return jsonify({"status": "error", "message": "Nombre requerido"}), 400
         
         db.collection(categories_collection).document(name).set({"name": name})
+        ref_cache.invalidate("categories")
         return jsonify({"status": "success"}), 201
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/categories/<category_id>', methods=['DELETE'])
+@api.route('/api/categories/<category_id>', methods=['DELETE'])
+@require_session
 def delete_category(category_id):
+    denied = admin_only()
+    if denied:
+        return denied
     try:
         db.collection(categories_collection).document(category_id).delete()
+        ref_cache.invalidate("categories")
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/categories/<category_id>', methods=['PUT'])
+@api.route('/api/categories/<category_id>', methods=['PUT'])
+@require_session
 def update_category(category_id):
+    denied = admin_only()
+    if denied:
+        return denied
     try:
         data = request.json
         name = data.get('name')
@@ -220,27 +264,35 @@ def update_category(category_id):
             return jsonify({"status": "error", "message": "Name required"}), 400
             
         db.collection(categories_collection).document(category_id).update({"name": name})
+        ref_cache.invalidate("categories")
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/clients', methods=['GET'])
+def load_clients():
+    clients = db.collection(clients_collection).stream()
+    # Support both 'name' (legacy/default) and 'company_name' (imported data)
+    client_list = []
+    for doc in clients:
+        data = doc.to_dict()
+        name = data.get('company_name') or data.get('name')
+        if name:
+            client_list.append(name)
+    return sorted(client_list)
+
+@api.route('/api/clients', methods=['GET'])
 def get_clients():
     try:
-        clients = db.collection(clients_collection).stream()
-        # Support both 'name' (legacy/default) and 'company_name' (imported data)
-        client_list = []
-        for doc in clients:
-            data = doc.to_dict()
-            name = data.get('company_name') or data.get('name')
-            if name:
-                client_list.append(name)
-        return jsonify(sorted(client_list)), 200
+        return cached_list_response("clients", load_clients)
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/clients', methods=['POST'])
+@api.route('/api/clients', methods=['POST'])
+@require_session
 def add_client():
+    denied = admin_only()
+    if denied:
+        return denied
     try:
         data = request.json
         name = data.get('name') # Frontend should send 'name'
@@ -249,20 +301,30 @@ def add_client():
         
         # Use name as doc ID for simplicity, matching initialize_clients
         db.collection(clients_collection).document(name).set({"company_name": name})
+        ref_cache.invalidate("clients")
         return jsonify({"status": "success"}), 201
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/clients/<client_id>', methods=['DELETE'])
+@api.route('/api/clients/<client_id>', methods=['DELETE'])
+@require_session
 def delete_client(client_id):
+    denied = admin_only()
+    if denied:
+        return denied
     try:
         db.collection(clients_collection).document(client_id).delete()
+        ref_cache.invalidate("clients")
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/clients/<client_id>', methods=['PUT'])
+@api.route('/api/clients/<client_id>', methods=['PUT'])
+@require_session
 def update_client(client_id):
+    denied = admin_only()
+    if denied:
+        return denied
     try:
         data = request.json
         company_name = data.get('company_name')
@@ -270,90 +332,655 @@ def update_client(client_id):
             return jsonify({"status": "error", "message": "Company Name required"}), 400
             
         db.collection(clients_collection).document(client_id).update({"company_name": company_name})
+        ref_cache.invalidate("clients")
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-from bq_import import sync_firestore_to_bigquery
-
-@app.route('/api/bq-export', methods=['POST'])
+@api.route('/api/cache-stats', methods=['GET'])
+@require_session
+def cache_stats():
+    denied = admin_only()
+    if denied:
+        return denied
+    return jsonify(ref_cache.stats()), 200
+
+@api.route('/api/session-stats', methods=['GET'])
+@require_session
+def session_stats():
+    denied = admin_only()
+    if denied:
+        return denied
+    return jsonify(sessions.stats()), 200
+
+from export_jobs import ExportJobs, ExportAlreadyRunning
+from scan_jobs import ScanJobs, ScanQueueFull
+
+def sync_firestore_to_bigquery(**kwargs):
+    # bq_import carga BigQuery y pyarrow: se importa recién con la primera exportación
+    from bq_import import sync_firestore_to_bigquery as sync
+    with instrumentation.span("bigquery.sync", **kwargs):
+        return sync(**kwargs)
+
+# La exportación corre en segundo plano para no ocupar un thread de gunicorn
+export_jobs = ExportJobs(db, sync_firestore_to_bigquery)
+
+@api.route('/api/bq-export', methods=['POST'])
+@require_session
 def bq_export():
+    denied = admin_only()
+    if denied:
+        return denied
     try:
-        sync_firestore_to_bigquery()
-        return jsonify({"status": "success", "message": "Exportación a BigQuery completada correctament."}), 200
+        data = request.get_json(silent=True) or {}
+        job_id = export_jobs.start(full=bool(data.get('full')))
+        return jsonify({"status": "accepted", "job_id": job_id, "message": "Exportación a BigQuery iniciada."}), 202
+    except ExportAlreadyRunning as e:
+        return jsonify({"status": "error", "job_id": e.job_id, "message": "Ya hay una exportación en curso."}), 409
     except Exception as e:
          return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/expenses', methods=['POST'])
+@api.route('/api/bq-export/<job_id>', methods=['GET'])
+@require_session
+def bq_export_status(job_id):
+    denied = admin_only()
+    if denied:
+        return denied
+    try:
+        job = export_jobs.get(job_id)
+        if not job:
+            return jsonify({"status": "error", "message": "Trabajo no encontrado"}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api.route('/api/expenses', methods=['POST'])
+@require_session
 def add_expense():
     try:
         data = request.json
-        update_time, doc_ref = db.collection(collection_name).add(data)
-        return jsonify({"status": "success", "id": doc_ref.id}), 201
+        data.setdefault('ejecutivo', g.session.username)
+        if not g.session.is_admin and data['ejecutivo'] != g.session.username:
+            return jsonify({"status": "error", "message": "No puede registrar gastos de otro ejecutivo"}), 403
+        # Se guarda como AAAA-MM-DD, igual que en la carga masiva (orden, rollups y exportaciones dependen de eso)
+        fecha = parse_fecha(data.get('fecha', ''))
+        if not fecha:
+            return jsonify({"status": "error", "message": "fecha inválida (use AAAA-MM-DD o DD/MM/AAAA)"}), 400
+        data['fecha'] = fecha
+        # Mismo recibo ya registrado (a mano, por un reintento o por otro ejecutivo)
+        duplicates = dedup.find_duplicates(db, data) if dedup.MODE != 'off' else []
+        if duplicates:
+            if dedup.MODE == 'reject' and request.args.get('allow_duplicate') != '1':
+                return jsonify({"status": "error", "message": "Posible gasto duplicado",
+                                "duplicates": duplicates}), 409
+            data['posible_duplicado'] = [d['id'] for d in duplicates]
+        # Marca de cambio usada como watermark por bq_import
+        data['actualizado_en'] = firestore.SERVER_TIMESTAMP
+        # Gasto + entradas de los índices de búsqueda y duplicados + rollups en el mismo batch
+        doc_ref = db.collection(collection_name).document()
+        batch = db.batch()
+        batch.set(doc_ref, data)
+        search_index.index_expense(batch, db, doc_ref.id, data)
+        dedup.index_expense(batch, db, doc_ref.id, data)
+        rollups.write_deltas(batch, db, rollups.accumulate({}, data, 1))
+        batch.commit()
+        return jsonify({"status": "success", "id": doc_ref.id, "duplicates": duplicates}), 201
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/expenses', methods=['GET'])
-def get_expenses():
+# Carga masiva de gastos (POST /api/expenses/batch)
+MAX_BATCH_ROWS = 1000
+WRITE_CHUNK = 70  # cada fila = gasto + 2 índices + hasta 4 buckets de rollups; un batch admite 500 escrituras
+EXPENSE_FIELDS = ['ejecutivo', 'fecha', 'categoria', 'establecimiento', 'cliente',
+                  'monto', 'descripcion', 'moneda', 'reportado_en']
+CLIENT_ID_RE = re.compile(r'^(?!__.*__$)[A-Za-z0-9_-]{1,128}$')  # Firestore reserva los ids __*__
+
+def parse_fecha(value):
+    """Fecha como YYYY-MM-DD (acepta ISO y el formato de los estados de cuenta), o None."""
+    day = expense_fields.parse_fecha(value)
+    return day.isoformat() if day else None
+
+def normalize_expense(row, categories, clients, session=None):
+    """
+    Valida y normaliza una fila de la carga masiva. Devuelve (id del cliente,
+    datos, errores); categoria y cliente se corrigen a su nombre registrado.
+    """
+    if not isinstance(row, dict):
+        return None, None, ["La fila no es un objeto JSON"]
+    errors = []
+    data = {field: row[field] for field in EXPENSE_FIELDS if row.get(field) not in (None, '')}
+
+    # Como texto: el id 5 y el id "5" son el mismo documento
+    client_id = str(row['id']) if row.get('id') is not None else None
+    if client_id is not None and not CLIENT_ID_RE.match(client_id):
+        errors.append("id inválido (letras, números, '-' o '_', máx. 128, no '__...__')")
+
+    if session:
+        data.setdefault('ejecutivo', session.username)
+    if not data.get('ejecutivo'):
+        errors.append("Falta ejecutivo")
+    elif session and not session.is_admin and data['ejecutivo'] != session.username:
+        errors.append("No puede registrar gastos de otro ejecutivo")
+
+    fecha = parse_fecha(data.get('fecha', ''))
+    if fecha:
+        data['fecha'] = fecha
+    else:
+        errors.append("fecha inválida (use AAAA-MM-DD o DD/MM/AAAA)")
+
+    monto = expense_fields.parse_monto(data.get('monto'))
+    if monto is None or monto <= 0:
+        errors.append("monto debe ser un número mayor que 0")
+    else:
+        data['monto'] = round(monto, 2)
+
+    for field, valid in (('categoria', categories), ('cliente', clients)):
+        value = data.get(field)
+        if value is None:
+            if field == 'categoria':
+                errors.append("Falta categoria")
+            continue
+        match = valid.get(str(value).strip().lower())
+        if match:
+            data[field] = match
+        else:
+            errors.append(f"{field} no registrado en el sistema: {value}")
+
+    data.setdefault('moneda', 'PEN')
+    data.setdefault('reportado_en', datetime.now(timezone.utc).isoformat())
+    data['actualizado_en'] = firestore.SERVER_TIMESTAMP
+    return client_id, data, errors
+
+def read_batch_rows():
+    """Filas del cuerpo: un arreglo JSON o NDJSON (una fila por línea)."""
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        rows = []
+        for line in request.stream:
+            if line.strip():
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    rows.append(None)  # se reporta como fila inválida
+            if len(rows) > MAX_BATCH_ROWS:
+                break
+        return rows
+    rows = request.get_json(silent=True)
+    if not isinstance(rows, list):
+        raise ValueError("Se espera un arreglo JSON o NDJSON")
+    return rows
+
+def create_expense_chunk(rows):
+    """
+    Crea en un batch los gastos (con sus entradas de los índices y los
+    rollups) cuyo id aún no existe. rows: [(índice, doc_id, datos)]. Devuelve (índices creados, ids ya existentes).
+    """
+    refs = [db.collection(collection_name).document(doc_id) for _, doc_id, _ in rows]
+    for attempt in range(3):
+        existing = {snap.id for snap in db.get_all(refs) if snap.exists}
+        batch = db.batch()
+        created = []
+        deltas = {}
+        for (index, doc_id, data), ref in zip(rows, refs):
+            if doc_id in existing:
+                continue
+            # create() y no set(): si otro reintento lo creó entretanto, el batch falla en vez de duplicar
+            batch.create(ref, data)
+            search_index.index_expense(batch, db, doc_id, data)
+            dedup.index_expense(batch, db, doc_id, data)
+            rollups.accumulate(deltas, data, 1)
+            created.append(index)
+        if not created:
+            return created, existing
+        # Los totales se confirman con los gastos que cuentan
+        rollups.write_deltas(batch, db, deltas)
+        try:
+            batch.commit()
+            return created, existing
+        except AlreadyExists:
+            if attempt == 2:
+                raise
+
+@api.route('/api/expenses/batch', methods=['POST'])
+@require_session
+def add_expenses_batch():
+    """
+    Carga masiva: arreglo JSON o NDJSON de gastos. Cada fila puede traer un
+    'id' propio (p. ej. generado offline); reenviar la misma fila no la
+    duplica. Los posibles duplicados se marcan o rechazan por fila según
+    DEDUP_MODE. Devuelve el resultado de cada fila en el mismo orden.
+    """
     try:
-        user_id = request.args.get('user_id')
-        search_query = request.args.get('search', '').lower()
-        date_from = request.args.get('date_from')
-        date_to = request.args.get('date_to')
-        category = request.args.get('category')
-        client = request.args.get('client')
-
-        query = db.collection(collection_name)
-
-        # 1. Filtro de Seguridad (Role-based)
-        if not is_admin(user_id):
-            query = query.where("ejecutivo", "==", user_id)
-
-        # 2. Filtros Específicos
-        if category:
-            query = query.where("categoria", "==", category)
-        if client:
-            query = query.where("cliente", "==", client)
-        if date_from:
-            query = query.where("fecha", ">=", date_from)
-        if date_to:
-            query = query.where("fecha", "<=", date_to)
-
-        # Ordenar por fecha descending
-        # NOTA: Si se usan múltiples filtros de desigualdad, Firestore requiere un índice compuesto.
-        query = query.order_by('fecha', direction=firestore.Query.DESCENDING)
-        
-        docs = query.limit(100).stream()
-        
+        try:
+            rows = read_batch_rows()
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        if len(rows) > MAX_BATCH_ROWS:
+            return jsonify({"status": "error", "message": f"Máximo {MAX_BATCH_ROWS} filas por petición"}), 413
+
+        categories = {c.lower(): c for c in ref_cache.get("categories", load_categories)[0]}
+        clients = {c.lower(): c for c in ref_cache.get("clients", load_clients)[0]}
+
         results = []
-        for doc in docs:
-            item = doc.to_dict()
-            item['id'] = doc.id
-            
-            # Filtro de búsqueda textual (establecimiento) en memoria para evitar complejidad de índices
-            if search_query:
-                content = f"{item.get('establecimiento', '')} {item.get('descripcion', '')}".lower()
-                if search_query in content:
-                    results.append(item)
-            else:
+        valid = []
+        seen_ids = set()
+        for index, row in enumerate(rows):
+            client_id, data, errors = normalize_expense(row, categories, clients, g.session)
+            if client_id is not None and client_id in seen_ids:
+                errors.append("id repetido en la petición")
+            if errors:
+                results.append({"index": index, "status": "invalid", "errors": errors})
+                continue
+            doc_id = client_id if client_id is not None else db.collection(collection_name).document().id
+            seen_ids.add(doc_id)
+            results.append({"index": index, "status": "pending", "id": doc_id})
+            valid.append((index, doc_id, data))
+
+        # Posibles duplicados, fila por fila como en POST /api/expenses (una sola lectura del índice)
+        if dedup.MODE != 'off' and valid:
+            reject = dedup.MODE == 'reject' and request.args.get('allow_duplicate') != '1'
+            matches = dedup.find_duplicates_many(db, [(doc_id, data) for _, doc_id, data in valid])
+            kept = []
+            for (index, doc_id, data), duplicates in zip(valid, matches):
+                if duplicates:
+                    results[index]["duplicates"] = duplicates
+                    if reject:
+                        results[index]["status"] = "duplicate"
+                        continue
+                    data['posible_duplicado'] = [d['id'] for d in duplicates]
+                kept.append((index, doc_id, data))
+            valid = kept
+
+        for start in range(0, len(valid), WRITE_CHUNK):
+            chunk = valid[start:start + WRITE_CHUNK]
+            try:
+                created, existing = create_expense_chunk(chunk)
+            except Exception as e:
+                for index, _, _ in chunk:
+                    results[index].update(status="error", errors=[str(e)])
+                continue
+            created = set(created)
+            for index, _, _ in chunk:
+                if index in created:
+                    results[index]["status"] = "created"
+                else:
+                    results[index]["status"] = "exists"
+
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        rejected = counts.get("invalid", 0) + counts.get("error", 0) + counts.get("duplicate", 0)
+        status = "success" if rejected == 0 else "partial"
+        return jsonify({"status": status, "counts": counts, "results": results}), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# Paginación por cursor (keyset) sobre (fecha, id)
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(fecha, doc_id):
+    """Token opaco para el cliente a partir de la última fila leída."""
+    raw = json.dumps([fecha, doc_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    padded = token + '=' * (-len(token) % 4)
+    fecha, doc_id = json.loads(base64.urlsafe_b64decode(padded))
+    return fecha, doc_id
+
+def page_params(args):
+    """(page_size, cursor) de los parámetros de la petición; ValueError si son inválidos."""
+    page_size = min(max(int(args.get('page_size', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    cursor_token = args.get('cursor')
+    try:
+        cursor = decode_cursor(cursor_token) if cursor_token else None
+    except (TypeError, ValueError):
+        # base64/JSON válido pero con otra forma (p. ej. "5") también es un cursor inválido
+        raise ValueError("Cursor inválido")
+    return page_size, cursor
+
+def expense_filters(args, session):
+    """Filtro de seguridad (por rol) + filtros específicos, en el formato de query_planner."""
+    return {
+        "ejecutivo": None if session.is_admin else session.username,
+        "categoria": args.get('category') or None,
+        "cliente": args.get('client') or None,
+        "date_from": args.get('date_from'),
+        "date_to": args.get('date_to'),
+    }
+
+def expense_page(args, session, page_size, cursor):
+    """Una página de gastos (items, cursor siguiente) con los filtros de /api/expenses."""
+    search_query = args.get('search', '').strip()
+    # Búsqueda textual: se resuelve con el índice invertido (search_index)
+    if search_query:
+        ids, next_cursor = search_index.search(
+            db, search_query,
+            ejecutivo=None if session.is_admin else session.username,
+            date_from=args.get('date_from'), date_to=args.get('date_to'),
+            category=args.get('category'), client=args.get('client'),
+            page_size=page_size, cursor=cursor)
+        refs = [db.collection(collection_name).document(doc_id) for doc_id in ids]
+        docs = {doc.id: doc for doc in db.get_all(refs)} if refs else {}
+        results = []
+        for doc_id in ids:
+            doc = docs.get(doc_id)
+            if doc and doc.exists:
+                item = doc.to_dict()
+                item['id'] = doc.id
                 results.append(item)
-                
-        return jsonify(results)
+        return results, next_cursor
+
+    # query_planner decide cuáles filtros van a Firestore según los índices compuestos existentes
+    return query_planner.execute(db, expense_filters(args, session), page_size, cursor, collection_name)
+
+@api.route('/api/expenses', methods=['GET'])
+@require_session
+def get_expenses():
+    try:
+        try:
+            page_size, cursor = page_params(request.args)
+        except ValueError:
+            return jsonify({"status": "error", "message": "Parámetros de paginación inválidos"}), 400
+
+        results, next_cursor = expense_page(request.args, g.session, page_size, cursor)
+        return jsonify({"items": results, "next_cursor": encode_cursor(*next_cursor) if next_cursor else None})
     except Exception as e:
-        print(f"ERROR en get_expenses: {e}")
-        # Si Firestore arroja un error de índice faltante, el mensaje contendrá el link para crearlo.
+        instrumentation.log_exception("get_expenses")
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route('/api/expenses/<doc_id>', methods=['DELETE'])
+# Exportación: mismos filtros que /api/expenses; se recorre Firestore página a
+# página y el archivo sale por partes (chunked), sin armarlo en memoria
+EXPORT_PAGE_SIZE = 500
+EXPORT_MAX_CONCURRENT = int(os.environ.get('EXPORT_MAX_CONCURRENT', 2))  # cada una ocupa un hilo de gunicorn
+export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+def iter_expense_pages(args, session, page_size=EXPORT_PAGE_SIZE):
+    cursor = None
+    while True:
+        items, cursor = expense_page(args, session, page_size, cursor)
+        yield items
+        if not cursor:
+            return
+
+@api.route('/api/expenses/export', methods=['GET'])
+@require_session
+def export_expenses():
+    """Gastos filtrados en CSV, XLSX o Parquet (?format=), opcionalmente comprimidos (?gzip=1)."""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in expense_export.FORMATS:
+        return jsonify({"status": "error", "message": "Formato inválido (csv, xlsx o parquet)"}), 400
+    compress = request.args.get('gzip') in ('1', 'true')
+    if not export_slots.acquire(blocking=False):
+        return jsonify({"status": "error", "message": "Demasiadas exportaciones en curso, intente más tarde"}), 503
+
+    content_type, extension = expense_export.FORMATS[fmt]
+    filename = f"gastos-{datetime.now(timezone.utc):%Y%m%d}.{extension}" + ('.gz' if compress else '')
+    pages = iter_expense_pages(request.args.to_dict(), g.session)
+
+    def chunks():
+        try:
+            yield from expense_export.export(pages, fmt, compress)
+        except Exception:
+            # Ya se envió el estado 200: el cliente recibe un archivo cortado
+            instrumentation.log_exception("export_expenses", format=fmt)
+            raise
+
+    response = Response(stream_with_context(chunks()),
+                        content_type='application/gzip' if compress else content_type)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    # El cupo se libera al cerrar la respuesta, aunque el generador nunca llegue a correr
+    response.call_on_close(export_slots.release)
+    return response
+
+# Cambios en vivo (Server-Sent Events). Cada cliente conectado ocupa un hilo de
+# gunicorn, por eso el máximo queda por debajo de --threads y cada conexión se
+# cierra tras SSE_MAX_SECONDS (EventSource se reconecta solo). En modo asgi.py
+# esta ruta la atiende una corrutina que no ocupa hilos.
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', 4))
+SSE_MAX_SECONDS = int(os.environ.get('SSE_MAX_SECONDS', 300))
+SSE_HEARTBEAT = 15
+expense_stream = ExpenseStream(db, collection_name, deleted_collection, max_subscribers=SSE_MAX_CLIENTS)
+
+@api.route('/api/expenses/stream', methods=['GET'])
+def stream_expenses():
+    """Eventos added/modified/removed de los gastos que el usuario puede ver."""
+    # EventSource no puede enviar cabeceras: el token llega como ?token=
+    session = current_session(allow_query_token=True)
+    if session is None:
+        return jsonify({"status": "error", "message": UNAUTHORIZED}), 401
+    subscriber = expense_stream.subscribe(None if session.is_admin else session.username)
+    if subscriber is None:
+        # El cliente sigue funcionando sin tiempo real (recarga tras cada cambio)
+        return jsonify({"status": "error", "message": "Demasiadas conexiones en vivo"}), 503
+
+    def events():
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        try:
+            yield "retry: 3000\n\n"
+            while time.monotonic() < deadline:
+                try:
+                    kind, payload = subscriber.next_event(timeout=SSE_HEARTBEAT)
+                    yield format_event(kind, payload)
+                except queue.Empty:
+                    yield ": ping\n\n"  # mantiene viva la conexión a través de proxies
+        finally:
+            expense_stream.unsubscribe(subscriber)
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@api.route('/api/stream-stats', methods=['GET'])
+@require_session
+def stream_stats():
+    denied = admin_only()
+    if denied:
+        return denied
+    return jsonify(expense_stream.stats()), 200
+
+@api.route('/api/query-stats', methods=['GET'])
+@require_session
+def get_query_stats():
+    """Lecturas vs. filas devueltas y latencia por plan de consulta de /api/expenses."""
+    denied = admin_only()
+    if denied:
+        return denied
+    return jsonify(query_planner.stats.snapshot())
+
+@api.route('/api/expenses/<doc_id>', methods=['DELETE'])
+@require_session
 def delete_expense(doc_id):
     try:
-        db.collection(collection_name).document(doc_id).delete()
+        doc_ref = db.collection(collection_name).document(doc_id)
+        snapshot = doc_ref.get()
+        existing = snapshot.to_dict() or {}  # snapshot.get() lanza KeyError si falta el campo
+        if snapshot.exists and not g.session.is_admin and existing.get('ejecutivo') != g.session.username:
+            return jsonify({"status": "error", "message": "No autorizado"}), 403
+
+        # Borrado + tombstone en el mismo batch para que bq_import propague el delete
+        batch = db.batch()
+        batch.delete(doc_ref)
+        batch.set(db.collection(deleted_collection).document(doc_id), {
+            "eliminado_en": firestore.SERVER_TIMESTAMP,
+            # Para que /api/expenses/stream avise solo a quien puede ver el gasto
+            "ejecutivo": existing.get('ejecutivo'),
+        })
+        search_index.unindex_expense(batch, db, doc_id)
+        if snapshot.exists:
+            dedup.unindex_expense(batch, db, doc_id, existing)
+            rollups.write_deltas(batch, db, rollups.accumulate({}, existing, -1))
+        batch.commit()
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# Escaneo de recibos: trabajos en un pool propio, con cola acotada. POST devuelve
+# 202 con el id del trabajo y el navegador consulta su estado, así ningún hilo de
+# gunicorn espera a OpenCV/Vertex AI.
+SCAN_WORKERS = int(os.environ.get('SCAN_WORKERS', 2))
+SCAN_MAX_QUEUE = int(os.environ.get('SCAN_MAX_QUEUE', 8))  # escaneos en curso + en espera
+SCAN_TIMEOUT = int(os.environ.get('SCAN_TIMEOUT', 45))
+SCAN_MAX_BYTES = 15 * 1024 * 1024
+
+def run_scan(image_bytes):
+    """Preprocesa y extrae en memoria, sin escribir archivos _crop."""
+    # cv2 y vertexai se cargan recién con el primer escaneo
+    import receipt_scanner
+    with instrumentation.span("scan.preprocess", bytes=len(image_bytes)):
+        jpeg = receipt_scanner.bytes_to_jpeg(image_bytes)
+    with instrumentation.span("scan.extract", bytes=len(jpeg)):
+        return receipt_scanner.extract_from_bytes(jpeg)
+
+scan_jobs = ScanJobs(db, run_scan, workers=SCAN_WORKERS, max_queue=SCAN_MAX_QUEUE, timeout=SCAN_TIMEOUT)
+
+@api.route('/api/receipts/scan', methods=['POST'])
+@require_session
+def scan_receipt():
+    """Recibe una foto (multipart, campo 'image') y encola su lectura; el resultado se consulta por job_id."""
+    try:
+        if request.content_length and request.content_length > SCAN_MAX_BYTES:
+            return jsonify({"status": "error", "message": "Imagen demasiado grande"}), 413
+        upload = request.files.get('image')
+        if not upload:
+            return jsonify({"status": "error", "message": "Falta la imagen"}), 400
+        job_id = scan_jobs.start(upload.read(), g.session.username)
+        return jsonify({"status": "accepted", "job_id": job_id}), 202
+    except ScanQueueFull:
+        return jsonify({"status": "error", "message": "Demasiados escaneos en curso, intente de nuevo"}), 503
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api.route('/api/receipts/scan/<job_id>', methods=['GET'])
+@require_session
+def scan_receipt_status(job_id):
+    """Estado del escaneo: queued/running, success con los campos para prellenar el formulario, o error."""
+    try:
+        job = scan_jobs.get(job_id)
+        if not job or (job.get('owner') != g.session.username and not g.session.is_admin):
+            return jsonify({"status": "error", "message": "Trabajo no encontrado"}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def summary_body(dimension, buckets, session):
+    """Respuesta de /api/summary: buckets visibles para el usuario y totales del rango completo por clave."""
+    # Buckets vaciados por borrados quedan con count 0 hasta el próximo rebuild
+    buckets = [b for b in buckets if b.get('count', 0) > 0]
+    if not session.is_admin:
+        buckets = [b for b in buckets if b.get('key') == session.username]
+
+    totals = {}
+    for b in buckets:
+        t = totals.setdefault(b['key'], {"key": b['key'], "total": 0.0, "count": 0, "min": None, "max": None})
+        t['total'] += b['total']
+        t['count'] += b['count']
+        t['min'] = b['min'] if t['min'] is None else min(t['min'], b['min'])
+        t['max'] = b['max'] if t['max'] is None else max(t['max'], b['max'])
+    for item in list(buckets) + list(totals.values()):
+        item['total'] = round(item['total'], 2)
+
+    return {
+        "dimension": dimension,
+        "buckets": buckets,
+        "totals": sorted(totals.values(), key=lambda t: t['total'], reverse=True),
+    }
+
+def summary_error(dimension, session):
+    """(mensaje, código) si la consulta de resumen no es válida para el usuario, o None."""
+    if dimension not in rollups.DIMENSIONS + [rollups.TOTAL_DIMENSION]:
+        return "Dimensión inválida", 400
+    # Los no administradores solo ven sus propios totales
+    if not session.is_admin and dimension != 'ejecutivo':
+        return "No autorizado", 403
+    return None
+
+@api.route('/api/summary', methods=['GET'])
+@require_session
+def get_summary():
+    """Totales por periodo (YYYY-MM) y dimensión, servidos desde los rollups."""
+    try:
+        dimension = request.args.get('dimension', 'categoria')
+        period_from = request.args.get('from')
+        period_to = request.args.get('to')
+
+        error = summary_error(dimension, g.session)
+        if error:
+            return jsonify({"status": "error", "message": error[0]}), error[1]
+
+        buckets = rollups.summary(db, dimension, period_from, period_to)
+        return jsonify(summary_body(dimension, buckets, g.session)), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+# Métricas (formato Prometheus, por instancia) y perfilador por muestreo
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(instrumentation.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/api/profiler', methods=['GET'])
+@require_session
+def profiler_status():
+    """Estado del perfilador; ?format=collapsed devuelve las pilas para un flamegraph."""
+    denied = admin_only()
+    if denied:
+        return denied
+    if request.args.get('format') == 'collapsed':
+        return Response(instrumentation.profiler.collapsed(), mimetype='text/plain')
+    return jsonify(instrumentation.profiler.status()), 200
+
+@api.route('/api/profiler/start', methods=['POST'])
+@require_session
+def profiler_start():
+    denied = admin_only()
+    if denied:
+        return denied
+    try:
+        seconds = float(request.args.get('seconds', instrumentation.PROFILER_MAX_SECONDS))
+    except ValueError:
+        return jsonify({"status": "error", "message": "seconds inválido"}), 400
+    started = instrumentation.profiler.start(seconds)
+    return jsonify({"status": "success" if started else "already_running",
+                    **instrumentation.profiler.status()}), 200 if started else 409
+
+@api.route('/api/profiler/stop', methods=['POST'])
+@require_session
+def profiler_stop():
+    denied = admin_only()
+    if denied:
+        return denied
+    instrumentation.profiler.stop()
+    return jsonify(instrumentation.profiler.status()), 200
+
+def start_background_tasks():
+    """Tareas opcionales de arranque, en un hilo para no demorar la primera respuesta."""
+    if os.environ.get('BOOTSTRAP_ON_START') == '1':
+        import bootstrap
+        bootstrap.run()
+    if os.environ.get('REF_CACHE_WATCH') == '1':
+        # Con varias instancias de Cloud Run, un listener por colección invalida la caché en todas
+        ref_cache.watch(db, {
+            "categories": categories_collection,
+            "clients": clients_collection,
+            "users": users_collection,
+        })
+
+def create_app():
+    """
+    Crea la app Flask. No hace llamadas de red: los clientes de GCP se crean
+    con la primera petición que los usa y la carga inicial de datos es
+    bootstrap.py (o BOOTSTRAP_ON_START=1).
+    """
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    instrumentation.init_app(app)
+    if os.environ.get('BOOTSTRAP_ON_START') == '1' or os.environ.get('REF_CACHE_WATCH') == '1':
+        threading.Thread(target=start_background_tasks, name='startup', daemon=True).start()
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=True)
-
-
@@ -0,0 +1,227 @@
+"""
+ASGI serving mode: the same /api/* contract as app.py, with the read routes
+that mostly wait on Firestore served by coroutines on firestore.AsyncClient.
+
+    GET /api/expenses (without search), /api/categories, /api/clients,
+    GET /api/users, /api/summary
+
+A single process keeps many of those round trips in flight instead of one
+per gunicorn thread. The live updates stream (GET /api/expenses/stream) is
+a coroutine too, so an idle EventSource holds no thread. Every other
+request (writes, search, scans, the HTML pages) goes to the Flask app from
+app.py, run in a thread pool by a2wsgi. The async handlers reuse app.py's parameter parsing, reference
+cache and JSON encoding and query_planner's plans and stats, so both modes
+answer the same bodies, status codes and ETags.
+
+Usage:
+    uvicorn asgi:app --host 0.0.0.0 --port 8080
+"""
+import os
+import time
+import queue
+import asyncio
+from urllib.parse import parse_qs
+from a2wsgi import WSGIMiddleware
+
+import app as web
+import instrumentation
+import query_planner
+import rollups
+import sessions
+from expense_stream import format_event
+from gcp_clients import get_firestore_async
+
+# Threads for the routes handled by Flask (like gunicorn --threads)
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 8))
+# Live update streams per process; here they cost a queue each, not a thread
+SSE_MAX_CLIENTS = int(os.environ.get('ASGI_SSE_MAX_CLIENTS', 200))
+
+wsgi = WSGIMiddleware(web.app, workers=WSGI_THREADS)
+
+
+class Request:
+    """The parts of an ASGI request the handlers read."""
+
+    def __init__(self, scope):
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True)
+        self.args = {key: values[0] for key, values in query.items()}  # first value, like request.args.get
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers', [])}
+
+
+def json_response(value, status=200, headers=()):
+    """(status, body, headers) encoded like flask.jsonify."""
+    body = (web.app.json.dumps(value, separators=(",", ":")) + "\n").encode('utf-8')
+    return status, body, [(b'content-type', b'application/json')] + list(headers)
+
+
+def error_response(message, status):
+    return json_response({"status": "error", "message": message}, status)
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or f'"{etag}"' in tags
+
+
+def request_session(request):
+    """app.current_session() for the async routes (Bearer token only)."""
+    return sessions.verify(sessions.token_from(request.headers.get('authorization')))
+
+
+async def cached_list(request, key, loader):
+    """app.cached_list_response(): shared cache, ETag and 304."""
+    value, etag = await web.ref_cache.aget(key, loader)
+    headers = [(b'etag', f'"{etag}"'.encode('ascii')), (b'cache-control', b'no-cache')]
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return 304, b'', headers
+    return json_response(value, headers=headers)
+
+
+# Loaders: same results as app.load_categories / load_clients / load_users
+
+async def load_categories():
+    docs = get_firestore_async().collection(web.categories_collection).stream()
+    names = [doc.to_dict().get('name') async for doc in docs]
+    return sorted(name for name in names if name)
+
+
+async def load_clients():
+    docs = get_firestore_async().collection(web.clients_collection).stream()
+    client_list = []
+    async for doc in docs:
+        data = doc.to_dict()
+        name = data.get('company_name') or data.get('name')
+        if name:
+            client_list.append(name)
+    return sorted(client_list)
+
+
+async def load_users():
+    return [doc.id async for doc in get_firestore_async().collection(web.users_collection).stream()]
+
+
+async def get_categories(request):
+    return await cached_list(request, "categories", load_categories)
+
+
+async def get_clients(request):
+    return await cached_list(request, "clients", load_clients)
+
+
+async def get_users(request):
+    session = request_session(request)
+    if session is None:
+        return error_response(web.UNAUTHORIZED, 401)
+    if not session.is_admin:
+        return error_response("No autorizado", 403)
+    return await cached_list(request, "users", load_users)
+
+
+async def get_expenses(request):
+    if request.args.get('search', '').strip():
+        return None  # text search stays on the Flask route (search_index is synchronous)
+    session = request_session(request)
+    if session is None:
+        return error_response(web.UNAUTHORIZED, 401)
+    try:
+        page_size, cursor = web.page_params(request.args)
+    except ValueError:
+        return error_response("Parámetros de paginación inválidos", 400)
+    items, next_cursor = await query_planner.execute_async(
+        get_firestore_async(), web.expense_filters(request.args, session), page_size, cursor, web.collection_name)
+    return json_response({"items": items, "next_cursor": web.encode_cursor(*next_cursor) if next_cursor else None})
+
+
+async def get_summary(request):
+    session = request_session(request)
+    if session is None:
+        return error_response(web.UNAUTHORIZED, 401)
+    dimension = request.args.get('dimension', 'categoria')
+    error = web.summary_error(dimension, session)
+    if error:
+        return error_response(*error)
+    query = rollups.summary_query(get_firestore_async(), dimension, request.args.get('from'), request.args.get('to'))
+    buckets = [doc.to_dict() async for doc in query.stream()]
+    return json_response(web.summary_body(dimension, buckets, session))
+
+
+async def stream_expenses(scope, receive, send):
+    """app.stream_expenses() as a coroutine: waits for events without holding a thread."""
+    request = Request(scope)
+    # EventSource cannot send headers: the token comes as ?token=
+    session = sessions.verify(sessions.token_from(request.headers.get('authorization'), request.args.get('token')))
+    if session is None:
+        return error_response(web.UNAUTHORIZED, 401)
+    subscriber = web.expense_stream.subscribe(None if session.is_admin else session.username,
+                                              loop=asyncio.get_running_loop(), max_subscribers=SSE_MAX_CLIENTS)
+    if subscriber is None:
+        return error_response("Demasiadas conexiones en vivo", 503)
+
+    async def wait_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    disconnected = asyncio.ensure_future(wait_disconnect())
+    try:
+        await send({"type": "http.response.start", "status": 200, "headers": [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+        await send({"type": "http.response.body", "body": b"retry: 3000\n\n", "more_body": True})
+        deadline = time.monotonic() + web.SSE_MAX_SECONDS
+        while time.monotonic() < deadline and not disconnected.done():
+            try:
+                kind, payload = await subscriber.next_event_async(timeout=web.SSE_HEARTBEAT)
+                chunk = format_event(kind, payload)
+            except queue.Empty:
+                chunk = ": ping\n\n"
+            await send({"type": "http.response.body", "body": chunk.encode('utf-8'), "more_body": True})
+        if not disconnected.done():
+            await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnected.cancel()
+        web.expense_stream.unsubscribe(subscriber)
+
+
+ROUTES = {
+    ('GET', '/api/expenses'): get_expenses,
+    ('GET', '/api/categories'): get_categories,
+    ('GET', '/api/clients'): get_clients,
+    ('GET', '/api/users'): get_users,
+    ('GET', '/api/summary'): get_summary,
+}
+# Handlers that send their own (streaming) response; they return one only on errors
+STREAMS = {
+    ('GET', '/api/expenses/stream'): stream_expenses,
+}
+
+
+async def app(scope, receive, send):
+    route = (scope.get('method'), scope.get('path')) if scope['type'] == 'http' else None
+    handler = ROUTES.get(route)
+    stream = STREAMS.get(route)
+    response = None
+    started = time.perf_counter()
+    if stream:
+        response = await stream(scope, receive, send)
+        if response is None:
+            return
+    elif handler:
+        try:
+            response = await handler(Request(scope))
+        except Exception as e:
+            instrumentation.log_exception(scope['path'])
+            response = error_response(str(e), 500)
+    if response is None:
+        # Any other route (and lifespan events) go to the Flask app, which instruments itself
+        await wsgi(scope, receive, send)
+        return
+
+    status, body, headers = response
+    # Latency only: reads made through the AsyncClient are not counted
+    instrumentation.request_seconds.observe(time.perf_counter() - started, scope['method'], scope['path'], status)
+    await send({"type": "http.response.start", "status": status,
+                "headers": headers + [(b'content-length', str(len(body)).encode('ascii'))]})
+    await send({"type": "http.response.body", "body": body})
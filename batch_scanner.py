@@ -0,0 +1,434 @@
+"""
+Batch mode for receipt_scanner: scans a directory, glob or manifest of
+receipt photos and streams the extracted data to a JSONL file.
+
+OpenCV preprocessing is CPU-bound, so it runs in a process pool. Receipts
+already in the extraction cache skip the model; the rest go through
+generate_content_async with a concurrency limit, a token bucket rate limit
+and exponential backoff on quota errors. With --pack N, up to N receipts
+share one request with a schema-enforced JSON reply, and receipts whose
+date or amount fail validation are re-asked. --vertex-batch submits the
+whole backlog as a Vertex AI batch prediction job instead.
+
+Usage:
+    python batch_scanner.py <dir|glob|manifest> [--out results.jsonl]
+        [--concurrency 8] [--rate 5] [--workers N] [--retries 5] [--pack N]
+        [--vertex-batch gs://bucket/prefix] [--stub]
+"""
+import os
+import sys
+import glob
+import json
+import time
+import random
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from google.api_core import exceptions as google_exceptions
+
+import receipt_scanner
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+# Errors worth retrying: quota / rate limit and transient unavailability
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+)
+BACKOFF_BASE = 1.0  # seconds, doubled on every retry
+BACKOFF_MAX = 60.0
+PACK_WAIT = 0.5  # seconds a partial pack waits for more receipts before being sent
+VERTEX_BATCH_POLL = 30  # seconds between batch prediction job status checks
+
+
+def collect_paths(source):
+    """
+    Image paths from a directory, a glob pattern, or a manifest file
+    (.txt with one path per line, or .jsonl with {"path": ...} per line).
+    """
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in sorted(os.listdir(source))]
+    elif os.path.isfile(source) and source.endswith(('.txt', '.jsonl')):
+        base = os.path.dirname(source)
+        paths = []
+        with open(source) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                path = json.loads(line)['path'] if source.endswith('.jsonl') else line
+                paths.append(path if os.path.isabs(path) else os.path.join(base, path))
+    else:
+        paths = sorted(glob.glob(source, recursive=True))
+
+    # Skip the _crop files written by the single-image CLI
+    return [p for p in paths
+            if p.lower().endswith(IMAGE_EXTENSIONS) and not os.path.splitext(p)[0].endswith('_crop')]
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class StubModel:
+    """
+    Offline stand-in for GenerativeModel, for benchmarking the pipeline
+    without Vertex AI. Sleeps a simulated latency and can fail with quota
+    errors to exercise the retry path. Packed requests (build_batch_contents)
+    get a JSON array reply; `invalid_rate` of those receipts come back with
+    an unreadable date to exercise the re-ask path.
+    """
+
+    def __init__(self, latency=0.8, jitter=0.3, error_rate=0.0, invalid_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.invalid_rate = invalid_rate
+        self.requests = 0
+
+    def _receipt(self):
+        return {
+            "establishment": "Stub Store",
+            "date": time.strftime("%Y-%m-%d"),
+            "amount": round(random.uniform(5, 500), 2),
+        }
+
+    def _reply(self, contents):
+        self.requests += 1
+        if random.random() < self.error_rate:
+            raise google_exceptions.ResourceExhausted("Stub quota exceeded")
+        prompt = contents[-1]
+        if not prompt.startswith(receipt_scanner.BATCH_PROMPT):
+            return StubResponse(json.dumps(self._receipt()))
+
+        reply = []
+        for label in contents[:-1:2]:
+            receipt = dict(self._receipt(), index=int(label[len("Receipt "):-1]))
+            if random.random() < self.invalid_rate:
+                receipt["date"] = None
+            reply.append(receipt)
+        return StubResponse(json.dumps(reply))
+
+    async def generate_content_async(self, contents, **kwargs):
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        return self._reply(contents)
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        return self._reply(contents)
+
+
+class StageStats:
+    """Count, busy time and wall-clock span for one pipeline stage."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.first = None
+        self.last = None
+
+    def record(self, started, ended, ok=True):
+        self.count += 1
+        self.errors += 0 if ok else 1
+        self.busy += ended - started
+        self.first = started if self.first is None else min(self.first, started)
+        self.last = ended if self.last is None else max(self.last, ended)
+
+    def summary(self):
+        span = (self.last - self.first) if self.count else 0.0
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_latency_s": round(self.busy / self.count, 3) if self.count else 0.0,
+            "throughput_per_s": round(self.count / span, 2) if span else 0.0,
+        }
+
+
+async def generate_with_retry(model, contents, limiter, max_retries, **kwargs):
+    """Returns (response, retries). Raises after max_retries quota errors."""
+    retries = 0
+    while True:
+        await limiter.acquire()
+        try:
+            return await model.generate_content_async(contents, **kwargs), retries
+        except RETRYABLE_ERRORS:
+            if retries >= max_retries:
+                raise
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** retries)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))  # jitter
+            retries += 1
+
+
+async def extract_with_retry(model, image_bytes, limiter, max_retries):
+    """Returns (data, retries). Raises after max_retries quota errors."""
+    response, retries = await generate_with_retry(
+        model, receipt_scanner.build_contents(image_bytes), limiter, max_retries)
+    return receipt_scanner.parse_response(response.text), retries
+
+
+async def extract_packed_with_retry(model, images, limiter, max_retries, max_reasks=receipt_scanner.MAX_REASKS):
+    """
+    Async counterpart of receipt_scanner.extract_batch for one pack of images.
+    Returns ({position: {"data", "errors"}}, retries, requests).
+    """
+    results = {i: {"data": None, "errors": []} for i in range(len(images))}
+    labels = list(results)
+    problems = {}
+    retries = requests = 0
+    for _ in range(max_reasks + 1):
+        contents = receipt_scanner.build_batch_contents([images[i] for i in labels], labels, problems)
+        response, attempt_retries = await generate_with_retry(
+            model, contents, limiter, max_retries,
+            generation_config=receipt_scanner.batch_generation_config())
+        retries += attempt_retries
+        requests += 1
+        answers = receipt_scanner.parse_batch_response(response.text, labels)
+        labels, problems = receipt_scanner.check_batch_answers(answers, labels, results)
+        if not labels:
+            break
+    return results, retries, requests
+
+
+async def run_batch(paths, out_path, model, concurrency=8, rate=5.0, workers=None, max_retries=5, pack=1):
+    """Scans every path and appends one JSON line per receipt to out_path as results finish."""
+    loop = asyncio.get_running_loop()
+    limiter = TokenBucket(rate)
+    model_slots = asyncio.Semaphore(concurrency)
+    # Bounds how many preprocessed images wait in memory for a model slot
+    inflight = asyncio.Semaphore(concurrency * 4)
+    stages = {"preprocess": StageStats(), "model": StageStats()}
+    retries_total = 0
+    cache_hits = 0
+    requests_total = 0
+    invalid = 0
+    cache = receipt_scanner.get_cache()
+    # Packed mode: handle() queues (image, future) and packer() tasks send up to `pack` per request
+    packing = asyncio.Queue()
+    started = time.perf_counter()
+
+    async def packer():
+        nonlocal retries_total, requests_total
+        while True:
+            group = [await packing.get()]
+            deadline = loop.time() + PACK_WAIT
+            while len(group) < pack:
+                try:
+                    group.append(await asyncio.wait_for(packing.get(), max(0.0, deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            t1 = time.perf_counter()
+            try:
+                results, retries, requests = await extract_packed_with_retry(
+                    model, [image_bytes for image_bytes, _ in group], limiter, max_retries)
+                retries_total += retries
+                requests_total += requests
+                stages["model"].record(t1, time.perf_counter())
+                for i, (_, future) in enumerate(group):
+                    future.set_result(results[i])
+            except Exception as e:
+                stages["model"].record(t1, time.perf_counter(), ok=False)
+                for _, future in group:
+                    future.set_exception(e)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(out_path, 'a') as out:
+        async def handle(path):
+            nonlocal retries_total, cache_hits, requests_total, invalid
+            async with inflight:
+                record = {"path": path}
+                t0 = time.perf_counter()
+                try:
+                    image_bytes = await loop.run_in_executor(pool, receipt_scanner.preprocess_to_jpeg, path)
+                    stages["preprocess"].record(t0, time.perf_counter())
+                except Exception as e:
+                    stages["preprocess"].record(t0, time.perf_counter(), ok=False)
+                    record["error"] = f"preprocess: {e}"
+                else:
+                    lookup = cache.lookup(image_bytes, receipt_scanner.MODEL_ID,
+                                          receipt_scanner.PROMPT_VERSION) if cache else None
+                    if lookup and lookup["similar"]:
+                        record["duplicate_of"] = dict(lookup["similar"]["data"],
+                                                      distance=lookup["similar"]["distance"])
+                    if lookup and lookup["data"] is not None:
+                        record["data"] = lookup["data"]
+                        record["cached"] = True
+                        cache_hits += 1
+                    elif pack > 1:
+                        future = loop.create_future()
+                        await packing.put((image_bytes, future))
+                        try:
+                            result = await future
+                            record["data"] = result["data"]
+                            if result["errors"]:
+                                record["invalid"] = result["errors"]
+                                invalid += 1
+                            elif lookup:
+                                cache.store(lookup, record["data"])
+                        except Exception as e:
+                            record["error"] = f"model: {e}"
+                    else:
+                        async with model_slots:
+                            t1 = time.perf_counter()
+                            try:
+                                record["data"], record["retries"] = await extract_with_retry(
+                                    model, image_bytes, limiter, max_retries)
+                                retries_total += record["retries"]
+                                requests_total += 1
+                                stages["model"].record(t1, time.perf_counter())
+                                if lookup:
+                                    cache.store(lookup, record["data"])
+                            except Exception as e:
+                                stages["model"].record(t1, time.perf_counter(), ok=False)
+                                record["error"] = f"model: {e}"
+                record["seconds"] = round(time.perf_counter() - t0, 3)
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+
+        packers = [asyncio.create_task(packer()) for _ in range(concurrency if pack > 1 else 0)]
+        await asyncio.gather(*(handle(p) for p in paths))
+        for task in packers:
+            task.cancel()
+
+    wall = time.perf_counter() - started
+    return {
+        "images": len(paths),
+        "wall_s": round(wall, 2),
+        "images_per_s": round(len(paths) / wall, 2) if wall else 0.0,
+        "retries": retries_total,
+        "cache_hits": cache_hits,
+        "model_requests": requests_total,
+        "invalid": invalid,
+        "stages": {name: stats.summary() for name, stats in stages.items()},
+    }
+
+
+def run_vertex_batch(paths, out_path, gcs_prefix, pack=receipt_scanner.BATCH_SIZE, workers=None, model=None):
+    """
+    Submits the receipts as a Vertex AI batch prediction job (packed like
+    extract_batch, `pack` receipts per request) and writes the results to
+    out_path when it finishes. Receipts that fail validation get one online
+    re-ask through extract_batch. For large backlogs where latency does not
+    matter: batch prediction is billed at a lower rate than online calls.
+    """
+    from google.cloud import storage
+    from vertexai.batch_prediction import BatchPredictionJob
+
+    images, records = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {i: pool.submit(receipt_scanner.preprocess_to_jpeg, path) for i, path in enumerate(paths)}
+        for i, future in futures.items():
+            records[i] = {"path": paths[i]}
+            try:
+                images[i] = future.result()
+            except Exception as e:
+                records[i]["error"] = f"preprocess: {e}"
+
+    bucket_name, _, prefix = gcs_prefix[len("gs://"):].partition("/")
+    prefix = prefix.rstrip("/")
+    labels = sorted(images)
+    blob = storage.Client(project=receipt_scanner.PROJECT_ID).bucket(bucket_name).blob(f"{prefix}/input.jsonl")
+    with blob.open("w") as f:
+        for start in range(0, len(labels), pack):
+            chunk = labels[start:start + pack]
+            f.write(receipt_scanner.batch_prediction_line([images[i] for i in chunk], chunk) + "\n")
+
+    receipt_scanner.get_model()  # vertexai.init
+    job = BatchPredictionJob.submit(
+        source_model=receipt_scanner.MODEL_ID,
+        input_dataset=f"gs://{bucket_name}/{prefix}/input.jsonl",
+        output_uri_prefix=f"gs://{bucket_name}/{prefix}/output")
+    print(f"Submitted batch prediction job {job.resource_name}")
+    while not job.has_ended:
+        time.sleep(VERTEX_BATCH_POLL)
+        job.refresh()
+    if not job.has_succeeded:
+        raise RuntimeError(f"Batch prediction job failed: {job.error}")
+
+    results = {i: {"data": None, "errors": ["missing from the output"]} for i in labels}
+    out_bucket, _, out_prefix = job.output_location[len("gs://"):].partition("/")
+    for output in storage.Client(project=receipt_scanner.PROJECT_ID).list_blobs(out_bucket, prefix=out_prefix):
+        if not output.name.endswith(".jsonl"):
+            continue
+        for line in output.download_as_text().splitlines():
+            answers = receipt_scanner.batch_prediction_answers(line)
+            receipt_scanner.check_batch_answers(answers, list(answers), results)
+
+    failed = [i for i in labels if results[i]["errors"]]
+    if failed:
+        print(f"Re-asking {len(failed)} receipts online...")
+        for i, result in zip(failed, receipt_scanner.extract_batch([images[i] for i in failed], model)):
+            results[i] = result
+
+    with open(out_path, 'a') as out:
+        for i, record in records.items():
+            if i in results:
+                record["data"] = results[i]["data"]
+                if results[i]["errors"]:
+                    record["invalid"] = results[i]["errors"]
+            out.write(json.dumps(record) + "\n")
+    return {"images": len(paths), "requests": -(-len(labels) // pack), "reasked": len(failed),
+            "invalid": sum(1 for i in labels if results[i]["errors"])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch receipt scanning")
+    parser.add_argument("source", help="Directory, glob pattern or manifest (.txt/.jsonl)")
+    parser.add_argument("--out", default="results.jsonl")
+    parser.add_argument("--concurrency", type=int, default=8, help="Max concurrent model calls")
+    parser.add_argument("--rate", type=float, default=5.0, help="Max model calls per second")
+    parser.add_argument("--workers", type=int, default=None, help="Preprocessing processes (default: CPU count)")
+    parser.add_argument("--retries", type=int, default=5, help="Max retries on quota errors")
+    parser.add_argument("--pack", type=int, default=1, help="Receipts per model request (schema-enforced JSON)")
+    parser.add_argument("--vertex-batch", metavar="GS_PREFIX",
+                        help="Submit as a Vertex AI batch prediction job, staging files under this gs:// prefix")
+    parser.add_argument("--stub", action="store_true", help="Use the offline stub model")
+    parser.add_argument("--stub-latency", type=float, default=0.8)
+    parser.add_argument("--stub-error-rate", type=float, default=0.0)
+    parser.add_argument("--stub-invalid-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    paths = collect_paths(args.source)
+    if not paths:
+        print(f"No images found in {args.source}")
+        sys.exit(1)
+
+    if args.stub:
+        model = StubModel(latency=args.stub_latency, error_rate=args.stub_error_rate,
+                          invalid_rate=args.stub_invalid_rate)
+    else:
+        model = receipt_scanner.get_model()
+
+    print(f"Scanning {len(paths)} images -> {args.out}")
+    if args.vertex_batch:
+        stats = run_vertex_batch(paths, args.out, args.vertex_batch, args.pack if args.pack > 1 else receipt_scanner.BATCH_SIZE,
+                                 args.workers, model)
+    else:
+        stats = asyncio.run(run_batch(paths, args.out, model, args.concurrency, args.rate,
+                                      args.workers, args.retries, args.pack))
+    print(json.dumps(stats, indent=4))
+
+if __name__ == "__main__":
+    main()
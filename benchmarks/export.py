@@ -0,0 +1,131 @@
+"""
+Export throughput for GET /api/expenses/export against the Firestore
+emulator, at growing row counts (default 10k, 100k and 1M).
+
+The rows are written straight to the emulator with BulkWriter as
+expenses of one ejecutivo (--ejecutivo, default "bench-export"). A token for
+that user scopes the export to them, so other data in the emulator does not
+count. Each size is seeded on top of the previous one (ids are
+deterministic, so reruns overwrite the same rows). Every format is then exported
+through the Flask app in-process, reading the streamed body chunk by chunk
+as a client would. The report has rows/sec, bytes out and RSS growth (the
+memory the export added to the process, which should stay flat as rows
+grow).
+
+Usage (from the repo root):
+    export FIRESTORE_EMULATOR_HOST=localhost:8085
+    python -m benchmarks.export [--sizes 10000,100000,1000000] [--formats csv,xlsx,parquet] [--gzip] [--json out.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+
+
+class RssSampler:
+    """Peak resident memory while running, sampled from /proc every 20 ms."""
+
+    def __init__(self):
+        self.peak = self.start = self.current()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current():
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def _run(self):
+        while not self._stop.wait(0.02):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def seed(db, collection, ejecutivo, start, stop):
+    rng = random.Random(start)
+    writer = db.bulk_writer()
+    for n in range(start, stop):
+        writer.set(db.collection(collection).document(f"{ejecutivo}-{n:07d}"), {
+            "ejecutivo": ejecutivo,
+            "fecha": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "categoria": rng.choice(["Auto-Gasolina", "Gasto-Rep-Comida", "Viajes-Misc"]),
+            "cliente": f"Cliente-{rng.randint(1, 40)}",
+            "establecimiento": f"Comercio {rng.randint(1, 500)}",
+            "descripcion": "Gasto de prueba",
+            "monto": round(rng.uniform(5, 500), 2),
+            "moneda": "PEN",
+        })
+    writer.close()
+
+
+def export(client, token, fmt, compress):
+    path = f"/api/expenses/export?format={fmt}" + ("&gzip=1" if compress else "")
+    started = time.perf_counter()
+    with RssSampler() as rss:
+        response = client.get(path, headers={"Authorization": f"Bearer {token}"})
+        size = 0
+        for chunk in response.response:
+            size += len(chunk)
+        response.close()
+    elapsed = time.perf_counter() - started
+    if response.status_code != 200:
+        raise RuntimeError(f"{path}: {response.status_code}")
+    return elapsed, size, rss.peak - rss.start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export throughput benchmark")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--formats", default="csv,xlsx,parquet")
+    parser.add_argument("--gzip", action="store_true", help="Also measure every format gzipped")
+    parser.add_argument("--ejecutivo", default="bench-export")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("Set FIRESTORE_EMULATOR_HOST: this benchmark writes up to --sizes rows")
+
+    import app
+    import sessions
+    from gcp_clients import get_firestore
+
+    db = get_firestore()
+    client = app.app.test_client()
+    token = sessions.issue(args.ejecutivo, "user")
+    results = []
+    seeded = 0
+    for size in sorted(int(s) for s in args.sizes.split(",")):
+        started = time.perf_counter()
+        seed(db, app.collection_name, args.ejecutivo, seeded, size)
+        print(f"Seeded {size} rows ({time.perf_counter() - started:.1f}s)", file=sys.stderr)
+        seeded = size
+        for fmt in args.formats.split(","):
+            for compress in ([False, True] if args.gzip else [False]):
+                elapsed, size_bytes, rss_growth = export(client, token, fmt, compress)
+                results.append({
+                    "rows": size, "format": fmt, "gzip": compress,
+                    "seconds": round(elapsed, 2),
+                    "rows_per_s": round(size / elapsed),
+                    "mb_out": round(size_bytes / 1e6, 2),
+                    "rss_growth_mb": round(rss_growth / 1e6, 1),
+                })
+                print(json.dumps(results[-1]), file=sys.stderr)
+
+    print(json.dumps(results, indent=4))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
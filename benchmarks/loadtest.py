@@ -0,0 +1,208 @@
+"""
+Load test for the two serving modes against the Firestore emulator:
+sync (gunicorn, app:app, 1 worker x 8 threads as in the Dockerfile) and
+async (uvicorn, asgi:app). Each mode is started in turn on a local port,
+then every route is driven by --concurrency clients for --duration seconds
+over keep-alive connections; the report has requests/sec and p50/p99
+latency per route and mode.
+
+--seed N first creates the reference data (bootstrap.py) and N expenses
+through POST /api/expenses/batch, so the emulator has something to page
+through. --sync-url / --async-url test servers that are already running
+instead of starting them. Requests are sent with the session token of
+--user (default: the admin account created by bootstrap.py).
+
+Usage (from the repo root, with the emulator running):
+    export FIRESTORE_EMULATOR_HOST=localhost:8085
+    python -m benchmarks.loadtest --seed 2000 [--concurrency 32] [--duration 15] [--json out.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+import subprocess
+import http.client
+import urllib.request
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+PATHS = [
+    "/api/expenses?page_size=50",
+    "/api/expenses?category=Auto-Gasolina&page_size=50",
+    "/api/expenses?client=Cliente-1&page_size=50",
+    "/api/categories",
+    "/api/clients",
+    "/api/summary?dimension=categoria",
+]
+
+SERVERS = {
+    "sync": ["gunicorn", "--bind", "127.0.0.1:{port}", "--workers", "1", "--threads", "8", "--timeout", "0", "app:app"],
+    "async": ["uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", "{port}", "--no-access-log"],
+}
+
+
+def get_json(base_url, path):
+    with urllib.request.urlopen(base_url + path, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def login(base_url, username, password):
+    request = urllib.request.Request(
+        base_url + "/api/login", method="POST",
+        data=json.dumps({"username": username, "password": password}).encode("utf-8"),
+        headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())["token"]
+
+
+def seed(base_url, count, token):
+    """`count` expenses spread over 3 users, a year and every category/client."""
+    categories = get_json(base_url, "/api/categories")
+    clients = get_json(base_url, "/api/clients")
+    rng = random.Random(42)
+    rows = [{
+        "id": f"loadtest-{n}",
+        "ejecutivo": f"Ejecutivo-{n % 3 + 1}",
+        "fecha": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        "categoria": rng.choice(categories),
+        "cliente": rng.choice(clients),
+        "establecimiento": f"Comercio {rng.randint(1, 200)}",
+        "monto": round(rng.uniform(5, 500), 2),
+    } for n in range(count)]
+    for start in range(0, len(rows), 500):
+        request = urllib.request.Request(
+            base_url + "/api/expenses/batch", method="POST",
+            data=json.dumps(rows[start:start + 500]).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {token}"})
+        with urllib.request.urlopen(request, timeout=120) as response:
+            response.read()
+    print(f"Seeded {count} expenses")
+
+
+def start_server(mode, port):
+    command = [part.format(port=port) for part in SERVERS[mode]]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{mode} server exited with {process.returncode}: {' '.join(command)}")
+        try:
+            get_json(base_url, "/api/categories")
+            return process, base_url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{mode} server did not answer on {base_url}")
+
+
+def client_loop(base_url, path, until, headers, method="GET", body=None):
+    """One client: sequential requests on a keep-alive connection. Returns (latencies, errors)."""
+    url = urlsplit(base_url)
+    connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+    latencies = []
+    errors = 0
+    while time.perf_counter() < until:
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+    connection.close()
+    return latencies, errors
+
+
+def drive(base_url, path, concurrency, duration, token, method="GET", body=None):
+    """body (bytes) is sent as JSON with every request."""
+    headers = {"Authorization": f"Bearer {token}"}
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+    # Warm-up request: client creation and caches are not what is being measured
+    warm_up = urllib.request.Request(base_url + path, data=body, method=method, headers=headers)
+    with urllib.request.urlopen(warm_up, timeout=30) as response:
+        response.read()
+    started = time.perf_counter()
+    until = started + duration
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: client_loop(base_url, path, until, headers, method, body),
+                                range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for latency_list, _ in results for latency in latency_list)
+    errors = sum(error_count for _, error_count in results)
+    if not latencies:
+        return {"requests": 0, "errors": errors}
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(1000 * statistics.median(latencies), 1),
+        "p99_ms": round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync vs async serving load test")
+    parser.add_argument("--modes", default="sync,async")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15, help="Seconds per route and mode")
+    parser.add_argument("--seed", type=int, default=0, help="Expenses to create before the test")
+    parser.add_argument("--path", action="append", help="Route to test (repeatable); default: PATHS")
+    parser.add_argument("--sync-url", help="Use this running server for the sync mode")
+    parser.add_argument("--async-url", help="Use this running server for the async mode")
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="admin123")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    modes = args.modes.split(",")
+    urls = {"sync": args.sync_url, "async": args.async_url}
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST") and not all(urls[mode] for mode in modes):
+        sys.exit("Set FIRESTORE_EMULATOR_HOST: the servers started here would use the real database")
+
+    results = {"concurrency": args.concurrency, "duration_s": args.duration, "modes": {}}
+    for index, mode in enumerate(modes):
+        process = None
+        base_url = urls[mode]
+        if not base_url:
+            process, base_url = start_server(mode, args.port + index)
+        try:
+            if args.seed and index == 0:
+                # Reference data and the admin user first: the seed rows and the login need them
+                subprocess.run([sys.executable, "bootstrap.py"], check=True, capture_output=True)
+                token = login(base_url, args.user, args.password)
+                seed(base_url, args.seed, token)
+            else:
+                token = login(base_url, args.user, args.password)
+            results["modes"][mode] = {
+                path: drive(base_url, path, args.concurrency, args.duration, token) for path in args.path or PATHS}
+        finally:
+            if process:
+                process.terminate()
+                process.wait(timeout=30)
+
+    if {"sync", "async"} <= results["modes"].keys():
+        results["async_vs_sync_rps"] = {
+            path: round(results["modes"]["async"][path]["rps"] / results["modes"]["sync"][path]["rps"], 2)
+            for path in results["modes"]["sync"]
+            if results["modes"]["sync"][path].get("rps") and results["modes"]["async"][path].get("rps")}
+
+    print(json.dumps(results, indent=4))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
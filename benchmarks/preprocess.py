@@ -0,0 +1,150 @@
+"""
+Compares the original (full resolution, PIL) and fast (downscaled
+detection, perspective warp, direct JPEG) receipt preprocessing paths.
+
+For every image in the fixture directory it measures latency, peak memory
+and the size of the JPEG sent to the model. Peak memory is how far a fresh
+process's peak RSS (VmHWM, so Linux only) rises while preprocessing one
+image: the OpenCV and numpy buffers count (tracemalloc only sees the
+Python heap) and memory freed by earlier runs cannot hide it.
+
+If the directory has an expected.json
+({"<file name>": {"establishment", "date", "amount"}}) and
+--extract is given, both outputs also go through the model and the
+extracted fields are compared against it.
+
+Usage (from the repo root):
+    python -m benchmarks.preprocess <fixtures_dir> [--repeat 3] [--extract] [--json out.json]
+"""
+import os
+import json
+import time
+import argparse
+import statistics
+import multiprocessing
+
+import receipt_scanner
+from batch_scanner import collect_paths
+
+PATHS = {"original": False, "fast": True}
+
+
+def vm_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise ValueError(field)
+
+
+def peak_growth(path, fast):
+    """Bytes the peak RSS (VmHWM) of this process rises by while preprocessing `path`."""
+    # Resets VmHWM to the current RSS, dropping the peak left by the imports
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    before = vm_kb("VmHWM")
+    receipt_scanner.preprocess_to_jpeg(path, fast=fast)
+    return (vm_kb("VmHWM") - before) * 1024
+
+
+def measure(path, fast, repeat):
+    """(median seconds, peak RSS growth in bytes, JPEG bytes) of one preprocessing path."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        image_bytes = receipt_scanner.preprocess_to_jpeg(path, fast=fast)
+        timings.append(time.perf_counter() - started)
+
+    # Memory in a new process: in this one the buffers of the timed runs are
+    # still resident and would be reused
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        peak = pool.apply(peak_growth, (path, fast))
+    return statistics.median(timings), peak, image_bytes
+
+
+def fields_match(data, expected):
+    """Which expected fields the extraction got right (amount within 1 cent, text case-insensitive)."""
+    result = {}
+    for field, value in expected.items():
+        got = (data or {}).get(field)
+        if field == "amount":
+            try:
+                result[field] = abs(float(got) - float(value)) < 0.01
+            except (TypeError, ValueError):
+                result[field] = False
+        else:
+            result[field] = str(got or "").strip().lower() == str(value).strip().lower()
+    return result
+
+
+def run(fixtures, repeat=3, extract=False):
+    paths = collect_paths(fixtures)
+    expected_path = os.path.join(fixtures, "expected.json")
+    expected = {}
+    if extract and os.path.exists(expected_path):
+        with open(expected_path) as f:
+            expected = json.load(f)
+    model = receipt_scanner.get_model() if expected else None
+
+    per_image = []
+    totals = {name: {"seconds": [], "peak_bytes": [], "jpeg_bytes": [], "correct": 0, "checked": 0}
+              for name in PATHS}
+    for path in paths:
+        row = {"image": os.path.basename(path)}
+        for name, fast in PATHS.items():
+            seconds, peak, image_bytes = measure(path, fast, repeat)
+            row[name] = {"seconds": round(seconds, 4), "peak_mb": round(peak / 1e6, 1),
+                         "jpeg_kb": round(len(image_bytes) / 1024, 1)}
+            totals[name]["seconds"].append(seconds)
+            totals[name]["peak_bytes"].append(peak)
+            totals[name]["jpeg_bytes"].append(len(image_bytes))
+
+            wanted = expected.get(row["image"])
+            if wanted:
+                # The cache would hide model differences between the two paths
+                response = model.generate_content(receipt_scanner.build_contents(image_bytes))
+                try:
+                    data = receipt_scanner.parse_response(response.text)
+                except ValueError:
+                    data = None
+                matches = fields_match(data, wanted)
+                row[name]["fields"] = matches
+                totals[name]["correct"] += sum(matches.values())
+                totals[name]["checked"] += len(matches)
+        per_image.append(row)
+        print(json.dumps(row))
+
+    summary = {}
+    for name, t in totals.items():
+        if not t["seconds"]:
+            continue
+        summary[name] = {
+            "median_seconds": round(statistics.median(t["seconds"]), 4),
+            "max_seconds": round(max(t["seconds"]), 4),
+            "median_peak_mb": round(statistics.median(t["peak_bytes"]) / 1e6, 1),
+            "max_peak_mb": round(max(t["peak_bytes"]) / 1e6, 1),
+            "median_jpeg_kb": round(statistics.median(t["jpeg_bytes"]) / 1024, 1),
+            "field_accuracy": round(t["correct"] / t["checked"], 3) if t["checked"] else None,
+        }
+    if len(summary) == 2 and summary["fast"]["median_seconds"]:
+        summary["speedup"] = round(summary["original"]["median_seconds"] / summary["fast"]["median_seconds"], 2)
+    return {"images": len(paths), "repeat": repeat, "summary": summary, "per_image": per_image}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receipt preprocessing benchmark")
+    parser.add_argument("fixtures", help="Directory of receipt photos (optionally with expected.json)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per image and path")
+    parser.add_argument("--extract", action="store_true", help="Also compare extraction accuracy (calls Vertex AI)")
+    parser.add_argument("--json", help="Write the full results to this file")
+    args = parser.parse_args()
+
+    results = run(args.fixtures, args.repeat, args.extract)
+    print(json.dumps(results["summary"], indent=4))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Cold start benchmark for the web app: time to import `app` and time to
+answer the first request, each measured in a fresh interpreter (like a new
+Cloud Run instance or gunicorn worker).
+
+--compare <git ref> runs the same measurement on another commit (checked
+out into a temporary worktree) to get before/after numbers.
+
+Usage (from the repo root):
+    python -m benchmarks.startup [--runs 5] [--path /api/categories] [--compare HEAD~1] [--json out.json]
+
+Against real Firestore it needs credentials; set FIRESTORE_EMULATOR_HOST to
+run it against the emulator instead.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+# Runs inside the child interpreter, with the tree to measure as cwd
+PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, '.')
+import app
+t1 = time.perf_counter()
+response = app.app.test_client().get(sys.argv[1])
+t2 = time.perf_counter()
+print(json.dumps({"import_s": t1 - t0, "first_response_s": t2 - t1, "status": response.status_code}))
+"""
+
+
+def measure(tree, path, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", PROBE, path], cwd=tree,
+                                capture_output=True, text=True, timeout=300)
+        wall = time.perf_counter() - started
+        if result.returncode != 0:
+            raise RuntimeError(f"Probe failed in {tree}:\n{result.stderr[-2000:]}")
+        sample = json.loads(result.stdout.strip().splitlines()[-1])
+        sample["process_s"] = wall
+        samples.append(sample)
+    return {
+        "runs": runs,
+        "status": samples[-1]["status"],
+        **{f"median_{key}": round(statistics.median(s[key] for s in samples), 4)
+           for key in ("import_s", "first_response_s", "process_s")},
+        "max_process_s": round(max(s["process_s"] for s in samples), 4),
+    }
+
+
+def worktree(ref):
+    """Checks `ref` out into a temporary directory; returns its path."""
+    path = tempfile.mkdtemp(prefix="startup-bench-")
+    subprocess.run(["git", "worktree", "add", "--detach", path, ref], check=True, capture_output=True)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="App cold start benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/", help="Route used as the first request")
+    parser.add_argument("--compare", metavar="GIT_REF", help="Also measure this commit (e.g. the one before a change)")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = {"path": args.path, "current": measure(os.getcwd(), args.path, args.runs)}
+    if args.compare:
+        tree = worktree(args.compare)
+        try:
+            results[args.compare] = measure(tree, args.path, args.runs)
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", tree], capture_output=True)
+            shutil.rmtree(tree, ignore_errors=True)
+        before = results[args.compare]["median_process_s"]
+        after = results["current"]["median_process_s"]
+        results["speedup"] = round(before / after, 2) if after else None
+
+    print(json.dumps(results, indent=4))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Benchmark suite against the Firestore emulator: one run, one JSON report
+to compare with the next.
+
+For every scale in --scales (default 1k, 10k and 100k expenses; up to 1M)
+the emulator is seeded and then:
+
+- http: the real Flask routes served by gunicorn (1 worker x 8 threads, as
+  in the Dockerfile) are driven by --concurrency clients for --duration
+  seconds each: GET /api/expenses with every combination of the category,
+  client and date filters plus a text search, as an admin and as an
+  ejecutivo, then /api/categories, /api/clients and POST /api/login.
+  Documents read per request come from the server's /metrics
+  (firestore_reads_per_request), peak memory from the worker's VmHWM.
+- bigquery: sync_firestore_to_bigquery in this process, a full rebuild and
+  then an incremental sync after touching --changes expenses, with
+  LocalBigQuery standing in for BigQuery (load jobs are parsed and counted,
+  nothing leaves the machine).
+
+--fixtures <dir> also times receipt preprocessing over those images
+(benchmarks.preprocess, original and fast paths), once per run.
+
+Seeding writes straight to the emulator with BulkWriter: bootstrap.py's
+categories, clients and admin, --users ejecutivos (password "bench123")
+and the expenses with their search index entries, ids `bench-{n:07d}`.
+Each scale is seeded on top of the previous one, and reruns overwrite the
+same documents. Rollups are not rebuilt, so /api/summary is not measured
+here (benchmarks.loadtest covers it).
+
+Usage (from the repo root):
+    export FIRESTORE_EMULATOR_HOST=localhost:8085
+    python -m benchmarks.suite [--scales 1000,10000,100000,1000000] [--fixtures receipts/] [--json out.json]
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import subprocess
+import urllib.request
+
+from benchmarks import loadtest
+from benchmarks.export import RssSampler
+
+BENCH_PASSWORD = "bench123"
+FILTERS = {
+    "category": "Auto-Gasolina",
+    "client": "Cliente-1",
+    "date": "date_from=2024-03-01&date_to=2024-05-31",
+}
+SEARCH = "comercio 7"
+
+
+def expense_paths():
+    """/api/expenses with every combination of FILTERS, plus a text search."""
+    paths = []
+    for size in range(len(FILTERS) + 1):
+        for names in itertools.combinations(FILTERS, size):
+            query = ["page_size=50"] + [FILTERS[name] if name == "date" else f"{name}={FILTERS[name]}"
+                                        for name in names]
+            paths.append("/api/expenses?" + "&".join(query))
+    paths.append(f"/api/expenses?search={SEARCH.replace(' ', '+')}&page_size=50")
+    return paths
+
+
+# --- Seeding ---
+
+def seed_users(db, count):
+    from werkzeug.security import generate_password_hash
+    import bootstrap
+
+    hashed = generate_password_hash(BENCH_PASSWORD)  # once: hashing is slow on purpose
+    writer = db.bulk_writer()
+    for n in range(count):
+        username = f"bench-user-{n}"
+        writer.set(db.collection(bootstrap.users_collection).document(username),
+                   {"username": username, "password": hashed, "role": "user"})
+    writer.close()
+
+
+def seed_expenses(db, start, stop, users):
+    """Expenses start..stop-1 spread over the users, two years and every category/client."""
+    from google.cloud import firestore
+    import bootstrap
+    import search_index
+    from bq_import import COLLECTION_NAME
+
+    categories = [doc.id for doc in db.collection(bootstrap.categories_collection).stream()]
+    clients = [doc.id for doc in db.collection(bootstrap.clients_collection).stream()]
+    rng = random.Random(start)
+    writer = db.bulk_writer()
+    for n in range(start, stop):
+        doc_id = f"bench-{n:07d}"
+        data = {
+            "ejecutivo": f"bench-user-{n % users}",
+            "fecha": f"{rng.choice([2023, 2024])}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "categoria": rng.choice(categories),
+            "cliente": rng.choice(clients),
+            "establecimiento": f"Comercio {rng.randint(1, 500)}",
+            "descripcion": "Gasto de prueba",
+            "monto": round(rng.uniform(5, 500), 2),
+            "moneda": "PEN",
+            "actualizado_en": firestore.SERVER_TIMESTAMP,
+        }
+        writer.set(db.collection(COLLECTION_NAME).document(doc_id), data)
+        search_index.index_expense(writer, db, doc_id, data)
+    writer.close()
+
+
+def touch_expenses(db, count, total):
+    """Marks `count` expenses out of `total` as changed, for the incremental sync."""
+    from google.cloud import firestore
+    from bq_import import COLLECTION_NAME
+
+    writer = db.bulk_writer()
+    for n in random.Random(total).sample(range(total), min(count, total)):
+        writer.update(db.collection(COLLECTION_NAME).document(f"bench-{n:07d}"),
+                      {"actualizado_en": firestore.SERVER_TIMESTAMP})
+    writer.close()
+
+
+# --- HTTP load ---
+
+def scrape_reads(base_url):
+    """route -> (documents read, requests) from the server's firestore_reads_per_request histogram."""
+    with urllib.request.urlopen(base_url + "/metrics", timeout=30) as response:
+        text = response.read().decode("utf-8")
+    totals = {}
+    for line in text.splitlines():
+        for suffix, index in (("_sum", 0), ("_count", 1)):
+            prefix = f"firestore_reads_per_request{suffix}{{route=\""
+            if line.startswith(prefix):
+                route = line[len(prefix):line.index('"}')]
+                values = totals.setdefault(route, [0, 0])
+                values[index] = float(line.rsplit(" ", 1)[1])
+    return totals
+
+
+def worker_peak_mb(pid):
+    """Peak RSS (VmHWM) of the gunicorn worker under `pid`; None if it cannot be read (remote server)."""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = f.read().split()
+        with open(f"/proc/{children[0] if children else pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except (OSError, IndexError):
+        return None
+    return None
+
+
+def drive_route(base_url, route, path, args, token, method="GET", body=None, pid=None):
+    before = scrape_reads(base_url).get(route, [0, 0])
+    result = loadtest.drive(base_url, path, args.concurrency, args.duration, token, method, body)
+    after = scrape_reads(base_url).get(route, [0, 0])
+    requests = after[1] - before[1]
+    result["docs_read_per_request"] = round((after[0] - before[0]) / requests, 1) if requests else None
+    result["server_peak_mb"] = worker_peak_mb(pid) if pid else None
+    print(json.dumps({"path": path, **result}), file=sys.stderr)
+    return result
+
+
+def run_http(base_url, args, pid=None):
+    admin_token = loadtest.login(base_url, "admin", "admin123")
+    user_token = loadtest.login(base_url, "bench-user-0", BENCH_PASSWORD)
+    results = {}
+    for role, token in (("admin", admin_token), ("ejecutivo", user_token)):
+        for path in expense_paths():
+            results[f"{role} GET {path}"] = drive_route(base_url, "/api/expenses", path, args, token, pid=pid)
+    for path in ("/api/categories", "/api/clients"):
+        results[f"GET {path}"] = drive_route(base_url, path, path, args, admin_token, pid=pid)
+    body = json.dumps({"username": "bench-user-1", "password": BENCH_PASSWORD}).encode("utf-8")
+    results["POST /api/login"] = drive_route(base_url, "/api/login", "/api/login", args, admin_token,
+                                             "POST", body, pid=pid)
+    return results
+
+
+# --- BigQuery sync ---
+
+class LocalBigQuery:
+    """
+    Stands in for bigquery.Client in bq_import: load jobs are parsed (rows
+    counted, like BigQuery would) and copy/query jobs succeed at once.
+    --bq-latency adds a fixed wait per job to mimic the real round trip.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.project = "local"
+        self.jobs = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def _job(self):
+        self.jobs += 1
+        time.sleep(self.latency)
+        return self
+
+    def result(self):
+        return self
+
+    def load_table_from_file(self, file, table_ref, rewind=False, job_config=None):
+        if rewind:
+            file.seek(0)
+        data = file.read()
+        self.bytes += len(data)
+        if job_config.source_format == "PARQUET":
+            import pyarrow.parquet
+            self.rows += pyarrow.parquet.read_metadata(io.BytesIO(data)).num_rows
+        else:
+            self.rows += data.count(b"\n")
+        return self._job()
+
+    def copy_table(self, source, destination, job_config=None):
+        return self._job()
+
+    def query(self, sql, job_config=None):
+        return self._job()
+
+
+def run_bigquery(db, total, args):
+    import bq_import
+    import instrumentation
+    from gcp_clients import _clients
+
+    bigquery = _clients["bigquery"] = LocalBigQuery(args.bq_latency)
+    results = {}
+    for mode in ("full", "incremental"):
+        if mode == "incremental":
+            touch_expenses(db, args.changes, total)
+        reads = instrumentation.firestore_docs.value("read")
+        rows, bytes_loaded = bigquery.rows, bigquery.bytes
+        with RssSampler() as rss:
+            stats = bq_import.sync_firestore_to_bigquery(full=mode == "full")
+        results[mode] = {
+            "rows": stats["rows"],
+            "load_jobs": stats["load_jobs"],
+            "seconds": stats["seconds"],
+            "rows_per_s": stats["rows_per_sec"],
+            "docs_read": instrumentation.firestore_docs.value("read") - reads,
+            "rows_loaded": bigquery.rows - rows,
+            "mb_loaded": round((bigquery.bytes - bytes_loaded) / 1e6, 2),
+            "rss_growth_mb": round((rss.peak - rss.start) / 1e6, 1),
+        }
+        print(json.dumps({"bigquery": mode, **results[mode]}), file=sys.stderr)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite against the Firestore emulator")
+    parser.add_argument("--scales", default="1000,10000,100000", help="Expense counts, up to 1000000")
+    parser.add_argument("--users", type=int, default=20, help="Ejecutivos the expenses are spread over")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5, help="Seconds per route")
+    parser.add_argument("--changes", type=int, default=1000, help="Expenses changed before the incremental sync")
+    parser.add_argument("--bq-latency", type=float, default=0.0, help="Seconds added to every BigQuery job")
+    parser.add_argument("--skip", default="", help="Comma-separated parts to leave out: http, bigquery")
+    parser.add_argument("--fixtures", help="Receipt photos to time preprocessing on")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed preprocessing runs per image")
+    parser.add_argument("--port", type=int, default=8095)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("Set FIRESTORE_EMULATOR_HOST: this suite writes up to --scales expenses")
+    os.environ.setdefault("REQUEST_LOG", "0")  # the server's per-request log lines are not measured
+    skip = set(filter(None, args.skip.split(",")))
+
+    import bootstrap
+    from gcp_clients import get_firestore
+
+    db = get_firestore()
+    bootstrap.run()
+    seed_users(db, args.users)
+
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                 capture_output=True, text=True).stdout.strip() or None,
+        "config": {key: value for key, value in vars(args).items() if key != "json"},
+        "scales": {},
+    }
+    seeded = 0
+    for scale in sorted(int(s) for s in args.scales.split(",")):
+        started = time.perf_counter()
+        seed_expenses(db, seeded, scale, args.users)
+        print(f"Seeded {scale} expenses ({time.perf_counter() - started:.1f}s)", file=sys.stderr)
+        seeded = scale
+        scale_results = results["scales"][str(scale)] = {}
+
+        if "http" not in skip:
+            process, base_url = loadtest.start_server("sync", args.port)
+            try:
+                scale_results["http"] = run_http(base_url, args, process.pid)
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+        if "bigquery" not in skip:
+            scale_results["bigquery"] = run_bigquery(db, scale, args)
+
+    if args.fixtures:
+        from benchmarks import preprocess
+        preprocessing = preprocess.run(args.fixtures, args.repeat)
+        results["preprocess"] = {"images": preprocessing["images"], **preprocessing["summary"]}
+
+    print(json.dumps(results, indent=4))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+One-shot seeding of the reference data the app expects: default
+categories, clients and the admin user. Safe to run any number of times:
+each step only writes when its data is missing.
+
+Usage:
+    python bootstrap.py
+
+The app can also run it in a background thread at startup with
+BOOTSTRAP_ON_START=1 (see app.create_app).
+"""
+from google.cloud import firestore
+from werkzeug.security import generate_password_hash
+
+from gcp_clients import firestore_db as db
+
+users_collection = "users"
+categories_collection = "categories"
+clients_collection = "clients"
+
+def initialize_categories():
+    """Inicializa la colección de categorías si está vacía."""
+    try:
+        docs = db.collection(categories_collection).limit(1).stream()
+        if not any(docs):
+            print("Inicializando categorías en Firestore...")
+            initial_categories = [
+                "Auto-Gasolina", "Auto-Estacionamiento", "Auto-Otros",
+                "Gasto-Rep-Comida", "Gasto-Rep-Otros", "Servicios-Misc", "Viajes-Misc"
+            ]
+            batch = db.batch()
+            for cat in initial_categories:
+                doc_ref = db.collection(categories_collection).document(cat)
+                batch.set(doc_ref, {"name": cat})
+            batch.commit()
+            print("Categorías inicializadas.")
+    except Exception as e:
+        print(f"Error inicializando categorías: {e}")
+
+def initialize_clients():
+    """Inicializa la colección de clientes si está vacía."""
+    try:
+        docs = db.collection(clients_collection).limit(1).stream()
+        if not any(docs):
+            print("Inicializando clientes en Firestore...")
+            initial_clients = [
+                "Delosi", "Cliente-1", "Cliente-2", "Cliente-3", "Cliente-4",
+                "Cliente-5", "Cliente-6", "Cliente-7", "Cliente-8", "Cliente-9",
+                "Cliente-10", "Cliente-11", "Cliente-12", "Cliente-13", "Cliente-14", "Cliente-15"
+            ]
+            batch = db.batch()
+            for client in initial_clients:
+                doc_ref = db.collection(clients_collection).document(client)
+                batch.set(doc_ref, {"company_name": client})
+            batch.commit()
+            print("Clientes inicializados.")
+    except Exception as e:
+        print(f"Error inicializando clientes: {e}")
+
+def initialize_admin_user():
+    """Crea un usuario administrador por defecto si no existe."""
+    try:
+        admin_ref = db.collection(users_collection).document("admin")
+        if not admin_ref.get().exists:
+            print("Creando usuario admin por defecto...")
+            hashed_password = generate_password_hash("admin123")
+            admin_data = {
+                "username": "admin",
+                "password": hashed_password,
+                "role": "admin",
+                "created_at": firestore.SERVER_TIMESTAMP
+            }
+            admin_ref.set(admin_data)
+            print("Usuario admin creado.")
+    except Exception as e:
+        print(f"Error inicializando admin: {e}")
+
+def run():
+    initialize_categories()
+    initialize_clients()
+    initialize_admin_user()
+
+if __name__ == "__main__":
+    run()
@@ -1,44 +1,376 @@
+import os
+import sys
+import json
+import time
+import threading
+import tempfile
+from datetime import date, datetime, timedelta, timezone
 from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
 from google.cloud import bigquery
 
+from gcp_clients import firestore_db, bigquery_client
+from expense_fields import parse_fecha
+import instrumentation
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet is optional, NDJSON works everywhere
+    pyarrow = None
+
 PROJECT_ID = 'surfn-peru'
 
 # FirestoreConfiguration
 COLLECTION_NAME = 'expenses'
+TOMBSTONES_COLLECTION = 'expenses_deleted'  # written by app.delete_expense
+SYNC_STATE_COLLECTION = 'sync_state'
+SYNC_STATE_DOC = 'bigquery_expenses'
 DATABASE_ID = 'expenses'
-db = firestore.Client(project=PROJECT_ID, database=DATABASE_ID)
+# Shared clients, created on first use (see gcp_clients.py)
+db = firestore_db
 
-#BigQuery 
-bq_client = bigquery.Client(project=PROJECT_ID)
+#BigQuery
+bq_client = bigquery_client
 DATASET_ID = 'gastosrep'
 TABLE_ID = 'expenses'
-TABLE_REF = f"{bq_client.project}.{DATASET_ID}.{TABLE_ID}"
-
-def sync_firestore_to_bigquery():
-    # 1. Fetch data from Firestore
-    docs = db.collection(COLLECTION_NAME).stream()
-    rows_to_insert = [doc.to_dict() for doc in docs]
-
-    if not rows_to_insert:
-        print("No documents found in collection.")
-        return
-
-    # 2. Define BigQuery Load Job Configuration
-    job_config = bigquery.LoadJobConfig(
-        # This setting replaces the data instead of appending
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-        autodetect=True,  # Automatically detects schema from the data
-    )
-
-    # 3. Start the load job
-    job = bq_client.load_table_from_json(
-        rows_to_insert, 
-        TABLE_REF, 
-        job_config=job_config
-    )
-
-    job.result()  # Wait for the job to complete
-    print(f"Successfully synced {len(rows_to_insert)} rows to {TABLE_REF}.")
+STAGING_TABLE_ID = 'expenses_staging'
+REBUILD_TABLE_ID = 'expenses_rebuild'
+TABLE_REF = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
+STAGING_REF = f"{PROJECT_ID}.{DATASET_ID}.{STAGING_TABLE_ID}"
+REBUILD_REF = f"{PROJECT_ID}.{DATASET_ID}.{REBUILD_TABLE_ID}"
+
+# Streaming: documents are read in pages of CHUNK_SIZE and every page becomes
+# one load job, so memory stays flat no matter how big the collection gets.
+CHUNK_SIZE = int(os.environ.get('BQ_CHUNK_SIZE', 5000))
+# Chunks are serialized into a spooled temp file that only touches disk past this size.
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+# PARQUET when pyarrow is installed, otherwise NEWLINE_DELIMITED_JSON.
+EXPORT_FORMAT = os.environ.get('BQ_EXPORT_FORMAT', 'PARQUET' if pyarrow else 'NEWLINE_DELIMITED_JSON')
+
+# Re-read a small window before the watermark on every run so writes whose
+# server timestamp landed just before the previous run are not missed.
+# MERGE is keyed on id, so re-reading a row is harmless.
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+# Explicit, stable schema (instead of autodetect) so incremental loads and
+# the MERGE always line up with the target table.
+STRING_FIELDS = ['categoria', 'cliente', 'descripcion', 'ejecutivo', 'establecimiento', 'moneda']
+SCHEMA = [
+    bigquery.SchemaField('id', 'STRING', mode='REQUIRED'),
+    *[bigquery.SchemaField(name, 'STRING') for name in STRING_FIELDS],
+    bigquery.SchemaField('fecha', 'DATE'),
+    bigquery.SchemaField('monto', 'FLOAT64'),
+    bigquery.SchemaField('reportado_en', 'TIMESTAMP'),
+    bigquery.SchemaField('actualizado_en', 'TIMESTAMP'),
+]
+STAGING_SCHEMA = SCHEMA + [bigquery.SchemaField('_deleted', 'BOOL')]
+COLUMNS = [field.name for field in SCHEMA]
+
+
+def _as_float(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_timestamp(value):
+    if isinstance(value, str) and value:
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    return None
+
+
+def _to_row(doc_id, data):
+    """Maps a Firestore expense to a row matching SCHEMA."""
+    row = {'id': doc_id}
+    for name in STRING_FIELDS:
+        value = data.get(name)
+        row[name] = str(value) if value is not None else None
+    row['fecha'] = parse_fecha(data.get('fecha'))
+    row['monto'] = _as_float(data.get('monto'))
+    row['reportado_en'] = _as_timestamp(data.get('reportado_en'))
+    row['actualizado_en'] = _as_timestamp(data.get('actualizado_en'))
+    return row
+
+
+def _iter_pages(query, page_size=CHUNK_SIZE):
+    """Pages through an ordered query with start_after cursors, one list of snapshots at a time."""
+    last = None
+    while True:
+        page_query = query.limit(page_size)
+        if last is not None:
+            page_query = page_query.start_after(last)
+        page = list(page_query.stream())
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+
+def _arrow_type(field):
+    return {
+        'STRING': pyarrow.string(),
+        'DATE': pyarrow.date32(),
+        'FLOAT64': pyarrow.float64(),
+        'TIMESTAMP': pyarrow.timestamp('us', tz='UTC'),
+        'BOOL': pyarrow.bool_(),
+    }[field.field_type]
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Not JSON serializable: {type(value)}")
+
+
+def _serialize_chunk(rows, schema):
+    """Writes one chunk to a spooled temp file in EXPORT_FORMAT."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    if EXPORT_FORMAT == 'PARQUET':
+        arrow_schema = pyarrow.schema([
+            pyarrow.field(f.name, _arrow_type(f), nullable=f.mode != 'REQUIRED') for f in schema
+        ])
+        table = pyarrow.Table.from_pylist(rows, schema=arrow_schema)
+        pyarrow.parquet.write_table(table, spool)
+    else:
+        for row in rows:
+            spool.write(json.dumps(row, default=_json_default).encode('utf-8'))
+            spool.write(b'\n')
+    return spool
+
+
+def _load_chunks(chunks, table_ref, schema, progress=None):
+    """
+    Loads each chunk of rows with its own load job. The first job truncates
+    the table, the rest append. Calls progress(rows, jobs) after every job.
+    Returns (rows, jobs).
+    """
+    total_rows = 0
+    jobs = 0
+    for rows in chunks:
+        if not rows:
+            continue
+        job_config = bigquery.LoadJobConfig(
+            schema=schema,
+            source_format=EXPORT_FORMAT,
+            write_disposition=(bigquery.WriteDisposition.WRITE_APPEND if jobs
+                               else bigquery.WriteDisposition.WRITE_TRUNCATE),
+        )
+        with _serialize_chunk(rows, schema) as spool:
+            job = bq_client.load_table_from_file(spool, table_ref, rewind=True, job_config=job_config)
+            job.result()  # Wait for the job to complete
+        total_rows += len(rows)
+        jobs += 1
+        if progress:
+            progress(total_rows, jobs)
+    return total_rows, jobs
+
+
+def _state_ref():
+    return db.collection(SYNC_STATE_COLLECTION).document(SYNC_STATE_DOC)
+
+
+def _read_watermark():
+    doc = _state_ref().get()
+    if not doc.exists:
+        return None
+    return doc.to_dict().get('watermark')
+
+
+def _save_watermark(watermark, mode, rows):
+    _state_ref().set({
+        'watermark': watermark,
+        'last_mode': mode,
+        'last_rows': rows,
+        'last_run': firestore.SERVER_TIMESTAMP,
+    })
+
+
+def full_rebuild(progress=None):
+    """
+    Reloads the whole collection into BigQuery. Chunks go to a rebuild table
+    that then replaces the target with a single copy job, so readers never
+    see a half-loaded table.
+    """
+    # Anything written after this instant is picked up by the next incremental run.
+    started = datetime.now(timezone.utc)
+
+    query = db.collection(COLLECTION_NAME).order_by(FieldPath.document_id())
+    chunks = ([_to_row(doc.id, doc.to_dict()) for doc in page] for page in _iter_pages(query))
+    rows, jobs = _load_chunks(chunks, REBUILD_REF, SCHEMA, progress)
+
+    if not rows:
+        # No load job ran, so the rebuild table may hold an older run (or not
+        # exist): replace it with an empty one so the copy empties the target too.
+        instrumentation.log("INFO", "No documents found in collection")
+        bq_client.delete_table(REBUILD_REF, not_found_ok=True)
+        bq_client.create_table(bigquery.Table(REBUILD_REF, schema=SCHEMA))
+
+    # WRITE_TRUNCATE also replaces the table schema with SCHEMA.
+    copy_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    bq_client.copy_table(REBUILD_REF, TABLE_REF, job_config=copy_config).result()
+    _save_watermark(started, 'full', rows)
+    instrumentation.log("INFO", f"Full rebuild: synced {rows} rows to {TABLE_REF} in {jobs} load jobs")
+    return rows, jobs
+
+
+def _iter_changes(since):
+    """Yields staging rows for expenses changed and deleted since the given time."""
+    changed = (db.collection(COLLECTION_NAME)
+               .where('actualizado_en', '>=', since)
+               .order_by('actualizado_en'))
+    for page in _iter_pages(changed):
+        for doc in page:
+            row = _to_row(doc.id, doc.to_dict())
+            row['_deleted'] = False
+            yield row
+
+    tombstones = (db.collection(TOMBSTONES_COLLECTION)
+                  .where('eliminado_en', '>=', since)
+                  .order_by('eliminado_en'))
+    for page in _iter_pages(tombstones):
+        for doc in page:
+            # The tombstone time goes in actualizado_en so the MERGE can keep the latest version per id.
+            deleted_at = _as_timestamp(doc.to_dict()['eliminado_en'])
+            yield {'id': doc.id, 'actualizado_en': deleted_at, '_deleted': True}
+
+
+def _chunked(iterable, size=CHUNK_SIZE):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def incremental_sync(watermark, progress=None):
+    """Merges expenses changed (or deleted) since the watermark into BigQuery."""
+    new_watermark = watermark
+
+    def track(rows):
+        nonlocal new_watermark
+        for row in rows:
+            if row['actualizado_en'] and row['actualizado_en'] > new_watermark:
+                new_watermark = row['actualizado_en']
+            yield row
+
+    rows, jobs = _load_chunks(_chunked(track(_iter_changes(watermark - WATERMARK_OVERLAP))),
+                              STAGING_REF, STAGING_SCHEMA, progress)
+    if not rows:
+        instrumentation.log("INFO", "No changes since last sync")
+        return rows, jobs
+
+    updates = ", ".join(f"{c} = S.{c}" for c in COLUMNS if c != 'id')
+    columns = ", ".join(COLUMNS)
+    values = ", ".join(f"S.{c}" for c in COLUMNS)
+    merge_sql = f"""
+    MERGE `{TABLE_REF}` T
+    USING (
+      SELECT * EXCEPT(_rn) FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY id ORDER BY actualizado_en DESC, _deleted DESC) AS _rn
+        FROM `{STAGING_REF}`
+      ) WHERE _rn = 1
+    ) S
+    ON T.id = S.id
+    WHEN MATCHED AND S._deleted THEN DELETE
+    WHEN MATCHED THEN UPDATE SET {updates}
+    WHEN NOT MATCHED AND NOT S._deleted THEN INSERT ({columns}) VALUES ({values})
+    """
+    bq_client.query(merge_sql).result()
+
+    _save_watermark(new_watermark, 'incremental', rows)
+    instrumentation.log("INFO", f"Incremental sync: merged {rows} changes into {TABLE_REF} ({jobs} load jobs)")
+    return rows, jobs
+
+
+class _RssSampler:
+    """
+    Peak resident memory during one run, sampled from /proc every 50 ms.
+    (ru_maxrss is the peak of the whole process, which in a long-lived
+    gunicorn worker says nothing about the current run.) Without /proc
+    (macOS, Windows) nothing is sampled and stats() returns an empty dict,
+    so the run stats simply have no RSS keys.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.start = self.peak = self._current()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    @staticmethod
+    def _current():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            return None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._current() or 0)
+
+    def __enter__(self):
+        if self.start is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+            self.peak = max(self.peak, self._current() or 0)
+
+    def stats(self):
+        """peak_rss_mb and rss_growth_mb, or {} if RSS cannot be read here."""
+        if self.start is None:
+            return {}
+        return {'peak_rss_mb': round(self.peak / 2**20, 1),
+                'rss_growth_mb': round((self.peak - self.start) / 2**20, 1)}
+
+
+def sync_firestore_to_bigquery(full=False, progress=None):
+    """
+    Syncs Firestore expenses to BigQuery. Runs incrementally from the stored
+    watermark; falls back to a full rebuild when forced or when no watermark
+    exists yet (first run, or after the state document was removed).
+    progress(rows, jobs) is called after every load job.
+    Returns run stats (rows, load jobs, rows/sec, and where /proc exists
+    peak RSS during the run and its growth over the RSS at the start).
+    """
+    started = time.perf_counter()
+    with _RssSampler() as rss:
+        watermark = None if full else _read_watermark()
+        if watermark is None:
+            mode = 'full'
+            rows, jobs = full_rebuild(progress)
+        else:
+            mode = 'incremental'
+            rows, jobs = incremental_sync(watermark, progress)
+
+    elapsed = time.perf_counter() - started
+    stats = {
+        'mode': mode,
+        'rows': rows,
+        'load_jobs': jobs,
+        'format': EXPORT_FORMAT,
+        'seconds': round(elapsed, 2),
+        'rows_per_sec': round(rows / elapsed, 1) if elapsed else 0.0,
+        **rss.stats(),
+    }
+    instrumentation.log("INFO", "BigQuery sync stats", stats=stats)
+    return stats
 
 if __name__ == "__main__":
-    sync_firestore_to_bigquery()
\ No newline at end of file
+    sync_firestore_to_bigquery(full='--full' in sys.argv)
@@ -0,0 +1,258 @@
+"""
+Duplicate expense detection.
+
+The same receipt is often filed twice: once by hand and again after a
+retry, or by two ejecutivos. DEDUP_COLLECTION indexes every expense under
+a key built from its normalized fecha, amount in cents and cliente
+(`2024-03-05|4590|delosi`). Each key document keeps a small map of the
+expenses under it with their normalized establecimiento. Looking up a new
+expense reads the keys for each day in the window (fecha ± WINDOW_DAYS),
+2 * WINDOW_DAYS + 1 documents in one get_all whatever the size of the
+collection. It then compares merchant names fuzzily, so "Primax S.A." and
+"PRIMAX" still match.
+
+add_expense flags the matches on the new expense (or, with
+DEDUP_MODE=reject, refuses it with 409 unless ?allow_duplicate=1). The
+check and the write are not atomic, so two simultaneous submissions of the
+same receipt can both pass. `python dedup.py --scan` finds those, and any
+older duplicates, in one pass over the history.
+
+Usage:
+    python dedup.py --scan [--window 1] [--json clusters.json]
+    python dedup.py --rebuild    # index expenses created before this module
+"""
+import os
+import sys
+import json
+import argparse
+import difflib
+from collections import deque
+from datetime import timedelta
+from google.cloud import firestore
+
+from expense_fields import parse_fecha, id_part
+from search_index import normalize, tokenize
+from gcp_clients import firestore_db
+
+EXPENSES_COLLECTION = 'expenses'
+DEDUP_COLLECTION = 'expense_dedup'
+
+MODE = os.environ.get('DEDUP_MODE', 'flag')  # flag | reject | off
+WINDOW_DAYS = int(os.environ.get('DEDUP_WINDOW_DAYS', 1))
+MERCHANT_SIMILARITY = float(os.environ.get('DEDUP_MERCHANT_SIMILARITY', 0.8))
+BATCH_SIZE = 400
+
+
+def cents_of(data):
+    try:
+        return int(round(float(data.get('monto')) * 100))
+    except (TypeError, ValueError):
+        return None
+
+
+def merchant_of(data):
+    """'Primax S.A.C.' -> 'primax s a c'"""
+    return ' '.join(tokenize(data.get('establecimiento')))
+
+
+def cliente_of(data):
+    return ' '.join(normalize(data.get('cliente')).split())
+
+
+def key_id(day, cents, cliente):
+    return f"{day.isoformat()}|{cents}|{id_part(cliente)}"
+
+
+def key_of(data):
+    """Index key of an expense; None if it has no usable fecha or monto."""
+    day, cents = parse_fecha(data.get('fecha')), cents_of(data)
+    if day is None or cents is None:
+        return None
+    return key_id(day, cents, cliente_of(data))
+
+
+def similar_merchants(a, b):
+    """Same merchant, allowing for typos and suffixes ('primax' vs 'primax s a')."""
+    if not a or not b:
+        return a == b
+    if a.startswith(b) or b.startswith(a):
+        return True
+    return difflib.SequenceMatcher(None, a, b).ratio() >= MERCHANT_SIMILARITY
+
+
+def _entry(data):
+    return {'merchant': merchant_of(data), 'ejecutivo': data.get('ejecutivo'),
+            'fecha': data.get('fecha')}
+
+
+def index_expense(batch, db, doc_id, data):
+    """Adds the index write to an existing batch (a no-op for expenses without fecha/monto)."""
+    key = key_of(data)
+    if key:
+        batch.set(db.collection(DEDUP_COLLECTION).document(key),
+                  {'entries': {doc_id: _entry(data)}}, merge=True)
+
+
+def unindex_expense(batch, db, doc_id, data):
+    key = key_of(data)
+    if key:
+        batch.set(db.collection(DEDUP_COLLECTION).document(key),
+                  {'entries': {doc_id: firestore.DELETE_FIELD}}, merge=True)
+
+
+def find_duplicates(db, data, window_days=WINDOW_DAYS):
+    """
+    Indexed expenses that look like the same receipt as `data`: same amount
+    and cliente, fecha within window_days and a similar establecimiento.
+    Returns [{id, ejecutivo, fecha}], at most one document read per day of the window.
+    """
+    return find_duplicates_many(db, [(None, data)], window_days)[0]
+
+
+def find_duplicates_many(db, items, window_days=WINDOW_DAYS):
+    """
+    find_duplicates() for a whole upload, items = [(doc_id, data)], with one
+    get_all for the keys of all of them. Earlier items count as indexed, so a
+    receipt repeated within the upload is caught too. An item already indexed
+    under its doc_id is a resend of a stored expense and matches nothing.
+    Returns one list of matches per item.
+    """
+    lookups = []  # per item: (merchant, key ids of its window), or None without fecha/monto
+    for _, data in items:
+        day, cents = parse_fecha(data.get('fecha')), cents_of(data)
+        if day is None or cents is None:
+            lookups.append(None)
+            continue
+        cliente = cliente_of(data)
+        lookups.append((merchant_of(data), [key_id(day + timedelta(days=offset), cents, cliente)
+                                            for offset in range(-window_days, window_days + 1)]))
+
+    keys = sorted({key for lookup in lookups if lookup for key in lookup[1]})
+    refs = [db.collection(DEDUP_COLLECTION).document(key) for key in keys]
+    entries = {}  # key id -> {doc_id: entry}
+    for snapshot in db.get_all(refs) if refs else []:
+        if snapshot.exists:
+            entries[snapshot.id] = dict(snapshot.to_dict().get('entries') or {})
+
+    results = []
+    for (doc_id, data), lookup in zip(items, lookups):
+        if lookup is None:
+            results.append([])
+            continue
+        merchant, item_keys = lookup
+        if doc_id is not None and doc_id in entries.get(key_of(data), {}):
+            results.append([])
+            continue
+        matches = []
+        for key in item_keys:
+            for other_id, entry in sorted(entries.get(key, {}).items()):
+                if similar_merchants(merchant, entry.get('merchant', '')):
+                    matches.append({'id': other_id, 'ejecutivo': entry.get('ejecutivo'), 'fecha': entry.get('fecha')})
+        results.append(matches)
+        if doc_id is not None:
+            entries.setdefault(key_of(data), {})[doc_id] = _entry(data)
+    return results
+
+
+def scan(db, window_days=WINDOW_DAYS):
+    """
+    Duplicate clusters in the whole expenses collection, in one pass ordered
+    by fecha. Only the expenses of the last window_days are kept in memory,
+    grouped by (cents, cliente). Expenses whose fecha is not stored as
+    YYYY-MM-DD cannot be placed in that order and are counted as skipped.
+    """
+    fields = ['fecha', 'monto', 'cliente', 'establecimiento', 'ejecutivo']
+    recent = deque()   # (day, group key) of every expense in the window, in fecha order
+    groups = {}        # (cents, cliente) -> deque of (merchant, row), in fecha order
+    parent = {}        # union-find over the expenses that matched another one
+    rows = {}          # doc_id -> row, for those expenses only
+    scanned = skipped = 0
+
+    def root(doc_id):
+        while parent[doc_id] != doc_id:
+            parent[doc_id] = parent[parent[doc_id]]
+            doc_id = parent[doc_id]
+        return doc_id
+
+    query = db.collection(EXPENSES_COLLECTION).order_by('fecha').select(fields)
+    for doc in query.stream():
+        data = doc.to_dict()
+        scanned += 1
+        day, cents = parse_fecha(data.get('fecha')), cents_of(data)
+        if day is None or cents is None or str(data.get('fecha'))[:10] != day.isoformat():
+            skipped += 1
+            continue
+
+        oldest = day - timedelta(days=window_days)
+        while recent and recent[0][0] < oldest:
+            _, old_key = recent.popleft()
+            groups[old_key].popleft()
+            if not groups[old_key]:
+                del groups[old_key]
+
+        key = (cents, cliente_of(data))
+        merchant = merchant_of(data)
+        row = {'id': doc.id, **{field: data.get(field) for field in fields}}
+        group = groups.setdefault(key, deque())
+        for other_merchant, other in group:
+            if similar_merchants(merchant, other_merchant):
+                for match in (row, other):
+                    parent.setdefault(match['id'], match['id'])
+                    rows[match['id']] = match
+                parent[root(doc.id)] = root(other['id'])
+        group.append((merchant, row))
+        recent.append((day, key))
+
+    clusters = {}
+    for doc_id in parent:
+        clusters.setdefault(root(doc_id), []).append(rows[doc_id])
+    return {
+        'scanned': scanned,
+        'skipped': skipped,
+        'clusters': sorted((sorted(cluster, key=lambda r: (r['fecha'], r['id'])) for cluster in clusters.values()),
+                           key=lambda cluster: (cluster[0]['fecha'], cluster[0]['id'])),
+    }
+
+
+def rebuild(db):
+    """Rebuilds the index from the expenses collection (backfill / repair)."""
+    batch = db.batch()
+    pending = 0
+    for doc in db.collection(DEDUP_COLLECTION).stream():
+        batch.delete(doc.reference)
+        pending += 1
+        if pending == BATCH_SIZE:
+            batch.commit()
+            batch, pending = db.batch(), 0
+    count = 0
+    for doc in db.collection(EXPENSES_COLLECTION).stream():
+        index_expense(batch, db, doc.id, doc.to_dict())
+        count += 1
+        pending += 1
+        if pending == BATCH_SIZE:
+            batch.commit()
+            batch, pending = db.batch(), 0
+    batch.commit()
+    print(f"Dedup index rebuilt: {count} expenses.")
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Duplicate expense index and history scan")
+    parser.add_argument("--scan", action="store_true", help="Report duplicate clusters in the history")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the index from the expenses")
+    parser.add_argument("--window", type=int, default=WINDOW_DAYS, help="Days apart two duplicates may be")
+    parser.add_argument("--json", help="Write the scan result to this file")
+    args = parser.parse_args()
+    if not (args.scan or args.rebuild):
+        parser.print_usage()
+        sys.exit(1)
+    if args.rebuild:
+        rebuild(firestore_db)
+    if args.scan:
+        result = scan(firestore_db, args.window)
+        print(f"Scanned {result['scanned']} expenses ({result['skipped']} skipped): "
+              f"{len(result['clusters'])} duplicate clusters.")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(result, f, indent=2, default=str)
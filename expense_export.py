@@ -0,0 +1,248 @@
+"""
+Streaming expense exports for GET /api/expenses/export (CSV, XLSX, Parquet).
+
+The writers take an iterable of pages (lists of expense dicts, as returned
+page by page by /api/expenses) and yield bytes as each page is encoded, so
+the response goes out with chunked transfer and memory stays bounded by a
+page (a row group for Parquet) whatever the number of rows. gzip() wraps
+any of them.
+
+XLSX is written directly as the zipped SpreadsheetML parts: the sheet is a
+single zip entry streamed row by row, which no spreadsheet library does.
+"""
+import io
+import csv
+import zlib
+import zipfile
+from xml.sax.saxutils import escape
+
+from expense_fields import parse_fecha
+
+COLUMNS = ['id', 'fecha', 'ejecutivo', 'categoria', 'cliente', 'establecimiento',
+           'descripcion', 'monto', 'moneda']
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+XLSX_MAX_ROWS = 1048576 - 1   # Excel's row limit minus the header; more rows continue on a new sheet
+PARQUET_ROW_GROUP = 50000     # rows buffered per row group
+
+
+def cell(item, column):
+    value = item.get(column)
+    return '' if value is None else value
+
+
+def monto_of(item):
+    try:
+        return float(item.get('monto'))
+    except (TypeError, ValueError):
+        return None
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file that collects bytes until drain()."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def write_csv(pages):
+    # BOM so Excel opens the accents (Alimentación, Perú) as UTF-8
+    yield '\ufeff'.encode('utf-8')
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for page in pages:
+        for item in page:
+            writer.writerow([cell(item, column) for column in COLUMNS])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _column_letter(index):
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+_LETTERS = [_column_letter(i) for i in range(len(COLUMNS))]
+
+
+def _xlsx_row(number, values):
+    cells = []
+    for letter, value in zip(_LETTERS, values):
+        ref = f'{letter}{number}'
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f'<c r="{ref}"><v>{value}</v></c>')
+        elif value not in ('', None):
+            cells.append(f'<c r="{ref}" t="inlineStr"><is><t>{escape(str(value))}</t></is></c>')
+    return f'<row r="{number}">{"".join(cells)}</row>'
+
+
+_SHEET_START = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                '<sheetData>')
+_SHEET_END = '</sheetData></worksheet>'
+
+
+def _xlsx_static_parts(sheets):
+    ns = 'http://schemas.openxmlformats.org/'
+    overrides = ''.join(
+        f'<Override PartName="/xl/worksheets/sheet{n}.xml" '
+        f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for n in range(1, sheets + 1))
+    sheet_list = ''.join(
+        f'<sheet name="Gastos{"" if n == 1 else f" {n}"}" sheetId="{n}" r:id="rId{n}"/>'
+        for n in range(1, sheets + 1))
+    relationships = ''.join(
+        f'<Relationship Id="rId{n}" Type="{ns}officeDocument/2006/relationships/worksheet" '
+        f'Target="worksheets/sheet{n}.xml"/>' for n in range(1, sheets + 1))
+    return {
+        '[Content_Types].xml':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<Types xmlns="{ns}package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            f'{overrides}</Types>',
+        '_rels/.rels':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<Relationships xmlns="{ns}package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{ns}officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>',
+        'xl/workbook.xml':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<workbook xmlns="{ns}spreadsheetml/2006/main" xmlns:r="{ns}officeDocument/2006/relationships">'
+            f'<sheets>{sheet_list}</sheets></workbook>',
+        'xl/_rels/workbook.xml.rels':
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<Relationships xmlns="{ns}package/2006/relationships">{relationships}</Relationships>',
+    }
+
+
+def write_xlsx(pages):
+    sink = _Sink()
+    # The sink is not seekable, so zipfile writes sizes in data descriptors after each entry.
+    # No `with`: if the client goes away mid-sheet the archive is simply dropped.
+    archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED)
+    sheets = 0
+    sheet = None
+    row_number = 0
+
+    def start_sheet():
+        nonlocal sheets, sheet, row_number
+        sheets += 1
+        sheet = archive.open(f'xl/worksheets/sheet{sheets}.xml', 'w', force_zip64=True)
+        sheet.write(_SHEET_START.encode('utf-8'))
+        sheet.write(_xlsx_row(1, COLUMNS).encode('utf-8'))
+        row_number = 1
+
+    start_sheet()
+    for page in pages:
+        rows = []
+        for item in page:
+            if row_number > XLSX_MAX_ROWS:
+                sheet.write((''.join(rows) + _SHEET_END).encode('utf-8'))
+                sheet.close()
+                rows = []
+                start_sheet()
+            row_number += 1
+            values = [cell(item, column) for column in COLUMNS]
+            values[COLUMNS.index('monto')] = monto_of(item)
+            rows.append(_xlsx_row(row_number, values))
+        sheet.write(''.join(rows).encode('utf-8'))
+        yield sink.drain()
+    sheet.write(_SHEET_END.encode('utf-8'))
+    sheet.close()
+    for name, content in _xlsx_static_parts(sheets).items():
+        archive.writestr(name, content)
+    archive.close()
+    yield sink.drain()
+
+
+def parquet_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('id', pa.string()),
+        ('fecha', pa.date32()),
+        ('ejecutivo', pa.string()),
+        ('categoria', pa.string()),
+        ('cliente', pa.string()),
+        ('establecimiento', pa.string()),
+        ('descripcion', pa.string()),
+        ('monto', pa.float64()),
+        ('moneda', pa.string()),
+    ])
+
+
+def write_parquet(pages, row_group=PARQUET_ROW_GROUP):
+    # pyarrow is only needed by this format (and bq_import), so it is imported on first use
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema()
+    sink = _Sink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema, compression='snappy')
+    buffered = {name: [] for name in schema.names}
+
+    def flush():
+        writer.write_table(pa.table(buffered, schema=schema))
+        for values in buffered.values():
+            values.clear()
+
+    for page in pages:
+        for item in page:
+            for name in schema.names:
+                if name == 'fecha':
+                    buffered[name].append(parse_fecha(item.get('fecha')))
+                elif name == 'monto':
+                    buffered[name].append(monto_of(item))
+                else:
+                    value = item.get(name)
+                    buffered[name].append(None if value is None else str(value))
+        if len(buffered['id']) >= row_group:
+            flush()
+            yield sink.drain()
+    if buffered['id']:
+        flush()
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = {'csv': write_csv, 'xlsx': write_xlsx, 'parquet': write_parquet}
+
+
+def gzip(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(pages, fmt, compress=False):
+    """Bytes of `pages` in fmt ('csv', 'xlsx' or 'parquet'), optionally gzipped, as a generator."""
+    chunks = WRITERS[fmt](pages)
+    return gzip(chunks) if compress else chunks
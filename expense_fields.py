@@ -0,0 +1,57 @@
+"""
+Expense field parsing shared by the API (app.py), the derived collections
+(rollups.py, dedup.py) and the exports (expense_export.py, bq_import.py),
+so they all read a fecha the same way and build document ids alike.
+"""
+import re
+from datetime import date, datetime
+from urllib.parse import quote
+
+# ISO and the format of the bank statements
+DATE_FORMATS = ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y']
+# Currency marks and spaces dropped before reading a monto
+_MONTO_NOISE = re.compile(r'(?i)s/\.?|pen|\s')
+# '12,50': a single comma followed by one or two digits is a decimal comma
+_DECIMAL_COMMA = re.compile(r'^-?\d+,\d{1,2}$')
+
+
+def parse_fecha(value):
+    """
+    date of a fecha: a date/datetime or text in one of DATE_FORMATS (an ISO
+    timestamp counts by its date). None if missing or unreadable.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    text = str(value or '').strip()
+    if len(text) > 10 and text[10] in 'T ':
+        text = text[:10]
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_monto(value):
+    """
+    float of a monto: a number or text like 'S/ 1,234.50' or '12,50'.
+    None if missing or unreadable.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = _MONTO_NOISE.sub('', str(value or ''))
+    text = text.replace(',', '.') if _DECIMAL_COMMA.match(text) else text.replace(',', '')
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def id_part(value):
+    """value made safe for a document id: ids cannot contain '/', client names can."""
+    return quote(str(value), safe='')
@@ -0,0 +1,166 @@
+"""
+Live expense changes for GET /api/expenses/stream (Server-Sent Events).
+
+One pair of Firestore snapshot listeners per process, shared by every
+connected client: one on expenses changed since the listeners started
+(actualizado_en >= start) and one on the deletion tombstones. Each change
+is turned into an "added", "modified" or "removed" event and put on the
+queue of every subscriber allowed to see it. The listeners start with the
+first subscriber and stop with the last one.
+
+A subscriber is read either by a thread blocked in next_event() (the Flask
+route) or by a coroutine awaiting next_event_async() (asgi.py), which keeps
+no thread busy while the stream is idle.
+"""
+import json
+import queue
+import asyncio
+import threading
+from datetime import datetime, timezone
+from google.cloud.firestore_v1.watch import ChangeType
+
+QUEUE_SIZE = 256  # events buffered per client; a client that falls behind gets a "reset"
+
+
+class Subscriber:
+    def __init__(self, ejecutivo=None, loop=None):
+        self.ejecutivo = ejecutivo  # None = sees every expense (admin)
+        self.events = queue.Queue(maxsize=QUEUE_SIZE + 1)  # +1 keeps room for the reset
+        self.overflowed = False
+        self._loop = loop  # event loop of the coroutine reading next_event_async()
+        self._ready = asyncio.Event() if loop else None
+
+    def can_see(self, ejecutivo):
+        # An expense without ejecutivo belongs to nobody: only admins see it
+        return self.ejecutivo is None or (ejecutivo is not None and self.ejecutivo == ejecutivo)
+
+    def push(self, event):
+        if self.overflowed:
+            return
+        if self.events.qsize() >= QUEUE_SIZE:
+            # Dropping events would leave the client's table silently wrong: ask it to refetch
+            self.overflowed = True
+            event = ("reset", {})
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            return
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._ready.set)
+            except RuntimeError:
+                pass  # loop already closed: the stream is gone
+
+    def next_event(self, timeout):
+        """(kind, payload); raises queue.Empty after timeout seconds without events."""
+        return self._taken(self.events.get(timeout=timeout))
+
+    async def next_event_async(self, timeout):
+        """next_event() for a subscriber created with a loop, awaited on that loop."""
+        deadline = self._loop.time() + timeout
+        while True:
+            try:
+                return self._taken(self.events.get_nowait())
+            except queue.Empty:
+                pass
+            self._ready.clear()
+            if not self.events.empty():
+                continue  # pushed between get_nowait() and clear()
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                raise queue.Empty
+            try:
+                await asyncio.wait_for(self._ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                raise queue.Empty
+
+    def _taken(self, event):
+        if event[0] == "reset":
+            # The refetch covers everything dropped up to here
+            self.overflowed = False
+        return event
+
+
+class ExpenseStream:
+    def __init__(self, db, collection, deleted_collection, max_subscribers=50):
+        self.db = db
+        self.collection = collection
+        self.deleted_collection = deleted_collection
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._watches = []
+        self._lock = threading.Lock()
+        self.events_sent = 0
+
+    def subscribe(self, ejecutivo=None, loop=None, max_subscribers=None):
+        """
+        New subscriber, or None if max_subscribers (default self.max_subscribers)
+        are already connected. Pass the running loop to read it with next_event_async().
+        """
+        with self._lock:
+            if len(self._subscribers) >= (max_subscribers or self.max_subscribers):
+                return None
+            subscriber = Subscriber(ejecutivo, loop)
+            self._subscribers.add(subscriber)
+            if not self._watches:
+                self._start()
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            if not self._subscribers:
+                self._stop()
+
+    def _start(self):
+        # Only changes from now on: the clients already loaded the current list
+        start = datetime.now(timezone.utc)
+        expenses = self.db.collection(self.collection).where('actualizado_en', '>=', start)
+        tombstones = self.db.collection(self.deleted_collection).where('eliminado_en', '>=', start)
+        self._watches = [expenses.on_snapshot(self._on_expenses),
+                         tombstones.on_snapshot(self._on_tombstones)]
+
+    def _stop(self):
+        for watch in self._watches:
+            if watch is not None:
+                watch.unsubscribe()
+        self._watches = []
+
+    def _broadcast(self, kind, payload, ejecutivo):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if subscriber.can_see(ejecutivo):
+                subscriber.push((kind, payload))
+                self.events_sent += 1
+
+    def _on_expenses(self, docs, changes, read_time):
+        for change in changes:
+            # Deletes arrive through the tombstones; actualizado_en only grows,
+            # so a REMOVED here never means "stopped matching"
+            if change.type == ChangeType.REMOVED:
+                continue
+            doc = change.document
+            item = doc.to_dict()
+            item['id'] = doc.id
+            # A document written before start enters the query as ADDED when it is modified
+            created = doc.create_time is not None and doc.create_time == doc.update_time
+            kind = "added" if created else "modified"
+            self._broadcast(kind, item, item.get('ejecutivo'))
+
+    def _on_tombstones(self, docs, changes, read_time):
+        for change in changes:
+            if change.type != ChangeType.ADDED:
+                continue
+            data = change.document.to_dict()
+            self._broadcast("removed", {"id": change.document.id}, data.get('ejecutivo'))
+
+    def stats(self):
+        with self._lock:
+            return {"subscribers": len(self._subscribers), "max_subscribers": self.max_subscribers,
+                    "listening": bool(self._watches), "events_sent": self.events_sent}
+
+
+def format_event(kind, payload):
+    """One SSE message."""
+    return f"event: {kind}\ndata: {json.dumps(payload, default=str)}\n\n"
@@ -0,0 +1,128 @@
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import instrumentation
+
+# Job status is persisted so any Cloud Run instance can answer a poll.
+JOBS_COLLECTION = 'export_jobs'
+ACTIVE_STATUSES = ['queued', 'running']
+# A queued/running job that has not reported progress for this long is
+# considered dead (instance recycled mid-export) and no longer blocks new runs.
+STALE_AFTER = timedelta(minutes=30)
+# While the export runs, updated_at is refreshed this often even when no load
+# job finishes (the final MERGE can take longer than STALE_AFTER).
+HEARTBEAT_SECONDS = 60
+
+
+class ExportAlreadyRunning(Exception):
+    def __init__(self, job_id):
+        super().__init__(f"Export {job_id} is already running")
+        self.job_id = job_id
+
+
+class ExportJobs:
+    """
+    Runs BigQuery exports on a single background thread so request threads
+    return immediately, and refuses to start a second export while one is active.
+    """
+
+    def __init__(self, db, sync_fn):
+        self._db = db
+        self._sync_fn = sync_fn
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bq-export')
+        self._lock = threading.Lock()
+
+    def _ref(self, job_id):
+        return self._db.collection(JOBS_COLLECTION).document(job_id)
+
+    def _update(self, job_id, fields):
+        fields['updated_at'] = datetime.now(timezone.utc)
+        self._ref(job_id).set(fields, merge=True)
+
+    def _active_job_id(self):
+        cutoff = datetime.now(timezone.utc) - STALE_AFTER
+        docs = (self._db.collection(JOBS_COLLECTION)
+                .where('status', 'in', ACTIVE_STATUSES)
+                .stream())
+        for doc in docs:
+            if doc.to_dict().get('updated_at', cutoff) > cutoff:
+                return doc.id
+        return None
+
+    def start(self, full=False):
+        """Enqueues an export and returns its job id."""
+        with self._lock:
+            active = self._active_job_id()
+            if active:
+                raise ExportAlreadyRunning(active)
+            job_id = uuid.uuid4().hex
+            self._update(job_id, {
+                'status': 'queued',
+                'full': full,
+                'rows': 0,
+                'load_jobs': 0,
+                'created_at': datetime.now(timezone.utc),
+            })
+        self._executor.submit(self._run, job_id, full)
+        return job_id
+
+    def _run(self, job_id, full):
+        started = time.perf_counter()
+        self._update(job_id, {'status': 'running', 'started_at': datetime.now(timezone.utc)})
+
+        def progress(rows, jobs):
+            self._update(job_id, {
+                'rows': rows,
+                'load_jobs': jobs,
+                'elapsed': round(time.perf_counter() - started, 2),
+            })
+
+        finished = threading.Event()
+
+        def heartbeat():
+            # Only elapsed/updated_at: a beat that lands after the final update changes no status
+            while not finished.wait(HEARTBEAT_SECONDS):
+                try:
+                    self._update(job_id, {'elapsed': round(time.perf_counter() - started, 2)})
+                except Exception:
+                    instrumentation.log_exception("Error actualizando exportación", job_id=job_id)
+
+        threading.Thread(target=heartbeat, name='bq-export-heartbeat', daemon=True).start()
+        try:
+            stats = self._sync_fn(full=full, progress=progress)
+            self._update(job_id, {
+                'status': 'success',
+                'rows': stats['rows'],
+                'load_jobs': stats['load_jobs'],
+                'mode': stats['mode'],
+                'stats': stats,
+                'elapsed': round(time.perf_counter() - started, 2),
+                'finished_at': datetime.now(timezone.utc),
+            })
+        except Exception as e:
+            instrumentation.log_exception("Error en exportación", job_id=job_id)
+            self._update(job_id, {
+                'status': 'error',
+                'error': str(e),
+                'elapsed': round(time.perf_counter() - started, 2),
+                'finished_at': datetime.now(timezone.utc),
+            })
+        finally:
+            finished.set()
+
+    def get(self, job_id):
+        """Returns the job status as a JSON-friendly dict, or None."""
+        doc = self._ref(job_id).get()
+        if not doc.exists:
+            return None
+        job = doc.to_dict()
+        job['id'] = job_id
+        if job['status'] == 'running' and job.get('started_at'):
+            job['elapsed'] = round((datetime.now(timezone.utc) - job['started_at']).total_seconds(), 2)
+        for key, value in job.items():
+            if isinstance(value, datetime):
+                job[key] = value.isoformat()
+        return job
@@ -0,0 +1,154 @@
+"""
+Local cache of receipt extraction results.
+
+Results are keyed by a SHA-256 of the preprocessed JPEG bytes plus the model
+id and prompt version, so a receipt that was already scanned comes back
+without a Vertex AI call. Each entry also stores a 64-bit difference hash
+(dHash) of the image; photos of the same receipt taken twice land within a
+few bits of each other, which lets callers flag likely duplicate submissions.
+
+Entries live in a SQLite file with size-based LRU eviction.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import cv2
+import numpy as np
+
+CACHE_PATH = os.environ.get(
+    'RECEIPT_CACHE_PATH',
+    os.path.join(os.path.expanduser('~'), '.cache', 'receipt_scanner', 'extractions.sqlite3'))
+MAX_BYTES = int(os.environ.get('RECEIPT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Max differing bits for two hashes to count as the same receipt. The hash is
+# split into 8 one-byte bands: two hashes within 7 bits share at least one
+# band exactly, so near-duplicate lookups only scan rows matching a band.
+NEAR_DUPLICATE_BITS = 6
+BANDS = 8
+ROW_OVERHEAD = 128  # rough per-row bytes on top of the stored JSON
+
+
+def dhash(image_bytes):
+    """64-bit difference hash of an encoded image."""
+    gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("Could not decode image")
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _bands(value):
+    return [(value >> (8 * i)) & 0xFF for i in range(BANDS)]
+
+
+def _signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class ExtractionCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        band_columns = ", ".join(f"b{i} INTEGER" for i in range(BANDS))
+        with self._conn:
+            self._conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS extractions (
+                    key TEXT PRIMARY KEY,
+                    phash INTEGER NOT NULL,
+                    {band_columns},
+                    result TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON extractions (last_access)")
+            for i in range(BANDS):
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_b{i} ON extractions (b{i})")
+        # Running total of the row sizes, so store() does not sum the table on every insert.
+        # Other processes sharing the file are not seen here: it is re-synced before evicting.
+        self._total = self._sum_sizes()
+
+    def _sum_sizes(self):
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+
+    @staticmethod
+    def make_key(image_bytes, model_id, prompt_version):
+        digest = hashlib.sha256()
+        digest.update(f"{model_id}|{prompt_version}|".encode('utf-8'))
+        digest.update(image_bytes)
+        return digest.hexdigest()
+
+    def lookup(self, image_bytes, model_id, prompt_version):
+        """
+        Returns a dict with the cache key, the image hash, the cached result
+        ('data', None on a miss) and the closest near-duplicate entry
+        ('similar': {key, distance, data} or None).
+        """
+        key = self.make_key(image_bytes, model_id, prompt_version)
+        phash = dhash(image_bytes)
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM extractions WHERE key = ?", (key,)).fetchone()
+            if row:
+                with self._conn:
+                    self._conn.execute("UPDATE extractions SET last_access = ? WHERE key = ?", (time.time(), key))
+                return {"key": key, "phash": phash, "data": json.loads(row[0]), "similar": None}
+
+            where = " OR ".join(f"b{i} = ?" for i in range(BANDS))
+            candidates = self._conn.execute(
+                f"SELECT key, phash, result FROM extractions WHERE {where}", _bands(phash)).fetchall()
+
+        similar = None
+        for other_key, other_hash, result in candidates:
+            distance = bin(phash ^ _unsigned(other_hash)).count('1')
+            if distance <= NEAR_DUPLICATE_BITS and (similar is None or distance < similar["distance"]):
+                similar = {"key": other_key, "distance": distance, "data": json.loads(result)}
+        return {"key": key, "phash": phash, "data": None, "similar": similar}
+
+    def store(self, lookup, data):
+        """Saves a result for a previous lookup() miss and evicts the least recently used rows over max_bytes."""
+        result = json.dumps(data)
+        size = len(result) + ROW_OVERHEAD
+        band_columns = ", ".join(f"b{i}" for i in range(BANDS))
+        placeholders = ", ".join("?" for _ in range(BANDS))
+        with self._lock, self._conn:
+            replaced = self._conn.execute(
+                "SELECT size FROM extractions WHERE key = ?", (lookup["key"],)).fetchone()
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO extractions (key, phash, {band_columns}, result, size, last_access) "
+                f"VALUES (?, ?, {placeholders}, ?, ?, ?)",
+                (lookup["key"], _signed(lookup["phash"]), *_bands(lookup["phash"]), result, size, time.time()))
+            self._total += size - (replaced[0] if replaced else 0)
+            if self._total <= self.max_bytes:
+                return
+            total = self._sum_sizes()
+            while total > self.max_bytes:
+                oldest = self._conn.execute(
+                    "SELECT key, size FROM extractions ORDER BY last_access LIMIT 100").fetchall()
+                if not oldest:
+                    break
+                for old_key, old_size in oldest:
+                    self._conn.execute("DELETE FROM extractions WHERE key = ?", (old_key,))
+                    total -= old_size
+                    if total <= self.max_bytes:
+                        break
+            self._total = total
+
+    def stats(self):
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions").fetchone()
+        return {"entries": count, "bytes": total, "max_bytes": self.max_bytes}
@@ -0,0 +1,67 @@
+"""
+Shared Google Cloud clients, created on first use.
+
+Building a client means importing its library, discovering credentials and
+setting up channels, which used to happen at import time in every module
+and process. Here each client is created once per process, the first time
+something actually calls it. `firestore_db` and `bigquery_client` are
+stand-ins that modules can keep at module level as `db` / `bq_client`.
+"""
+import threading
+
+PROJECT_ID = 'surfn-peru'
+DATABASE_ID = 'expenses'
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def get_firestore():
+    def create():
+        from google.cloud import firestore
+        import instrumentation
+        # Reads/writes per request and in /metrics
+        return instrumentation.count_firestore(firestore.Client(project=PROJECT_ID, database=DATABASE_ID))
+    return _get('firestore', create)
+
+
+def get_firestore_async():
+    """firestore.AsyncClient for asgi.py. Create it from inside the event loop that will use it."""
+    def create():
+        from google.cloud import firestore
+        return firestore.AsyncClient(project=PROJECT_ID, database=DATABASE_ID)
+    return _get('firestore_async', create)
+
+
+def get_bigquery():
+    def create():
+        from google.cloud import bigquery
+        return bigquery.Client(project=PROJECT_ID)
+    return _get('bigquery', create)
+
+
+class LazyClient:
+    """Forwards every attribute to the shared client, creating it on first access."""
+
+    def __init__(self, getter):
+        self._getter = getter
+
+    def __getattr__(self, name):
+        return getattr(self._getter(), name)
+
+    def __repr__(self):
+        return f"<LazyClient {self._getter.__name__}>"
+
+
+firestore_db = LazyClient(get_firestore)
+bigquery_client = LazyClient(get_bigquery)
@@ -1,30 +1,261 @@
+"""
+Bulk import of JSON, JSONL or CSV files into a Firestore collection.
+
+Records are read one at a time (a JSON array is stream-parsed, never loaded
+whole) and written through Firestore's BulkWriter, which batches, sends in
+parallel, throttles and retries on its own. Progress is checkpointed every
+CHECKPOINT_EVERY records, so rerunning the same command after a failure
+picks up where it stopped. Writes that still fail after MAX_ATTEMPTS are
+saved to <file>.failed.jsonl for a later rerun, and so are CSV rows whose
+monto cannot be read as a number.
+
+Importing into 'expenses' also writes the search index and duplicate index
+entries and updates the monthly rollups, like POST /api/expenses does.
+Imported expenses are not checked for duplicates (`python dedup.py --scan`
+reports them afterwards).
+
+Usage:
+    python import_json.py [file] [--collection clients] [--id-field id]
+        [--format json|jsonl|csv] [--restart]
+"""
+import os
+import re
+import csv
+import sys
 import json
+import time
+import hashlib
+import argparse
+import threading
 from google.cloud import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+
+import search_index
+import rollups
+import dedup
+from expense_fields import parse_monto
+from gcp_clients import firestore_db
 
 PROJECT_ID = 'surfn-peru'
 
 # FirestoreConfiguration
 COLLECTION_NAME = 'clients'
 DATABASE_ID = 'expenses'
-db = firestore.Client(project=PROJECT_ID, database=DATABASE_ID)
-
-def import_json():
-    with open('uib-clientes.json', 'r') as f:
-        data = json.load(f)
-
-    print(f"Importing {len(data)} documents...")
-    
-    # Use a batch for efficiency (Firestore allows up to 500 writes per batch)
-    batch = db.batch()
-    
-    for item in data:
-        # Using the 'id' from your JSON as the Document ID
-        doc_id = str(item['id'])
-        doc_ref = db.collection(COLLECTION_NAME).document(doc_id)
-        batch.set(doc_ref, item)
-
-    batch.commit()
-    print("✅ Import complete.")
+db = firestore_db
+
+DEFAULT_FILE = 'uib-clientes.json'
+# Field used as document id per collection; None = ids derived from the file
+# and record number, so a resumed run rewrites the same documents
+DEFAULT_ID_FIELDS = {'clients': 'id', 'categories': 'name', 'users': 'username', 'expenses': None}
+# CSV values are strings; these fields are converted to float (parse_monto)
+FLOAT_FIELDS = {'expenses': ['monto']}
+CHECKPOINT_EVERY = 5000
+MAX_ATTEMPTS = 5
+MAX_OPS_PER_SECOND = 2000  # BulkWriter ramps up from 500 ops/s towards this (500/50/5 rule)
+READ_SIZE = 1 << 16
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_json_array(f):
+    """Yields the items of a top-level JSON array without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buffer = f.read(READ_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("Expected a JSON array")
+    pos = 1
+    eof = False
+    while True:
+        pos = _SEPARATORS.match(buffer, pos).end()
+        if buffer.startswith(']', pos):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+            # A number at the very end of the buffer may continue in the next read
+            if end == len(buffer) and not eof:
+                raise json.JSONDecodeError("Incomplete item", buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more = f.read(READ_SIZE)
+            eof = not more
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+        yield item
+        pos = end
+
+
+def iter_records(path, fmt=None, float_fields=()):
+    """
+    (record, error) pairs of a .json (array), .jsonl/.ndjson or .csv file,
+    streamed. error is None unless a CSV float field cannot be read.
+    """
+    fmt = fmt or {'.jsonl': 'jsonl', '.ndjson': 'jsonl', '.csv': 'csv'}.get(
+        os.path.splitext(path)[1].lower(), 'json')
+    with open(path, 'r', encoding='utf-8', newline='' if fmt == 'csv' else None) as f:
+        if fmt == 'json':
+            for item in iter_json_array(f):
+                yield item, None
+        elif fmt == 'jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line), None
+        else:
+            for row in csv.DictReader(f):
+                error = None
+                for field in float_fields:
+                    if row.get(field):
+                        value = parse_monto(row[field])
+                        if value is None:
+                            error = f"{field} is not a number: {row[field]!r}"
+                        else:
+                            row[field] = value
+                yield row, error
+
+
+def source_id(path):
+    """Short fingerprint of a file (size + first block), stable across reruns."""
+    digest = hashlib.sha1(str(os.path.getsize(path)).encode('utf-8'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(READ_SIZE))
+    return digest.hexdigest()[:10]
+
+
+def checkpoint_path(path, collection):
+    return f"{path}.{collection}.checkpoint"
+
+
+def load_checkpoint(path, collection):
+    try:
+        with open(checkpoint_path(path, collection)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"done": 0, "failed": 0}
+
+
+def save_checkpoint(path, collection, state):
+    # Write-then-rename so an interrupted save never leaves a corrupt checkpoint
+    target = checkpoint_path(path, collection)
+    with open(target + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(target + '.tmp', target)
+
+
+def import_json(path=DEFAULT_FILE, collection=COLLECTION_NAME, id_field='', fmt=None, restart=False):
+    """
+    Imports every record of `path` into `collection` and returns stats:
+    docs, skipped (already done in a previous run), failed, retries, seconds
+    and docs_per_sec. id_field '' uses the collection default; None forces
+    ids derived from the file and record number.
+    """
+    if id_field == '':
+        id_field = DEFAULT_ID_FIELDS.get(collection, 'id')
+    is_expenses = collection == rollups.EXPENSES_COLLECTION
+    state = {"done": 0, "failed": 0} if restart else load_checkpoint(path, collection)
+    skip = state["done"]
+    if skip:
+        print(f"Resuming after {skip} records (checkpoint {checkpoint_path(path, collection)})")
+
+    source = source_id(path)
+    lock = threading.Lock()
+    retries = 0
+    failures = []
+    # Expenses count in the rollups only once their write succeeded; the ones
+    # that end in failed.jsonl leave them untouched
+    pending = {}  # document path -> record, until its write succeeds or gives up
+    deltas = {}
+
+    def on_result(reference, result, bulk_writer):
+        with lock:
+            item = pending.pop(reference.path, None)
+            if item is not None:
+                rollups.accumulate(deltas, item, 1)
+
+    def on_error(failure, bulk_writer):
+        nonlocal retries
+        with lock:
+            if failure.attempts < MAX_ATTEMPTS:
+                retries += 1
+                return True
+            pending.pop(failure.operation.reference.path, None)
+            failures.append({"path": failure.operation.reference.path, "code": failure.code,
+                             "message": failure.message, "data": failure.operation.document_data})
+            return False
+
+    writer = db.bulk_writer(options=BulkWriterOptions(max_ops_per_second=MAX_OPS_PER_SECOND))
+    writer.on_write_result(on_result)
+    writer.on_write_error(on_error)
+
+    def checkpoint(done):
+        writer.flush()
+        if failures:
+            with open(f"{path}.failed.jsonl", 'a') as f:
+                for failure in failures:
+                    f.write(json.dumps(failure, default=str) + "\n")
+            state["failed"] += len(failures)
+            failures.clear()
+        state["done"] = done
+        save_checkpoint(path, collection, state)
+        # Rollups only after the checkpoint: a crash in between leaves them short
+        # (rollups.py --rebuild fixes it) instead of counting a resumed range twice
+        if deltas:
+            rollups.apply(db, deltas)
+            deltas.clear()
+
+    print(f"Importing {path} into '{collection}'...")
+    started = time.perf_counter()
+    count = 0
+    for count, (item, error) in enumerate(iter_records(path, fmt, FLOAT_FIELDS.get(collection, ())), 1):
+        if count <= skip:
+            continue
+        if error:
+            with lock:
+                failures.append({"record": count, "message": error, "data": item})
+            continue
+        if id_field:
+            doc_ref = db.collection(collection).document(str(item[id_field]))
+        else:
+            doc_ref = db.collection(collection).document(f"import-{source}-{count}")
+        if is_expenses:
+            item.setdefault('actualizado_en', firestore.SERVER_TIMESTAMP)
+            search_index.index_expense(writer, db, doc_ref.id, item)
+            dedup.index_expense(writer, db, doc_ref.id, item)
+            with lock:
+                pending[doc_ref.path] = item
+        writer.set(doc_ref, item)
+
+        if count % CHECKPOINT_EVERY == 0:
+            checkpoint(count)
+            elapsed = time.perf_counter() - started
+            print(f"{count} records, {(count - skip) / elapsed:.0f} docs/sec, {retries} retries")
+
+    checkpoint(count)
+    writer.close()
+    seconds = time.perf_counter() - started
+    stats = {
+        "docs": count - skip,
+        "skipped": min(skip, count),
+        "failed": state["failed"],
+        "retries": retries,
+        "seconds": round(seconds, 2),
+        "docs_per_sec": round((count - skip) / seconds, 1) if seconds else 0.0,
+    }
+    print(f"✅ Import complete: {json.dumps(stats)}")
+    if state["failed"]:
+        print(f"Failed records saved to {path}.failed.jsonl")
+    return stats
+
 
 if __name__ == "__main__":
-    import_json()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Bulk import into Firestore")
+    parser.add_argument("file", nargs="?", default=DEFAULT_FILE)
+    parser.add_argument("--collection", default=COLLECTION_NAME)
+    parser.add_argument("--id-field", default='',
+                        help="Field used as document id (default depends on the collection; 'none' = file + record number)")
+    parser.add_argument("--format", choices=["json", "jsonl", "csv"], help="Default: from the file extension")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and import from the start")
+    args = parser.parse_args()
+
+    id_field = None if args.id_field.lower() == 'none' else args.id_field
+    stats = import_json(args.file, args.collection, id_field, args.format, args.restart)
+    sys.exit(1 if stats["failed"] else 0)
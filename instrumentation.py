@@ -0,0 +1,367 @@
+"""
+Request instrumentation: latency histograms per route, Firestore reads and
+writes per request, timing spans, structured logs, /metrics and an opt-in
+sampling profiler.
+
+- Firestore accounting wraps the RPC layer of the shared client
+  (count_firestore(), called by gcp_clients), so every module's queries,
+  gets, batches, transactions and BulkWriter writes are counted without
+  proxying the query API. Reads are documents returned; writes are
+  documents in each commit / batch_write.
+- init_app() times every Flask request and logs one JSON line per request
+  (route, status, latency, Firestore reads/writes) in the format Cloud
+  Logging parses from stdout; responses with status >= 500 are logged at
+  ERROR with their message.
+- span(name) times a block (BigQuery sync, receipt extraction, ...) into
+  the same registry and logs it.
+- render_metrics() is the Prometheus text exposition served at /metrics.
+  Counters are per process (per Cloud Run instance).
+- Profiler samples every thread's stack every PROFILER_INTERVAL seconds
+  into collapsed stacks (flamegraph.pl / speedscope input). Off unless
+  PROFILER=1 or started through /api/profiler/start, and stops by itself
+  after PROFILER_MAX_SECONDS.
+"""
+import os
+import sys
+import json
+import time
+import bisect
+import traceback
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+PROJECT_ID = 'surfn-peru'
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') == '1'
+PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL', 0.01))
+PROFILER_MAX_STACKS = 5000
+PROFILER_MAX_SECONDS = 300  # a forgotten profiler stops by itself
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+READS_BUCKETS = [0, 1, 5, 10, 50, 100, 500, 1000, 5000]
+
+
+def log(severity, message, **fields):
+    """One structured log line on stdout (Cloud Logging reads severity/message/httpRequest)."""
+    entry = {"severity": severity, "message": message,
+             "time": datetime.now(timezone.utc).isoformat(), **fields}
+    print(json.dumps(entry, default=str), flush=True)
+
+
+def log_exception(context, **fields):
+    """ERROR line with the current exception and its traceback (picked up by Error Reporting)."""
+    log("ERROR", f"{context}: {traceback.format_exc()}", **fields)
+
+
+# --- Metrics registry ---
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, labels):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.labels = labels
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        for label_values, series in sorted(items):
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], series[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{{{_labels(self.labels, label_values)}}} {value}")
+        return lines
+
+
+def _labels(names, values):
+    return ",".join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in zip(names, values))
+
+
+request_seconds = Histogram("http_request_duration_seconds", "Request latency by route",
+                            LATENCY_BUCKETS, ["method", "route", "status"])
+request_reads = Histogram("firestore_reads_per_request", "Firestore documents read per request",
+                          READS_BUCKETS, ["route"])
+firestore_calls = Counter("firestore_rpcs_total", "Firestore RPCs by method", ["method"])
+firestore_docs = Counter("firestore_documents_total", "Firestore documents read or written", ["kind"])
+span_seconds = Histogram("span_duration_seconds", "Duration of instrumented operations",
+                         LATENCY_BUCKETS, ["span", "outcome"])
+
+METRICS = [request_seconds, request_reads, firestore_calls, firestore_docs, span_seconds]
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Firestore accounting ---
+
+class RequestCounts:
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.rpcs = 0
+
+
+_current = contextvars.ContextVar('firestore_request_counts', default=None)
+
+
+def _count(method, reads=0, writes=0):
+    firestore_calls.inc(1, method)
+    if reads:
+        firestore_docs.inc(reads, "read")
+    if writes:
+        firestore_docs.inc(writes, "write")
+    counts = _current.get()
+    if counts is not None:
+        counts.rpcs += 1
+        counts.reads += reads
+        counts.writes += writes
+
+
+def _writes_in(kwargs, args):
+    request = kwargs.get('request', args[0] if args else None)
+    if isinstance(request, dict):
+        return len(request.get('writes') or [])
+    return len(getattr(request, 'writes', None) or [])
+
+
+class CountingFirestoreApi:
+    """Stands in for a Client's GAPIC API object and counts what goes through it."""
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        return getattr(self._api, name)
+
+    def run_query(self, *args, **kwargs):
+        # Query.stream() only needs an iterator; count documents as they arrive
+        responses = self._api.run_query(*args, **kwargs)
+        _count("run_query")
+        for response in responses:
+            if 'document' in response:
+                _count_read()
+            yield response
+
+    def batch_get_documents(self, *args, **kwargs):
+        responses = self._api.batch_get_documents(*args, **kwargs)
+        _count("batch_get_documents")
+        for response in responses:
+            if 'found' in response:
+                _count_read()
+            yield response
+
+    def run_aggregation_query(self, *args, **kwargs):
+        _count("run_aggregation_query", reads=1)  # billed as one read per 1000 index entries
+        return self._api.run_aggregation_query(*args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        _count("commit", writes=_writes_in(kwargs, args))
+        return self._api.commit(*args, **kwargs)
+
+    def batch_write(self, *args, **kwargs):
+        _count("batch_write", writes=_writes_in(kwargs, args))
+        return self._api.batch_write(*args, **kwargs)
+
+
+def _count_read():
+    firestore_docs.inc(1, "read")
+    counts = _current.get()
+    if counts is not None:
+        counts.reads += 1
+
+
+def count_firestore(client):
+    """Installs the counting wrapper on a firestore.Client; returns the client."""
+    client._firestore_api_internal = CountingFirestoreApi(client._firestore_api)
+    return client
+
+
+# --- Spans ---
+
+@contextmanager
+def span(name, **fields):
+    """Times the block into span_duration_seconds and logs it."""
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        span_seconds.observe(seconds, name, outcome)
+        log("INFO" if outcome == "ok" else "ERROR", f"{name} {outcome} in {seconds:.3f}s",
+            span=name, seconds=round(seconds, 4), outcome=outcome, **fields)
+
+
+# --- Sampling profiler ---
+
+class Profiler:
+    """Collapsed stacks of every thread, sampled by a background thread."""
+
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self._stacks = {}
+        self._samples = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.started_at = None
+        self._deadline = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds=PROFILER_MAX_SECONDS):
+        """Starts sampling for at most `seconds`; False if it was already running."""
+        with self._lock:
+            if self.running:
+                return False
+            self._stacks = {}
+            self._samples = 0
+            self._stop.clear()
+            self.started_at = time.time()
+            self._deadline = time.monotonic() + min(seconds, PROFILER_MAX_SECONDS)
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval) and time.monotonic() < self._deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                with self._lock:
+                    if key in self._stacks or len(self._stacks) < PROFILER_MAX_STACKS:
+                        self._stacks[key] = self._stacks.get(key, 0) + 1
+            self._samples += 1
+
+    def collapsed(self):
+        """'frame;frame;frame count' lines, most sampled first."""
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: item[1], reverse=True)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def status(self):
+        return {"running": self.running, "interval": self.interval, "samples": self._samples,
+                "stacks": len(self._stacks), "started_at": self.started_at}
+
+
+profiler = Profiler()
+
+
+# --- Flask integration ---
+
+def init_app(app):
+    from flask import g, request
+
+    @app.before_request
+    def start_request():
+        g.instrumentation_started = time.perf_counter()
+        g.instrumentation_counts = RequestCounts()
+        g.instrumentation_token = _current.set(g.instrumentation_counts)
+
+    @app.after_request
+    def finish_request(response):
+        started = g.pop('instrumentation_started', None)
+        if started is None:
+            return response
+        seconds = time.perf_counter() - started
+        counts = g.instrumentation_counts
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        request_seconds.observe(seconds, request.method, route, response.status_code)
+        request_reads.observe(counts.reads, route)
+
+        if REQUEST_LOG or response.status_code >= 500:
+            fields = {
+                "httpRequest": {
+                    "requestMethod": request.method,
+                    "requestUrl": request.path,
+                    "status": response.status_code,
+                    "latency": f"{seconds:.4f}s",
+                    "userAgent": request.user_agent.string,
+                    "remoteIp": request.headers.get('X-Forwarded-For', request.remote_addr),
+                },
+                "route": route,
+                "firestore": {"reads": counts.reads, "writes": counts.writes, "rpcs": counts.rpcs},
+            }
+            trace = request.headers.get('X-Cloud-Trace-Context')
+            if trace:
+                fields["logging.googleapis.com/trace"] = f"projects/{PROJECT_ID}/traces/{trace.split('/')[0]}"
+            message = f"{request.method} {request.path} {response.status_code}"
+            severity = "INFO"
+            if response.status_code >= 500:
+                severity = "ERROR"
+                if response.is_json and not response.is_streamed:
+                    message += f": {(response.get_json(silent=True) or {}).get('message')}"
+            log(severity, message, **fields)
+        return response
+
+    @app.teardown_request
+    def reset_counts(exc):
+        token = g.pop('instrumentation_token', None)
+        if token is not None:
+            _current.reset(token)
+
+    if os.environ.get('PROFILER') == '1':
+        profiler.start()
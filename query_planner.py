@@ -0,0 +1,318 @@
+"""
+Query planner for GET /api/expenses.
+
+Every combination of equality filters (ejecutivo, categoria, cliente) plus
+the fecha order needs its own Firestore composite index, and a query whose
+index is missing fails. Instead of sending every filter to Firestore, the
+planner pushes down only the indexed combination that is expected to match
+the fewest documents and checks the remaining filters in memory while
+streaming results, reading at most MAX_SCAN documents per page.
+
+The module is split so other callers (e.g. an async handler) can reuse it:
+plan() is pure, build_query() turns a plan into a Firestore query for any
+collection reference, matches() is the in-memory filter, and execute() runs
+the whole thing with the synchronous client (execute_async() with
+firestore.AsyncClient, for asgi.py).
+
+Usage:
+    python query_planner.py --indexes > firestore.indexes.json
+"""
+import sys
+import json
+import time
+import threading
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from ref_cache import TTLCache
+import instrumentation
+import rollups
+
+EXPENSES_COLLECTION = 'expenses'
+EQUALITY_FIELDS = ['ejecutivo', 'categoria', 'cliente']
+# Equality combinations backed by a composite index (fields..., fecha DESC).
+# () only needs the single-field fecha index, so it always works.
+INDEXED_COMBINATIONS = [
+    (),
+    ('ejecutivo',),
+    ('categoria',),
+    ('cliente',),
+    ('ejecutivo', 'categoria'),
+    ('ejecutivo', 'cliente'),
+]
+# Indexes defined by search_index.py and rollups.py, kept here so
+# firestore.indexes.json describes the whole database
+OTHER_INDEXES = [
+    {"collectionGroup": "expenses_search", "queryScope": "COLLECTION", "fields": [
+        {"fieldPath": "terms", "arrayConfig": "CONTAINS"},
+        {"fieldPath": "fecha", "order": "DESCENDING"}]},
+    {"collectionGroup": "expenses_search", "queryScope": "COLLECTION", "fields": [
+        {"fieldPath": "ejecutivo", "order": "ASCENDING"},
+        {"fieldPath": "terms", "arrayConfig": "CONTAINS"},
+        {"fieldPath": "fecha", "order": "DESCENDING"}]},
+    {"collectionGroup": "expense_rollups", "queryScope": "COLLECTION", "fields": [
+        {"fieldPath": "dimension", "order": "ASCENDING"},
+        {"fieldPath": "period", "order": "ASCENDING"}]},
+]
+
+MAX_SCAN = 1000          # documents read per page at most; a short page still returns a cursor
+MAX_FETCH = 400          # documents per Firestore round trip
+DEFAULT_SELECTIVITY = 0.1  # fraction matching a filter when rollups have no count for it
+ESTIMATE_TTL = 600
+
+_estimates = TTLCache(ttl=ESTIMATE_TTL, maxsize=512)
+
+
+class Plan:
+    """
+    Equality filters sent to Firestore (pushdown) and checked in memory
+    (residual), both {field: value}; the fecha range is always pushed down.
+    """
+
+    def __init__(self, pushdown, residual, date_from=None, date_to=None, selectivity=1.0):
+        self.pushdown = pushdown
+        self.residual = residual
+        self.date_from = date_from
+        self.date_to = date_to
+        self.selectivity = selectivity
+
+    @property
+    def combination(self):
+        return tuple(self.pushdown)
+
+    @property
+    def key(self):
+        return '+'.join(list(self.pushdown) + ['fecha']) + (
+            ' | ' + '+'.join(sorted(self.residual)) if self.residual else '')
+
+    def fetch_size(self, page_size):
+        """Documents to request per round trip: enough to fill a page at the expected selectivity."""
+        return int(min(MAX_FETCH, max(page_size, page_size / max(self.selectivity, 1e-3))))
+
+
+def estimate_count(db, field, value):
+    """Number of expenses with field == value, from the rollups (cached). None if unknown."""
+    def load():
+        buckets = db.collection(rollups.ROLLUPS_COLLECTION) \
+            .where('dimension', '==', field).where('key', '==', str(value)).stream()
+        counts = [bucket.to_dict().get('count', 0) for bucket in buckets]
+        return sum(counts) if counts else None  # no rollups for the value: unknown, not 0
+    try:
+        return _estimates.get(f"{field}={value}", load)[0]
+    except Exception:
+        instrumentation.log_exception("Error estimating count", field=field, value=value)
+        return None
+
+
+async def estimate_count_async(db, field, value):
+    """estimate_count() with an AsyncClient; shares the same cache."""
+    async def load():
+        buckets = db.collection(rollups.ROLLUPS_COLLECTION) \
+            .where('dimension', '==', field).where('key', '==', str(value)).stream()
+        counts = [bucket.to_dict().get('count', 0) async for bucket in buckets]
+        return sum(counts) if counts else None
+    try:
+        return (await _estimates.aget(f"{field}={value}", load))[0]
+    except Exception:
+        instrumentation.log_exception("Error estimating count", field=field, value=value)
+        return None
+
+
+def plan(filters, counts=None, total=None, exclude=()):
+    """
+    Chooses the pushdown for `filters` ({field: value}, plus optional
+    date_from/date_to). counts ({field: estimated matches}) and total
+    (collection size) rank the candidates; without them the plan with the
+    most pushed-down filters wins. `exclude` lists combinations known to fail.
+    """
+    equality = {f: filters[f] for f in EQUALITY_FIELDS if filters.get(f) is not None}
+    counts = counts or {}
+
+    def score(combo):
+        # Fewest estimated matches first (an AND matches at most its smallest
+        # filter), then the most filters pushed down
+        known = [counts[f] for f in combo if counts.get(f) is not None]
+        return (min(known) if known else float('inf'), -len(combo))
+
+    candidates = [combo for combo in INDEXED_COMBINATIONS
+                  if combo not in exclude and all(f in equality for f in combo)]
+    best = min(candidates, key=score)
+
+    residual = {f: v for f, v in equality.items() if f not in best}
+    selectivity = 1.0
+    for field in residual:
+        if total and counts.get(field) is not None:
+            # Chance that a pushed-down match also passes this filter (independence assumed)
+            selectivity *= min(1.0, counts[field] / total)
+        else:
+            selectivity *= DEFAULT_SELECTIVITY
+    return Plan({f: equality[f] for f in best}, residual,
+                filters.get('date_from'), filters.get('date_to'), selectivity)
+
+
+def build_query(collection_ref, query_plan, cursor=None, limit=None):
+    """Firestore query for a plan, newest first by (fecha, id), starting after cursor (fecha, id)."""
+    query = collection_ref
+    for field, value in query_plan.pushdown.items():
+        query = query.where(field, '==', value)
+    if query_plan.date_from:
+        query = query.where('fecha', '>=', query_plan.date_from)
+    if query_plan.date_to:
+        query = query.where('fecha', '<=', query_plan.date_to)
+    query = query.order_by('fecha', direction=firestore.Query.DESCENDING)
+    query = query.order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+    if cursor:
+        query = query.start_after({'fecha': cursor[0], '__name__': cursor[1]})
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def matches(item, residual):
+    return all(item.get(field) == value for field, value in residual.items())
+
+
+class QueryStats:
+    """Per-plan counters: queries, documents read vs returned, latency, index fallbacks."""
+
+    def __init__(self):
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def record(self, plan_key, read, returned, seconds, fallback=False):
+        with self._lock:
+            s = self._plans.setdefault(plan_key, {
+                "queries": 0, "docs_read": 0, "docs_returned": 0, "seconds": 0.0,
+                "max_seconds": 0.0, "fallbacks": 0})
+            s["queries"] += 1
+            s["docs_read"] += read
+            s["docs_returned"] += returned
+            s["seconds"] += seconds
+            s["max_seconds"] = max(s["max_seconds"], seconds)
+            s["fallbacks"] += 1 if fallback else 0
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for plan_key, s in self._plans.items():
+                result[plan_key] = dict(
+                    s,
+                    seconds=round(s["seconds"], 3),
+                    max_seconds=round(s["max_seconds"], 3),
+                    avg_ms=round(1000 * s["seconds"] / s["queries"], 1),
+                    read_per_returned=round(s["docs_read"] / s["docs_returned"], 2) if s["docs_returned"] else None)
+            return result
+
+
+stats = QueryStats()
+_failed_combinations = set()  # composite indexes found missing at runtime
+
+
+def execute(db, filters, page_size, cursor=None, collection=EXPENSES_COLLECTION):
+    """
+    Returns (items, next cursor) for one page. items carry their 'id'. The
+    page can be shorter than page_size when MAX_SCAN documents were read
+    without filling it; the cursor then continues after the last one read.
+    """
+    started = time.perf_counter()
+    counts = {f: estimate_count(db, f, filters[f]) for f in EQUALITY_FIELDS if filters.get(f) is not None}
+    total = estimate_count(db, rollups.TOTAL_DIMENSION, 'all') if counts else None
+    query_plan = plan(filters, counts, total, exclude=_failed_combinations)
+    fallback = False
+    try:
+        items, next_cursor, read = _run(db.collection(collection), query_plan, page_size, cursor)
+    except FailedPrecondition as e:
+        query_plan = _fallback_plan(filters, query_plan, e)
+        fallback = True
+        items, next_cursor, read = _run(db.collection(collection), query_plan, page_size, cursor)
+    stats.record(query_plan.key, read, len(items), time.perf_counter() - started, fallback)
+    return items, next_cursor
+
+
+async def execute_async(db, filters, page_size, cursor=None, collection=EXPENSES_COLLECTION):
+    """execute() for firestore.AsyncClient: same plans, stats and index fallback."""
+    started = time.perf_counter()
+    counts = {f: await estimate_count_async(db, f, filters[f])
+              for f in EQUALITY_FIELDS if filters.get(f) is not None}
+    total = await estimate_count_async(db, rollups.TOTAL_DIMENSION, 'all') if counts else None
+    query_plan = plan(filters, counts, total, exclude=_failed_combinations)
+    fallback = False
+    try:
+        items, next_cursor, read = await _run_async(db.collection(collection), query_plan, page_size, cursor)
+    except FailedPrecondition as e:
+        query_plan = _fallback_plan(filters, query_plan, e)
+        fallback = True
+        items, next_cursor, read = await _run_async(db.collection(collection), query_plan, page_size, cursor)
+    stats.record(query_plan.key, read, len(items), time.perf_counter() - started, fallback)
+    return items, next_cursor
+
+
+def _fallback_plan(filters, failed_plan, error):
+    # Missing composite index: remember it and answer with the fecha-only plan
+    instrumentation.log("WARNING", f"Missing index for {failed_plan.key}, falling back: {error}",
+                        plan=failed_plan.key)
+    _failed_combinations.add(failed_plan.combination)
+    return plan(filters, exclude=[combo for combo in INDEXED_COMBINATIONS if combo])
+
+
+def _run(collection_ref, query_plan, page_size, cursor):
+    fetch = query_plan.fetch_size(page_size)
+    items = []
+    read = 0
+    while read < MAX_SCAN:
+        limit = min(fetch, MAX_SCAN - read)
+        docs = list(build_query(collection_ref, query_plan, cursor, limit).stream())
+        read += len(docs)
+        for doc in docs:
+            item = doc.to_dict()
+            cursor = (item.get('fecha'), doc.id)
+            if matches(item, query_plan.residual):
+                item['id'] = doc.id
+                items.append(item)
+                if len(items) == page_size:
+                    return items, cursor, read
+        if len(docs) < limit:
+            return items, None, read  # end of the collection
+    return items, cursor, read
+
+
+async def _run_async(collection_ref, query_plan, page_size, cursor):
+    # Same loop as _run(), reading each round trip from the async stream
+    fetch = query_plan.fetch_size(page_size)
+    items = []
+    read = 0
+    while read < MAX_SCAN:
+        limit = min(fetch, MAX_SCAN - read)
+        docs = [doc async for doc in build_query(collection_ref, query_plan, cursor, limit).stream()]
+        read += len(docs)
+        for doc in docs:
+            item = doc.to_dict()
+            cursor = (item.get('fecha'), doc.id)
+            if matches(item, query_plan.residual):
+                item['id'] = doc.id
+                items.append(item)
+                if len(items) == page_size:
+                    return items, cursor, read
+        if len(docs) < limit:
+            return items, None, read
+    return items, cursor, read
+
+
+def indexes_json():
+    """firestore.indexes.json contents for INDEXED_COMBINATIONS plus OTHER_INDEXES."""
+    indexes = []
+    for combo in INDEXED_COMBINATIONS:
+        if not combo:
+            continue
+        fields = [{"fieldPath": f, "order": "ASCENDING"} for f in combo]
+        fields.append({"fieldPath": "fecha", "order": "DESCENDING"})
+        indexes.append({"collectionGroup": EXPENSES_COLLECTION, "queryScope": "COLLECTION", "fields": fields})
+    return {"indexes": indexes + OTHER_INDEXES, "fieldOverrides": []}
+
+
+if __name__ == "__main__":
+    if '--indexes' not in sys.argv:
+        print("Usage: python query_planner.py --indexes > firestore.indexes.json")
+        sys.exit(1)
+    print(json.dumps(indexes_json(), indent=2))
@@ -2,11 +2,17 @@
 import os
 import sys
 import json
+import heapq
+import base64
+import datetime
+import threading
 import cv2
 import numpy as np
 from PIL import Image
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part, Image as VertexImage
+from vertexai.generative_models import GenerativeModel, GenerationConfig, Part, Image as VertexImage
+from extraction_cache import ExtractionCache
+import instrumentation
 
 # Configuration
 PROJECT_ID = "surfn-peru"  # Using existing project ID
@@ -15,27 +21,115 @@ LOCATION = "us-central1"   # Default location
 # We will use 'gemini-2.0-flash-exp' to honor the "latest/2.5" request as closely as possible.
 MODEL_ID = "gemini-2.5-flash" 
 
-# Initialize Vertex AI
-# This will automatically pick up Application Default Credentials (ADC)
-# from the environment (e.g., GOOGLE_APPLICATION_CREDENTIALS, gcloud auth, or metadata server)
-try:
-    vertexai.init(project=PROJECT_ID, location=LOCATION)
-except Exception as e:
-    print(f"Error initializing Vertex AI: {e}")
-    sys.exit(1)
+PROMPT = """
+    Analyze this receipt image. Extract the following information in JSON format:
+    - establishment: The name of the store or merchant.
+    - date: The date of the transaction (YYYY-MM-DD format).
+    - amount: The total amount paid (numeric).
+    
+    Return ONLY valid JSON. do not include markdown blocks like ```json ... ```
+    """
+# Part of the extraction cache key: bump it whenever PROMPT changes
+PROMPT_VERSION = "1"
+
+# Multi-receipt extraction (extract_batch): several receipts per request,
+# with the reply forced to JSON matching BATCH_RESPONSE_SCHEMA
+BATCH_PROMPT = """
+    Each image above is a receipt, preceded by its label "Receipt <index>:".
+    For every receipt return an object with:
+    - index: the number in the receipt's label.
+    - establishment: The name of the store or merchant.
+    - date: The date of the transaction (YYYY-MM-DD format), or null if unreadable.
+    - amount: The total amount paid (numeric), or null if unreadable.
+    """
+REASK_PROMPT = """
+    A previous answer for these receipts was rejected: {problems}.
+    Read them again carefully.
+    """
+BATCH_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "index": {"type": "INTEGER"},
+            "establishment": {"type": "STRING"},
+            "date": {"type": "STRING", "nullable": True},
+            "amount": {"type": "NUMBER", "nullable": True},
+        },
+        "required": ["index", "establishment", "date", "amount"],
+    },
+}
+BATCH_SIZE = int(os.environ.get("RECEIPT_BATCH_SIZE", 8))  # receipts per request
+MAX_REASKS = 1
+OLDEST_DATE = datetime.date(2000, 1, 1)
+
+# Fast preprocessing path (fast_crop_document / encode_jpeg_array)
+DETECT_MAX_SIDE = 800      # contour detection runs on a proxy no larger than this
+TOP_CONTOURS = 5           # only the largest few contours are tested for 4 corners
+OUTPUT_MAX_SIDE = 1600     # longest side of the image sent to the model
+JPEG_QUALITY = 85
+JPEG_MIN_QUALITY = 50
+MAX_JPEG_BYTES = 1024 * 1024
+
+# Local cache of extraction results (set RECEIPT_CACHE=0 to disable)
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None and os.environ.get("RECEIPT_CACHE", "1") != "0":
+        _cache = ExtractionCache()
+    return _cache
+
+# Vertex AI client and model, created once per process on first use
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """
+    Returns the shared GenerativeModel, initializing Vertex AI the first time.
+    """
+    global _model
+    with _model_lock:
+        if _model is None:
+            # Initialize Vertex AI
+            # This will automatically pick up Application Default Credentials (ADC)
+            # from the environment (e.g., GOOGLE_APPLICATION_CREDENTIALS, gcloud auth, or metadata server)
+            vertexai.init(project=PROJECT_ID, location=LOCATION)
+            _model = GenerativeModel(MODEL_ID)
+        return _model
+
+class ExtractionError(Exception):
+    """Vertex AI could not be called (as opposed to a receipt it could not read)."""
 
 def preprocess_image(image_path):
     """
     Loads an image, finds the document contour, chops off the background,
     and returns the processed image (as a PIL Image).
     """
-    print(f"Processing image: {image_path}")
-    
+    instrumentation.log("DEBUG", "Processing image", path=image_path)
+
     # Load image
     img = cv2.imread(image_path)
     if img is None:
         raise ValueError(f"Could not load image at {image_path}")
 
+    return crop_document(img)
+
+def preprocess_image_bytes(image_bytes):
+    """
+    Same as preprocess_image for an encoded image already in memory
+    (e.g. an upload), without touching the disk.
+    """
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+
+    return crop_document(img)
+
+def crop_document(img):
+    """
+    Finds the document contour in a BGR image and returns the crop as a PIL Image.
+    """
     # Convert to grayscale
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     
@@ -68,17 +162,17 @@ def preprocess_image(image_path):
     if receipt_contour is None and len(contours) > 0:
         x, y, w, h = cv2.boundingRect(contours[0])
         cropped = img[y:y+h, x:x+w]
-        print("No 4-point contour found, using largest bounding box.")
+        instrumentation.log("DEBUG", "No 4-point contour found, using largest bounding box")
         
     elif receipt_contour is not None:
         # 4-point transform logic could be added here for perspective correction
         # For now, let's just do a bounding rect crop of the contour to keep it simple and robust
         x, y, w, h = cv2.boundingRect(receipt_contour)
         cropped = img[y:y+h, x:x+w]
-        print("Document contour found, cropping.")
+        instrumentation.log("DEBUG", "Document contour found, cropping")
     else:
         # Fallback: return original if no contours found
-        print("No contours found, using original image.")
+        instrumentation.log("DEBUG", "No contours found, using original image")
         cropped = img
 
     # Convert back to PIL for consistency, but Vertex AI Image can take path or bytes
@@ -86,50 +180,340 @@ def preprocess_image(image_path):
     pil_image = Image.fromarray(cropped_rgb)
     return pil_image
 
-def extract_data(pil_image):
+def find_document_corners(img):
     """
-    Sends the image to Gemini 2.5 Flash (via Vertex AI) to extract data.
+    Detects the document on a downscaled copy of a BGR image. Returns
+    (corners, is_quad) in full-resolution coordinates: the 4 corners of the
+    document, or the bounding box of the largest contour when no 4-point
+    contour is found. Returns (None, False) if there are no contours at all.
     """
-    print(f"Sending to Vertex AI Model: {MODEL_ID}...")
-    
-    model = GenerativeModel(MODEL_ID)
+    height, width = img.shape[:2]
+    scale = min(1.0, DETECT_MAX_SIDE / max(height, width))
+    proxy = img
+    if scale < 1.0:
+        proxy = cv2.resize(img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
 
-    # Convert PIL image to Vertex Image
-    # Using a temporary buffer to avoid saving to disk if possible, or just re-save it temporarily
-    # Vertex Image.from_bytes requires bytes
+    gray = cv2.cvtColor(proxy, cv2.COLOR_BGR2GRAY)
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    edged = cv2.Canny(blurred, 75, 200)
+    # findContours no longer modifies its input (OpenCV >= 3.2), no copy needed
+    contours, _ = cv2.findContours(edged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None, False
+
+    # Partial top-k instead of sorting every contour by area
+    largest = heapq.nlargest(TOP_CONTOURS, contours, key=cv2.contourArea)
+    for c in largest:
+        peri = cv2.arcLength(c, True)
+        approx = cv2.approxPolyDP(c, 0.02 * peri, True)
+        if len(approx) == 4:
+            return approx.reshape(4, 2).astype(np.float32) / scale, True
+
+    x, y, w, h = cv2.boundingRect(largest[0])
+    box = np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]], dtype=np.float32)
+    return box / scale, False
+
+def order_points(pts):
+    """Orders 4 points as top-left, top-right, bottom-right, bottom-left."""
+    ordered = np.zeros((4, 2), dtype=np.float32)
+    s = pts.sum(axis=1)
+    ordered[0] = pts[np.argmin(s)]
+    ordered[2] = pts[np.argmax(s)]
+    diff = np.diff(pts, axis=1).ravel()  # y - x
+    ordered[1] = pts[np.argmin(diff)]
+    ordered[3] = pts[np.argmax(diff)]
+    return ordered
+
+def warp_document(img, corners, max_side=OUTPUT_MAX_SIDE):
+    """
+    Perspective-corrects the quadrilateral `corners` of img into a flat
+    rectangle. The output is already capped at max_side, so the full
+    resolution warp and the resize happen in a single pass.
+    """
+    tl, tr, br, bl = order_points(corners)
+    width = max(np.linalg.norm(br - bl), np.linalg.norm(tr - tl))
+    height = max(np.linalg.norm(tr - br), np.linalg.norm(tl - bl))
+    scale = min(1.0, max_side / max(width, height, 1))
+    out_w, out_h = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+    dst = np.array([[0, 0], [out_w - 1, 0], [out_w - 1, out_h - 1], [0, out_h - 1]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(np.array([tl, tr, br, bl]), dst)
+    return cv2.warpPerspective(img, matrix, (out_w, out_h), flags=cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR)
+
+def limit_size(img, max_side=OUTPUT_MAX_SIDE):
+    height, width = img.shape[:2]
+    scale = max_side / max(height, width)
+    if scale >= 1.0:
+        return img
+    return cv2.resize(img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+def fast_crop_document(img):
+    """
+    Optimized crop_document: detection on a downscaled proxy, perspective
+    correction of the 4-point contour, output capped at OUTPUT_MAX_SIDE.
+    Returns a BGR NumPy array.
+    """
+    corners, is_quad = find_document_corners(img)
+    if is_quad:
+        return warp_document(img, corners)
+    if corners is not None:
+        height, width = img.shape[:2]
+        x0, y0 = np.floor(corners.min(axis=0)).astype(int)
+        x1, y1 = np.ceil(corners.max(axis=0)).astype(int)
+        img = img[max(0, y0):min(height, y1), max(0, x0):min(width, x1)]
+    return limit_size(img)
+
+def encode_jpeg_array(img, max_bytes=MAX_JPEG_BYTES):
+    """
+    Encodes a BGR array straight to JPEG bytes, lowering the quality until
+    the result fits in max_bytes (or JPEG_MIN_QUALITY is reached).
+    """
+    quality = JPEG_QUALITY
+    while True:
+        ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError("Could not encode image")
+        if buffer.nbytes <= max_bytes or quality <= JPEG_MIN_QUALITY:
+            return buffer.tobytes()
+        quality = max(JPEG_MIN_QUALITY, quality - 10)
+
+def encode_jpeg(pil_image):
+    """
+    Encodes a PIL image as JPEG bytes.
+    Vertex Image.from_bytes requires bytes
+    """
     from io import BytesIO
     buffered = BytesIO()
     pil_image.save(buffered, format="JPEG")
-    image_bytes = buffered.getvalue()
-    vertex_image = VertexImage.from_bytes(image_bytes)
+    return buffered.getvalue()
 
-    prompt = """
-    Analyze this receipt image. Extract the following information in JSON format:
-    - establishment: The name of the store or merchant.
-    - date: The date of the transaction (YYYY-MM-DD format).
-    - amount: The total amount paid (numeric).
-    
-    Return ONLY valid JSON. do not include markdown blocks like ```json ... ```
+def preprocess_to_jpeg(image_path, fast=True):
+    """
+    Preprocessed JPEG bytes for the model. Returns plain bytes so it can run
+    in a process pool (see batch_scanner.py). fast=False uses the original
+    full-resolution preprocess_image + encode_jpeg path.
     """
+    if not fast:
+        return encode_jpeg(preprocess_image(image_path))
+    img = cv2.imread(image_path)
+    if img is None:
+        raise ValueError(f"Could not load image at {image_path}")
+    return encode_jpeg_array(fast_crop_document(img))
+
+def bytes_to_jpeg(image_bytes, fast=True):
+    """preprocess_to_jpeg for an encoded image already in memory."""
+    if not fast:
+        return encode_jpeg(preprocess_image_bytes(image_bytes))
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+    return encode_jpeg_array(fast_crop_document(img))
+
+def build_contents(image_bytes):
+    """Request contents for one receipt: the image followed by the prompt."""
+    return [VertexImage.from_bytes(image_bytes), PROMPT]
+
+def parse_response(text_response):
+    """Parses the model reply as JSON."""
+    # Clean up code blocks if present (just in case model ignores instruction)
+    text_response = text_response.strip()
+    if text_response.startswith('```json'):
+        text_response = text_response[7:]
+    if text_response.endswith('```'):
+        text_response = text_response[:-3]
     
-    try:
-        response = model.generate_content([vertex_image, prompt])
-        text_response = response.text
-        
-        # Clean up code blocks if present (just in case model ignores instruction)
-        text_response = text_response.strip()
-        if text_response.startswith('```json'):
-            text_response = text_response[7:]
-        if text_response.endswith('```'):
-            text_response = text_response[:-3]
-        
-        text_response = text_response.strip()
-            
-        return json.loads(text_response)
+    text_response = text_response.strip()
         
+    return json.loads(text_response)
+
+def extract_from_bytes(image_bytes, model=None):
+    """
+    Extracts data from a preprocessed JPEG, going to Vertex AI only on a cache miss.
+    Returns {"data": dict or None, "cached": bool, "duplicate_of": dict or None};
+    duplicate_of describes an earlier scan of what looks like the same receipt.
+    Raises ExtractionError when Vertex AI cannot be called; an answer that is
+    not valid JSON gives data None.
+    """
+    cache = get_cache()
+    lookup = cache.lookup(image_bytes, MODEL_ID, PROMPT_VERSION) if cache else None
+    if lookup and lookup["data"] is not None:
+        instrumentation.log("INFO", "Cache hit, skipping Vertex AI call")
+        return {"data": lookup["data"], "cached": True, "duplicate_of": None}
+
+    duplicate_of = None
+    if lookup and lookup["similar"]:
+        duplicate_of = dict(lookup["similar"]["data"], distance=lookup["similar"]["distance"])
+        instrumentation.log("WARNING", "This looks like an already scanned receipt", duplicate_of=duplicate_of)
+
+    model = model or get_model()
+    try:
+        response = model.generate_content(build_contents(image_bytes))
     except Exception as e:
-        print(f"Error calling Vertex AI: {e}")
-        return None
+        raise ExtractionError(f"Error calling Vertex AI ({MODEL_ID}): {e}") from e
+
+    try:
+        data = parse_response(response.text)
+    except ValueError:
+        instrumentation.log_exception("Unreadable Vertex AI answer", model=MODEL_ID)
+        return {"data": None, "cached": False, "duplicate_of": duplicate_of}
+    if lookup:
+        cache.store(lookup, data)
+    return {"data": data, "cached": False, "duplicate_of": duplicate_of}
+
+def extract_data(pil_image):
+    """
+    Sends the image to Gemini 2.5 Flash (via Vertex AI) to extract data.
+    """
+    # Convert PIL image to Vertex Image
+    image_bytes = encode_jpeg(pil_image)
+    return extract_from_bytes(image_bytes)["data"]
+
+def batch_generation_config():
+    return GenerationConfig(response_mime_type="application/json",
+                            response_schema=BATCH_RESPONSE_SCHEMA, temperature=0)
+
+def build_batch_contents(images, labels, problems=None):
+    """
+    Request contents for several receipts: each image preceded by its label,
+    then the batch prompt. `problems` ({label: [problem]}) turns it into a
+    re-ask that tells the model what was wrong with its previous answer.
+    """
+    contents = []
+    for label, image_bytes in zip(labels, images):
+        contents.append(f"Receipt {label}:")
+        contents.append(VertexImage.from_bytes(image_bytes))
+    prompt = BATCH_PROMPT
+    if problems:
+        prompt += REASK_PROMPT.format(problems="; ".join(
+            f"receipt {label}: {', '.join(items)}" for label, items in problems.items()))
+    contents.append(prompt)
+    return contents
+
+def parse_batch_response(text_response, labels):
+    """{label: data} from a schema-enforced batch reply. Unknown labels are dropped."""
+    wanted = set(labels)
+    answers = {}
+    for item in json.loads(text_response):
+        label = item.pop("index", None)
+        if label in wanted:
+            answers[label] = item
+    return answers
+
+def validate_receipt(data):
+    """Problems with an extracted receipt; an empty list means it looks right."""
+    problems = []
+    try:
+        date = datetime.date.fromisoformat(str(data.get("date")))
+        if not OLDEST_DATE <= date <= datetime.date.today() + datetime.timedelta(days=1):
+            problems.append(f"date {date} is out of range")
+    except ValueError:
+        problems.append("date is not YYYY-MM-DD")
+    try:
+        if float(data.get("amount")) <= 0:
+            problems.append("amount must be positive")
+    except (TypeError, ValueError):
+        problems.append("amount is not a number")
+    return problems
+
+def check_batch_answers(answers, labels, results):
+    """
+    Stores the answers for `labels` into results ({label: {"data", "errors"}})
+    and returns (labels to re-ask, {label: problems}).
+    """
+    retry, problems = [], {}
+    for label in labels:
+        data = answers.get(label)
+        if data is None:
+            results[label]["errors"] = ["missing from the reply"]
+            retry.append(label)
+            continue
+        results[label]["data"] = data
+        results[label]["errors"] = validate_receipt(data)
+        if results[label]["errors"]:
+            retry.append(label)
+            problems[label] = results[label]["errors"]
+    return retry, problems
+
+def extract_batch(images, model=None, max_reasks=MAX_REASKS):
+    """
+    Extracts several preprocessed JPEGs with BATCH_SIZE receipts per Vertex AI
+    request. Receipts whose date or amount fail validation are asked again
+    (up to max_reasks times), in one request per chunk with only those
+    receipts. Returns one {"data", "errors", "cached", "duplicate_of"} per
+    image, in order; "errors" lists validation problems left after re-asks.
+    """
+    cache = get_cache()
+    results = {}
+    lookups = {}
+    pending = []
+    for i, image_bytes in enumerate(images):
+        results[i] = {"data": None, "errors": [], "cached": False, "duplicate_of": None}
+        lookup = cache.lookup(image_bytes, MODEL_ID, PROMPT_VERSION) if cache else None
+        if lookup and lookup["data"] is not None:
+            results[i].update(data=lookup["data"], cached=True)
+            continue
+        if lookup and lookup["similar"]:
+            results[i]["duplicate_of"] = dict(lookup["similar"]["data"], distance=lookup["similar"]["distance"])
+        lookups[i] = lookup
+        pending.append(i)
+
+    if pending:
+        model = model or get_model()
+        instrumentation.log("INFO", f"Sending {len(pending)} receipts to Vertex AI Model: {MODEL_ID} ({BATCH_SIZE} per request)")
+    for start in range(0, len(pending), BATCH_SIZE):
+        labels = pending[start:start + BATCH_SIZE]
+        problems = {}
+        for _ in range(max_reasks + 1):
+            contents = build_batch_contents([images[i] for i in labels], labels, problems)
+            try:
+                response = model.generate_content(contents, generation_config=batch_generation_config())
+                answers = parse_batch_response(response.text, labels)
+            except Exception as e:
+                instrumentation.log_exception("Error calling Vertex AI", model=MODEL_ID, receipts=len(labels))
+                for i in labels:
+                    results[i]["errors"] = [f"request failed: {e}"]
+                break
+            labels, problems = check_batch_answers(answers, labels, results)
+            if not labels:
+                break
+
+    for i, lookup in lookups.items():
+        if lookup and results[i]["data"] is not None and not results[i]["errors"]:
+            cache.store(lookup, results[i]["data"])
+    return [results[i] for i in range(len(images))]
+
+def batch_prediction_line(images, labels):
+    """
+    One JSONL line of a Vertex AI batch prediction input file: the same packed
+    request as extract_batch, in REST form.
+    """
+    parts = []
+    for label, image_bytes in zip(labels, images):
+        parts.append({"text": f"Receipt {label}:"})
+        parts.append({"inlineData": {"mimeType": "image/jpeg",
+                                     "data": base64.b64encode(image_bytes).decode("ascii")}})
+    parts.append({"text": BATCH_PROMPT})
+    return json.dumps({"request": {
+        "contents": [{"role": "user", "parts": parts}],
+        "generationConfig": {"responseMimeType": "application/json",
+                             "responseSchema": BATCH_RESPONSE_SCHEMA, "temperature": 0},
+    }})
+
+def batch_prediction_answers(line):
+    """{label: data} from one line of a batch prediction output file."""
+    record = json.loads(line)
+    try:
+        text = record["response"]["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError):
+        instrumentation.log("WARNING", "Batch prediction request failed", status=record.get('status'))
+        return {}
+    return parse_batch_response(text, list(_labels_of(record["request"])))
+
+def _labels_of(request):
+    for part in request["contents"][0]["parts"]:
+        text = part.get("text", "")
+        if text.startswith("Receipt ") and text.endswith(":"):
+            yield int(text[len("Receipt "):-1])
 
 def main():
     if len(sys.argv) < 2:
@@ -144,16 +528,18 @@ def main():
 
     try:
         # 1. Preprocess
-        processed_image = preprocess_image(image_path)
+        print(f"Processing image: {image_path}")
+        image_bytes = preprocess_to_jpeg(image_path)
         
         # Save processed image with _crop suffix
-        base, ext = os.path.splitext(image_path)
-        output_path = f"{base}_crop{ext}"
-        processed_image.save(output_path)
+        base, _ = os.path.splitext(image_path)
+        output_path = f"{base}_crop.jpg"
+        with open(output_path, "wb") as f:
+            f.write(image_bytes)
         print(f"Processed image saved to '{output_path}'")
 
         # 2. Extract
-        data = extract_data(processed_image)
+        data = extract_from_bytes(image_bytes)["data"]
         
         if data:
             print(json.dumps(data, indent=4))
@@ -0,0 +1,90 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Small in-process cache for reference lists (categories, clients, users).
+    Entries expire after `ttl` seconds, at most `maxsize` are kept (LRU), and
+    writes invalidate them explicitly. Every entry carries an ETag so handlers
+    can answer conditional requests with 304.
+    """
+
+    def __init__(self, ttl=60, maxsize=32):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (expires_at, value, etag)
+        self._generation = {}  # bumped on invalidate, so in-flight loads don't store stale data
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        """Returns (value, etag), calling loader() on a miss or expired entry."""
+        now = time.monotonic()
+        hit, generation = self._lookup(key, now)
+        if hit:
+            return hit
+        return self._store(key, now, generation, loader())
+
+    async def aget(self, key, loader):
+        """Like get() for coroutines: awaits loader() on a miss."""
+        now = time.monotonic()
+        hit, generation = self._lookup(key, now)
+        if hit:
+            return hit
+        return self._store(key, now, generation, await loader())
+
+    def _lookup(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return (entry[1], entry[2]), None
+            self.misses += 1
+            return None, self._generation.get(key, 0)
+
+    def _store(self, key, now, generation, value):
+        etag = hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+        with self._lock:
+            if self._generation.get(key, 0) == generation:
+                self._entries[key] = (now + self.ttl, value, etag)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value, etag
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation[key] = self._generation.get(key, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+                "entries": list(self._entries.keys()),
+                "ttl": self.ttl,
+                "maxsize": self.maxsize,
+            }
+
+    def watch(self, db, collections):
+        """
+        Invalidates entries whenever their Firestore collection changes, so
+        writes made by other instances (or by import_json.py) are seen without
+        waiting for the TTL. `collections` maps cache key -> collection name.
+        Returns the listener handles.
+        """
+        watches = []
+        for key, collection in collections.items():
+            def on_change(docs, changes, read_time, key=key):
+                self.invalidate(key)
+            watches.append(db.collection(collection).on_snapshot(on_change))
+        return watches
@@ -0,0 +1,198 @@
+"""
+Pre-aggregated expense totals.
+
+One document per (period, dimension, key) in ROLLUPS_COLLECTION, e.g.
+month 2026-02 / categoria / Auto-Gasolina, with the running total, count
+and min/max of monto. add_expense, delete_expense and the batch endpoint
+add the bucket updates to the same batch as the expense writes
+(write_deltas: Increment/Minimum/Maximum transforms, no reads), so the
+totals commit or fail with the expenses they count. /api/summary reads
+O(buckets) documents instead of every expense. Buckets whose count drops
+to 0 stay with count 0 until the next rebuild.
+"""
+import sys
+from google.cloud import firestore
+
+from expense_fields import id_part, parse_fecha
+from gcp_clients import firestore_db
+
+EXPENSES_COLLECTION = 'expenses'
+ROLLUPS_COLLECTION = 'expense_rollups'
+
+DIMENSIONS = ['categoria', 'cliente', 'ejecutivo']
+TOTAL_DIMENSION = 'total'  # one bucket per period with the overall numbers
+NO_VALUE = '(sin valor)'
+NO_PERIOD = 'sin-fecha'
+BATCH_SIZE = 400
+
+
+def period_of(data):
+    """Monthly period 'YYYY-MM' from the expense fecha (NO_PERIOD if unreadable)."""
+    day = parse_fecha(data.get('fecha'))
+    return day.strftime('%Y-%m') if day else NO_PERIOD
+
+
+def amount_of(data):
+    try:
+        return float(data.get('monto') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def bucket_id(period, dimension, key):
+    return f"{period}|{dimension}|{id_part(key)}"
+
+
+def buckets_for(data):
+    """(period, dimension, key) of every bucket an expense contributes to."""
+    period = period_of(data)
+    buckets = [(period, TOTAL_DIMENSION, 'all')]
+    for dimension in DIMENSIONS:
+        buckets.append((period, dimension, str(data.get(dimension) or NO_VALUE)))
+    return buckets
+
+
+def accumulate(deltas, data, sign=1):
+    """Adds (sign=1) or removes (sign=-1) one expense to a dict of pending bucket deltas."""
+    amount = amount_of(data)
+    for bucket in buckets_for(data):
+        delta = deltas.setdefault(bucket, {'total': 0.0, 'count': 0, 'min': None, 'max': None, 'removed': []})
+        delta['total'] += sign * amount
+        delta['count'] += sign
+        if sign > 0:
+            delta['min'] = amount if delta['min'] is None else min(delta['min'], amount)
+            delta['max'] = amount if delta['max'] is None else max(delta['max'], amount)
+        else:
+            delta['removed'].append(amount)
+    return deltas
+
+
+def _merge(current, delta):
+    """New bucket values from the stored ones plus a delta. None means the bucket is now empty."""
+    count = current.get('count', 0) + delta['count']
+    if count <= 0:
+        return None
+    stale = current.get('minmax_stale', False)
+    low, high = current.get('min'), current.get('max')
+    # A removed amount equal to the current min/max leaves it unknown until the next rebuild
+    if any(amount in (low, high) for amount in delta['removed']):
+        stale = True
+    if delta['min'] is not None:
+        low = delta['min'] if low is None else min(low, delta['min'])
+        high = delta['max'] if high is None else max(high, delta['max'])
+    return {
+        'total': current.get('total', 0.0) + delta['total'],
+        'count': count,
+        'min': low,
+        'max': high,
+        'minmax_stale': stale,
+    }
+
+
+@firestore.transactional
+def _apply_in_transaction(transaction, db, deltas):
+    refs = {bucket: db.collection(ROLLUPS_COLLECTION).document(bucket_id(*bucket)) for bucket in deltas}
+    current = {snap.id: snap.to_dict() for snap in transaction.get_all(list(refs.values())) if snap.exists}
+    for bucket, ref in refs.items():
+        values = _merge(current.get(ref.id, {}), deltas[bucket])
+        if values is None:
+            transaction.delete(ref)
+            continue
+        period, dimension, key = bucket
+        values.update({'period': period, 'dimension': dimension, 'key': key})
+        transaction.set(ref, values)
+
+
+def apply(db, deltas):
+    """Commits pending deltas, at most BATCH_SIZE buckets per transaction."""
+    items = list(deltas.items())
+    for start in range(0, len(items), BATCH_SIZE):
+        _apply_in_transaction(db.transaction(), db, dict(items[start:start + BATCH_SIZE]))
+
+
+def write_deltas(batch, db, deltas):
+    """
+    Adds the bucket updates for pending deltas to an existing batch as
+    server-side transforms. Removals read the affected buckets once, only to
+    tell whether a removed amount was their min/max.
+    """
+    refs = {bucket: db.collection(ROLLUPS_COLLECTION).document(bucket_id(*bucket)) for bucket in deltas}
+    current = {}
+    removed = [refs[bucket] for bucket, delta in deltas.items() if delta['removed']]
+    if removed:
+        current = {snap.id: snap.to_dict() for snap in db.get_all(removed) if snap.exists}
+    for bucket, ref in refs.items():
+        delta = deltas[bucket]
+        period, dimension, key = bucket
+        values = {
+            'period': period, 'dimension': dimension, 'key': key,
+            'total': firestore.Increment(delta['total']),
+            'count': firestore.Increment(delta['count']),
+        }
+        if delta['min'] is not None:
+            values['min'] = firestore.Minimum(delta['min'])
+            values['max'] = firestore.Maximum(delta['max'])
+        stored = current.get(ref.id, {})
+        # A removed amount equal to the current min/max leaves it unknown until the next rebuild
+        if any(amount in (stored.get('min'), stored.get('max')) for amount in delta['removed']):
+            values['minmax_stale'] = True
+        batch.set(ref, values, merge=True)
+
+
+def summary_query(db, dimension, period_from=None, period_to=None):
+    """Query for summary(); works with the sync and the async client."""
+    query = db.collection(ROLLUPS_COLLECTION).where('dimension', '==', dimension)
+    if period_from:
+        query = query.where('period', '>=', period_from)
+    if period_to:
+        query = query.where('period', '<=', period_to)
+    return query.order_by('period')
+
+
+def summary(db, dimension, period_from=None, period_to=None):
+    """Buckets of one dimension between two periods (inclusive), ordered by period."""
+    return [doc.to_dict() for doc in summary_query(db, dimension, period_from, period_to).stream()]
+
+
+def rebuild(db):
+    """Recomputes every bucket from the expenses collection (backfill / repair)."""
+    deltas = {}
+    count = 0
+    for doc in db.collection(EXPENSES_COLLECTION).stream():
+        accumulate(deltas, doc.to_dict(), 1)
+        count += 1
+
+    fresh_ids = set()
+    batch = db.batch()
+    pending = 0
+    for (period, dimension, key), delta in deltas.items():
+        ref = db.collection(ROLLUPS_COLLECTION).document(bucket_id(period, dimension, key))
+        fresh_ids.add(ref.id)
+        batch.set(ref, {
+            'period': period, 'dimension': dimension, 'key': key,
+            'total': delta['total'], 'count': delta['count'],
+            'min': delta['min'], 'max': delta['max'], 'minmax_stale': False,
+        })
+        pending += 1
+        if pending == BATCH_SIZE:
+            batch.commit()
+            batch, pending = db.batch(), 0
+
+    # Buckets that no longer have any expense
+    for doc in db.collection(ROLLUPS_COLLECTION).stream():
+        if doc.id not in fresh_ids:
+            batch.delete(doc.reference)
+            pending += 1
+            if pending == BATCH_SIZE:
+                batch.commit()
+                batch, pending = db.batch(), 0
+    batch.commit()
+    print(f"Rollups rebuilt: {count} expenses into {len(deltas)} buckets.")
+    return len(deltas)
+
+
+if __name__ == "__main__":
+    if '--rebuild' not in sys.argv:
+        print("Usage: python rollups.py --rebuild")
+        sys.exit(1)
+    rebuild(firestore_db)
@@ -0,0 +1,109 @@
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import instrumentation
+
+# Like export_jobs: the status is persisted so any Cloud Run instance can
+# answer a poll. The image itself only lives in the memory of the instance
+# that received it, until its worker picks it up.
+JOBS_COLLECTION = 'scan_jobs'
+ACTIVE_STATUSES = ['queued', 'running']
+# Job documents carry expires_at for a Firestore TTL policy (setup.txt)
+KEEP_FOR = timedelta(days=1)
+
+
+class ScanQueueFull(Exception):
+    pass
+
+
+class ScanJobs:
+    """
+    Runs receipt scans on a small worker pool. start() returns a job id right
+    away, so no request thread waits for OpenCV or Vertex AI; the client polls
+    get() until the job leaves queued/running. At most max_queue scans are
+    running or waiting, and a job older than timeout seconds is reported as
+    failed (its worker may still be busy, or the instance was recycled).
+    """
+
+    def __init__(self, db, scan_fn, workers=2, max_queue=8, timeout=45):
+        self._db = db
+        self._scan_fn = scan_fn
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan')
+        self._slots = threading.BoundedSemaphore(max_queue)
+
+    def _ref(self, job_id):
+        return self._db.collection(JOBS_COLLECTION).document(job_id)
+
+    def _update(self, job_id, fields):
+        fields['updated_at'] = datetime.now(timezone.utc)
+        self._ref(job_id).set(fields, merge=True)
+
+    def start(self, image_bytes, owner):
+        """Enqueues a scan of image_bytes and returns its job id; ScanQueueFull if the queue is full."""
+        if not self._slots.acquire(blocking=False):
+            raise ScanQueueFull()
+        try:
+            job_id = uuid.uuid4().hex
+            now = datetime.now(timezone.utc)
+            self._update(job_id, {'status': 'queued', 'owner': owner, 'created_at': now,
+                                  'expires_at': now + KEEP_FOR})
+            self._executor.submit(self._run, job_id, image_bytes, time.monotonic())
+        except Exception:
+            self._slots.release()
+            raise
+        return job_id
+
+    def _run(self, job_id, image_bytes, queued_at):
+        try:
+            if time.monotonic() - queued_at > self.timeout:
+                return  # get() already reports it as timed out: don't spend a worker on it
+            started = time.perf_counter()
+            self._update(job_id, {'status': 'running'})
+            try:
+                result = self._scan_fn(image_bytes)
+            except Exception as e:
+                instrumentation.log_exception("Error escaneando recibo", job_id=job_id)
+                self._update(job_id, {'status': 'error', 'error': str(e),
+                                      'elapsed': round(time.perf_counter() - started, 2)})
+                return
+            data = result["data"]
+            if not data:
+                self._update(job_id, {'status': 'error', 'error': "No se pudo leer el recibo",
+                                      'elapsed': round(time.perf_counter() - started, 2)})
+                return
+            self._update(job_id, {
+                'status': 'success',
+                'fields': {
+                    'establecimiento': data.get('establishment'),
+                    'fecha': data.get('date'),
+                    'monto': data.get('amount'),
+                },
+                'cached': result["cached"],
+                'duplicate_of': result["duplicate_of"],
+                'elapsed': round(time.perf_counter() - started, 2),
+            })
+        except Exception:
+            instrumentation.log_exception("Error actualizando escaneo", job_id=job_id)
+        finally:
+            self._slots.release()
+
+    def get(self, job_id):
+        """Returns the job status as a JSON-friendly dict, or None."""
+        doc = self._ref(job_id).get()
+        if not doc.exists:
+            return None
+        job = doc.to_dict()
+        job['id'] = job_id
+        created_at = job.get('created_at')
+        if job['status'] in ACTIVE_STATUSES and created_at and \
+                datetime.now(timezone.utc) - created_at > timedelta(seconds=self.timeout):
+            job['status'] = 'error'
+            job['error'] = "El escaneo tardó demasiado"
+        for key, value in job.items():
+            if isinstance(value, datetime):
+                job[key] = value.isoformat()
+        return job
@@ -0,0 +1,166 @@
+"""
+Inverted index for expense text search.
+
+Every expense gets an entry in INDEX_COLLECTION (same document id) whose
+`terms` array holds the accent-folded tokens of establecimiento, cliente and
+descripcion plus their prefixes. Firestore indexes array members, so an
+`array_contains` lookup on one term is an index seek whose cost depends on
+the number of matches, not on the size of the expenses collection.
+"""
+import re
+import sys
+import unicodedata
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from gcp_clients import firestore_db
+
+EXPENSES_COLLECTION = 'expenses'
+INDEX_COLLECTION = 'expenses_search'
+
+# Field weights used for ranking
+INDEXED_FIELDS = {'establecimiento': 3, 'cliente': 2, 'descripcion': 1}
+MIN_PREFIX = 2
+MAX_PREFIX = 12  # longer prefixes add index entries without improving recall
+# Upper bound of index entries read to fill one page of results
+MAX_SCAN_PER_PAGE = 500
+BATCH_SIZE = 400  # Firestore allows 500 writes per batch
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text):
+    """Lowercases and strips accents: 'Café Ñandú' -> 'cafe nandu'."""
+    decomposed = unicodedata.normalize('NFKD', str(text or ''))
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(normalize(text))
+
+
+def _prefixes(token):
+    return [token[:n] for n in range(MIN_PREFIX, min(len(token), MAX_PREFIX) + 1)]
+
+
+def build_entry(data):
+    """Index entry for one expense: searchable terms plus the fields needed to filter without reading the expense."""
+    tokens = {field: tokenize(data.get(field)) for field in INDEXED_FIELDS}
+    terms = set()
+    for field_tokens in tokens.values():
+        for token in field_tokens:
+            terms.add(token)
+            terms.update(_prefixes(token))
+    return {
+        'terms': sorted(terms),
+        'tokens': tokens,
+        'ejecutivo': data.get('ejecutivo'),
+        'categoria': data.get('categoria'),
+        'cliente': data.get('cliente'),
+        'fecha': data.get('fecha'),
+    }
+
+
+def index_expense(batch, db, doc_id, data):
+    """Adds the index entry write to an existing batch/transaction."""
+    batch.set(db.collection(INDEX_COLLECTION).document(doc_id), build_entry(data))
+
+
+def unindex_expense(batch, db, doc_id):
+    batch.delete(db.collection(INDEX_COLLECTION).document(doc_id))
+
+
+def _score(query_tokens, entry):
+    """Sum of field weights, doubled for whole-word matches. 0 if any query token is missing."""
+    total = 0
+    for q in query_tokens:
+        best = 0
+        for field, weight in INDEXED_FIELDS.items():
+            for token in entry.get('tokens', {}).get(field, []):
+                if token == q:
+                    best = max(best, weight * 2)
+                elif token.startswith(q):
+                    best = max(best, weight)
+        if not best:
+            return 0
+        total += best
+    return total
+
+
+def search(db, text, ejecutivo=None, date_from=None, date_to=None,
+           category=None, client=None, page_size=20, cursor=None):
+    """
+    Returns (ranked expense ids, next cursor). Pages advance newest-first by
+    (fecha, id) like /api/expenses, and results within a page are ordered by
+    relevance. `ejecutivo` restricts the search to one user's expenses.
+    """
+    query_tokens = tokenize(text)
+    if not query_tokens:
+        return [], None
+
+    # The longest token is the most selective one to push down to Firestore;
+    # the rest are checked against the entry's stored tokens.
+    pivot = max(query_tokens, key=len)[:MAX_PREFIX]
+    query = db.collection(INDEX_COLLECTION).where('terms', 'array_contains', pivot)
+    if ejecutivo is not None:
+        query = query.where('ejecutivo', '==', ejecutivo)
+    if date_from:
+        query = query.where('fecha', '>=', date_from)
+    if date_to:
+        query = query.where('fecha', '<=', date_to)
+    query = query.order_by('fecha', direction=firestore.Query.DESCENDING)
+    query = query.order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+
+    matches = []
+    scanned = 0
+    exhausted = False
+    while len(matches) < page_size and scanned < MAX_SCAN_PER_PAGE:
+        batch_query = query.limit(page_size)
+        if cursor:
+            batch_query = batch_query.start_after({'fecha': cursor[0], '__name__': cursor[1]})
+        docs = list(batch_query.stream())
+        scanned += len(docs)
+
+        for doc in docs:
+            entry = doc.to_dict()
+            cursor = (entry.get('fecha'), doc.id)
+            if category and entry.get('categoria') != category:
+                continue
+            if client and entry.get('cliente') != client:
+                continue
+            score = _score(query_tokens, entry)
+            if score:
+                matches.append((score, doc.id))
+            if len(matches) == page_size:
+                break
+
+        if len(docs) < page_size:
+            exhausted = not docs or cursor[1] == docs[-1].id
+            break
+
+    # sort() is stable, so equal scores keep the newest-first order
+    matches.sort(key=lambda m: m[0], reverse=True)
+    next_cursor = None if exhausted or cursor is None else cursor
+    return [doc_id for _, doc_id in matches], next_cursor
+
+
+def rebuild(db):
+    """Rebuilds the whole index from the expenses collection."""
+    count = 0
+    batch = db.batch()
+    for doc in db.collection(EXPENSES_COLLECTION).stream():
+        index_expense(batch, db, doc.id, doc.to_dict())
+        count += 1
+        if count % BATCH_SIZE == 0:
+            batch.commit()
+            batch = db.batch()
+            print(f"Indexed {count} expenses...")
+    batch.commit()
+    print(f"Search index rebuilt: {count} expenses.")
+    return count
+
+
+if __name__ == "__main__":
+    if '--rebuild' not in sys.argv:
+        print("Usage: python search_index.py --rebuild")
+        sys.exit(1)
+    rebuild(firestore_db)
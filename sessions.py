@@ -0,0 +1,202 @@
+"""
+Signed session tokens for the API.
+
+/api/login checks the password hash once (slow on purpose: scrypt/pbkdf2)
+and returns a token carrying the username and role read from the users
+collection. Every other request is authenticated by verifying the token's
+HMAC-SHA256 signature in constant time: no Firestore read and no password
+hashing per request, and the user can no longer be chosen with a user_id
+query parameter.
+
+Tokens use the JWT compact format (HS256), signed with SESSION_SECRET. All
+instances must share the secret; without it each process makes up its own
+and tokens stop working after a restart or on another instance.
+
+Revocation (password change, deleted user) is an in-process cache of
+"tokens issued before this time are invalid" per user, kept for SESSION_TTL
+seconds, when every token it could reject has expired anyway. Another
+instance keeps accepting the revoked tokens until they expire, so keep
+SESSION_TTL short.
+"""
+import os
+import json
+import time
+import hmac
+import base64
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict, deque
+
+import instrumentation
+
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 8 * 3600))
+LOGIN_MAX_FAILURES = int(os.environ.get('LOGIN_MAX_FAILURES', 5))  # per username...
+LOGIN_WINDOW = int(os.environ.get('LOGIN_WINDOW', 300))             # ...in this many seconds
+
+ROLES = ['admin', 'gerente', 'user']
+ADMIN_ROLES = ['admin', 'gerente']  # see and manage every ejecutivo's expenses
+
+_HEADER = {"alg": "HS256", "typ": "JWT"}
+
+
+def _load_secret():
+    secret = os.environ.get('SESSION_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+    instrumentation.log("WARNING", "SESSION_SECRET not set; sessions will not survive a restart or work across instances")
+    return secrets.token_bytes(32)
+
+
+_secret = _load_secret()
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _sign(signing_input):
+    return hmac.new(_secret, signing_input.encode('ascii'), hashlib.sha256).digest()
+
+
+def role_of(username, stored_role=None):
+    """Role from the user document; accounts created before roles get it from their name."""
+    if stored_role in ROLES and stored_role != 'user':
+        return stored_role
+    if username == 'admin':
+        return 'admin'
+    if username.startswith('Gerente-'):
+        return 'gerente'
+    return 'user'
+
+
+class Session:
+    def __init__(self, username, role, issued_at, expires_at):
+        self.username = username
+        self.role = role
+        self.issued_at = issued_at
+        self.expires_at = expires_at
+
+    @property
+    def is_admin(self):
+        return self.role in ADMIN_ROLES
+
+
+class RevocationCache:
+    """username -> time before which its tokens are rejected; entries outlive every token they reject."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._revoked = OrderedDict()
+        self._lock = threading.Lock()
+
+    def revoke(self, username):
+        with self._lock:
+            self._revoked.pop(username, None)
+            self._revoked[username] = time.time()
+            self._purge()
+
+    def is_revoked(self, username, issued_at):
+        with self._lock:
+            revoked_at = self._revoked.get(username)
+        return revoked_at is not None and issued_at <= revoked_at
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl
+        while self._revoked and next(iter(self._revoked.values())) < cutoff:
+            self._revoked.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._revoked)
+
+
+class LoginLimiter:
+    """
+    Failed logins per key (the username) in a sliding window. Bounded: at
+    most maxsize keys are tracked, the least recently failed ones go first.
+    """
+
+    def __init__(self, max_failures, window, maxsize=10000):
+        self.max_failures = max_failures
+        self.window = window
+        self.maxsize = maxsize
+        self._failures = OrderedDict()  # key -> deque of failure times
+        self._lock = threading.Lock()
+        self.blocked = 0
+
+    def retry_after(self, key):
+        """Seconds until key may try again; 0 if it is not blocked."""
+        now = time.monotonic()
+        with self._lock:
+            failures = self._failures.get(key)
+            if not failures:
+                return 0
+            while failures and failures[0] <= now - self.window:
+                failures.popleft()
+            if len(failures) < self.max_failures:
+                return 0
+            self.blocked += 1
+            return int(failures[0] + self.window - now) + 1
+
+    def failed(self, key):
+        with self._lock:
+            failures = self._failures.pop(key, None) or deque(maxlen=self.max_failures)
+            failures.append(time.monotonic())
+            self._failures[key] = failures
+            while len(self._failures) > self.maxsize:
+                self._failures.popitem(last=False)
+
+    def succeeded(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"tracked": len(self._failures), "blocked": self.blocked,
+                    "max_failures": self.max_failures, "window": self.window}
+
+
+revocations = RevocationCache(SESSION_TTL)
+login_limiter = LoginLimiter(LOGIN_MAX_FAILURES, LOGIN_WINDOW)
+
+
+def issue(username, role):
+    """Signed token for username/role, valid for SESSION_TTL seconds."""
+    now = time.time()
+    payload = {"sub": username, "role": role, "iat": round(now, 3), "exp": int(now + SESSION_TTL)}
+    signing_input = _b64encode(json.dumps(_HEADER, separators=(',', ':')).encode('utf-8')) + '.' + \
+        _b64encode(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+    return signing_input + '.' + _b64encode(_sign(signing_input))
+
+
+def verify(token):
+    """Session for a valid, unexpired, unrevoked token; None otherwise."""
+    if not token or token.count('.') != 2:
+        return None
+    signing_input, _, signature = token.rpartition('.')
+    try:
+        if not hmac.compare_digest(_sign(signing_input), _b64decode(signature)):
+            return None
+        payload = json.loads(_b64decode(signing_input.split('.')[1]))
+        session = Session(payload['sub'], payload['role'], payload['iat'], payload['exp'])
+    except (ValueError, KeyError, TypeError):
+        return None
+    if session.expires_at <= time.time() or revocations.is_revoked(session.username, session.issued_at):
+        return None
+    return session
+
+
+def token_from(authorization, query_token=None):
+    """Token from an 'Authorization: Bearer ...' header, else query_token (EventSource cannot send headers)."""
+    if authorization and authorization.startswith('Bearer '):
+        return authorization[len('Bearer '):].strip()
+    return query_token
+
+
+def stats():
+    return {"ttl": SESSION_TTL, "revoked_users": len(revocations), "login": login_limiter.stats()}
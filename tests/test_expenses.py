@@ -0,0 +1,96 @@
+"""
+POST /api/expenses without Firestore: the client is replaced by a mock and
+the test looks at the documents the request writes.
+
+    python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as web
+import expense_fields
+import import_json
+import rollups
+import sessions
+
+
+class AddExpenseTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mock.MagicMock()
+        self.db.get_all.return_value = []  # nothing indexed yet: no duplicates
+        self.db.collection.return_value.document.return_value.id = 'e1'
+        patcher = mock.patch.object(web, 'db', self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = web.app.test_client()
+        self.headers = {"Authorization": "Bearer " + sessions.issue('ana', 'user')}
+
+    def document_ids(self):
+        """Ids passed to document() in any collection (expense, indexes, rollups)."""
+        return [call.args[0] for call in self.db.collection.return_value.document.call_args_list if call.args]
+
+    def test_day_month_year_fecha_is_stored_as_iso(self):
+        response = self.client.post('/api/expenses', headers=self.headers, json={
+            "fecha": "05/03/2024", "monto": 45.9, "categoria": "Auto-Gasolina", "cliente": "Delosi"})
+        self.assertEqual(response.status_code, 201, response.get_json())
+
+        batch = self.db.batch.return_value
+        expense = next(call.args[1] for call in batch.set.call_args_list if 'monto' in call.args[1])
+        self.assertEqual(expense['fecha'], '2024-03-05')
+        ids = self.document_ids()
+        self.assertIn('2024-03|total|all', ids)
+        self.assertTrue(all('/' not in doc_id for doc_id in ids), ids)
+        batch.commit.assert_called_once()
+
+    def test_unreadable_fecha_is_rejected(self):
+        response = self.client.post('/api/expenses', headers=self.headers, json={
+            "fecha": "2024/03/05", "monto": 10})
+        self.assertEqual(response.status_code, 400)
+        self.db.batch.return_value.commit.assert_not_called()
+
+
+class NormalizeExpenseTest(unittest.TestCase):
+    def test_numeric_id_is_text(self):
+        client_id, _, _ = web.normalize_expense({"id": 5, "fecha": "2024-03-05", "monto": 1}, {}, {})
+        self.assertEqual(client_id, "5")
+
+    def test_reserved_id_is_invalid(self):
+        _, _, errors = web.normalize_expense({"id": "__x__", "fecha": "2024-03-05", "monto": 1}, {}, {})
+        self.assertTrue(any(error.startswith("id inválido") for error in errors), errors)
+
+
+class PeriodTest(unittest.TestCase):
+    def test_period_of(self):
+        self.assertEqual(rollups.period_of({'fecha': '2024-03-05'}), '2024-03')
+        self.assertEqual(rollups.period_of({'fecha': '05/03/2024'}), '2024-03')
+        self.assertEqual(rollups.period_of({'fecha': '2024/03/05'}), rollups.NO_PERIOD)
+        self.assertEqual(rollups.period_of({}), rollups.NO_PERIOD)
+
+
+class ParseMontoTest(unittest.TestCase):
+    def test_formats(self):
+        self.assertEqual(expense_fields.parse_monto(45.9), 45.9)
+        self.assertEqual(expense_fields.parse_monto('S/ 1,234.50'), 1234.5)
+        self.assertEqual(expense_fields.parse_monto('12,50'), 12.5)
+        self.assertEqual(expense_fields.parse_monto('S/ 10'), 10.0)
+        self.assertIsNone(expense_fields.parse_monto('diez'))
+        self.assertIsNone(expense_fields.parse_monto(True))
+
+
+class CsvRecordsTest(unittest.TestCase):
+    def test_unreadable_monto_is_reported_not_raised(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, encoding='utf-8') as f:
+            f.write('fecha,monto\n2024-03-05,"12,50"\n2024-03-06,S/ 10\n2024-03-07,diez\n')
+        self.addCleanup(os.remove, f.name)
+        records = list(import_json.iter_records(f.name, float_fields=['monto']))
+        self.assertEqual([row['monto'] for row, _ in records], [12.5, 10.0, 'diez'])
+        self.assertEqual([error is None for _, error in records], [True, True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()